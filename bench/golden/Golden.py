@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+
+# Local, file backed stand-in of the Golden module for the taxo_pack benchmark.
+#
+# The flat files are read from $GOLDENDATA/bench_golden.dat, indexed by
+# $GOLDENDATA/bench_golden.idx ('acc\toffset\tlength' lines), both written by
+# "taxobench.py generate". $GOLDEN_STANDIN_LATENCY (seconds by card, default 0)
+# simulates the cost of the real Golden indexes.
+
+import os
+import time
+
+_store = {}
+_pending = {}
+
+
+def _load():
+    if not _store:
+        goldendata = os.environ.get('GOLDENDATA', '.').split(os.pathsep)[0]
+        index = {}
+        idxfh = open(os.path.join(goldendata, 'bench_golden.idx'))
+        for line in idxfh:
+            acc, offset, length = line.split('\t')
+            index[acc] = (int(offset), int(length))
+        idxfh.close()
+        _store['index'] = index
+        _store['flat'] = open(os.path.join(goldendata, 'bench_golden.dat'), 'rb')
+        _store['latency'] = float(os.environ.get('GOLDEN_STANDIN_LATENCY', 0))
+    return _store
+
+
+def access(db, ac):
+    store = _load()
+    if store['latency']:
+        time.sleep(store['latency'])
+    entry = store['index'].get(ac)
+    if entry is None:
+        return ''
+    store['flat'].seek(entry[0])
+    return store['flat'].read(entry[1])
+
+
+def access_new(cards):
+    """
+    First call: start the 'db:acc\\n...' cards batch and return the first flat
+    file. Next calls with the same cards: the following flat files, then None.
+    """
+    cards_iter = _pending.get(cards)
+    if cards_iter is None:
+        cards_iter = _pending[cards] = iter([card.split(':', 1) for card in cards.split('\n') if card])
+    for db, ac in cards_iter:
+        return access(db, ac)
+    del _pending[cards]
+    return None
@@ -0,0 +1,375 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Performance benchmark of the taxo_pack programs, without the real Golden and
+# taxodb databases.
+#
+#  taxobench.py generate -o DIR -n 10000    synthetic m8 files, taxodb/gg BDB, Golden flat files
+#  taxobench.py run -d DIR -o results.json  time taxoptimizer (ncbi, gg), rankoptimizer and
+#                                           kronaextract (with their --metrics reports)
+#  taxobench.py compare old.json new.json   compare two results files
+#
+# version 2.1
+
+import os
+import sys
+import json
+import time
+import random
+import bisect
+import argparse
+import platform
+import subprocess
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+SRC_DIR = os.path.join(os.path.dirname(BENCH_DIR), 'src')
+GOLDEN_STANDIN_DIR = os.path.join(BENCH_DIR, 'golden')
+
+RANKS = ['superkingdom', 'phylum', 'class', 'order', 'family', 'genus']
+SUPERKINGDOMS = ['Bacteria', 'Archaea', 'Eukaryota', 'Viruses']
+
+
+class TaxoBenchError:
+    def __init__(self, err):
+        self.err = err
+
+    def __repr__(self):
+        return "[taxobench] " + self.err
+
+
+##############################################################################
+#
+#            Synthetic data
+#
+##############################################################################
+
+
+def zipf_cdf(nb, skew):
+    """
+    Cumulative distribution of a Zipf law (rank i weight 1/i**skew) on nb items.
+    """
+    cdf = []
+    total = 0.0
+    for i in xrange(1, nb + 1):
+        total += 1.0 / i ** skew
+        cdf.append(total)
+    return [x / total for x in cdf]
+
+
+def draw(cdf, rnd):
+    return min(bisect.bisect_left(cdf, rnd.random()), len(cdf) - 1)
+
+
+def make_organisms(nb_organisms, rnd):
+    """
+    [(orgName, taxid, lineage with ranks, lineage without ranks), ...]
+    """
+    organisms = []
+    for i in xrange(nb_organisms):
+        names = [SUPERKINGDOMS[i % len(SUPERKINGDOMS)]]
+        # 4 children by node under the superkingdoms
+        levels = RANKS[1:]
+        for depth, rank in enumerate(levels):
+            node = i / 4 ** (len(levels) - depth)
+            names.append('%s %s%d' % (names[0][:4], rank.capitalize(), node))
+        org_name = 'Synthetic organism %d' % i
+        lineage = '; '.join(['%s (%s)' % (name, rank) for name, rank in zip(names, RANKS)] + ['%s (species)' % org_name])
+        organisms.append((org_name, 100000 + i, lineage, '; '.join(names)))
+    return organisms
+
+
+def uniprot_entry(acc, organism, rnd):
+    org_name, taxid, lineage, light = organism
+    oc = ['OC   %s;' % name for name in light.split('; ')]
+    return '\n'.join(['ID   %s_SYNTH              Unreviewed;       %d AA.' % (acc, rnd.randint(50, 3000)),
+                      'AC   %s;' % acc,
+                      'DT   01-JAN-2016, integrated into UniProtKB/TrEMBL.',
+                      'DE   SubName: Full=Synthetic protein %s;' % acc,
+                      'OS   %s.' % org_name] +
+                     oc +
+                     ['OX   NCBI_TaxID=%d;' % taxid,
+                      'RN   [1]',
+                      'SQ   SEQUENCE   100 AA;  11000 MW;  0000000000000000 CRC64;',
+                      '     MSTNPKPQRK TKRNTNRRPQ DVKFPGGGQI VGGVYLLPRR GPRLGVRATR KTSERSQPRG',
+                      '//',
+                      ''])
+
+
+def write_golden(directory, accessions, organisms, rnd, missing=0.02):
+    """
+    Flat files of the Golden stand-in: all the accessions but a missing fraction.
+    """
+    datfh = open(os.path.join(directory, 'bench_golden.dat'), 'wb')
+    idxfh = open(os.path.join(directory, 'bench_golden.idx'), 'w')
+    for acc, org in accessions:
+        if rnd.random() < missing:
+            continue
+        entry = uniprot_entry(acc, organisms[org], rnd)
+        print >>idxfh, "%s\t%d\t%d" % (acc, datfh.tell(), len(entry))
+        datfh.write(entry)
+    datfh.close()
+    idxfh.close()
+
+
+def write_taxodb(path, organisms, rnd, missing=0.05):
+    """
+    taxodb_ncbi like BDB: 'orgName.' --> lineage, but a missing fraction.
+    """
+    from bsddb3 import db as bdb
+    taxodb = bdb.DB()
+    taxodb.open(path, None, bdb.DB_HASH, bdb.DB_CREATE)
+    for org_name, taxid, lineage, light in organisms:
+        if rnd.random() >= missing:
+            taxodb.put(org_name + '.', lineage)
+    taxodb.close()
+
+
+def write_gg_db(path, nb_accessions, organisms, rnd):
+    """
+    taxo_rrna like BDB: acc --> 'orgName_@#$_lineage'
+    """
+    from bsddb3 import db as bdb
+    ggdb = bdb.DB()
+    ggdb.open(path, None, bdb.DB_HASH, bdb.DB_CREATE)
+    for i in xrange(nb_accessions):
+        org_name, taxid, lineage, light = organisms[rnd.randrange(len(organisms))]
+        ggdb.put('GG%07d' % i, '%s_@#$_%s' % (org_name, light))
+    ggdb.close()
+
+
+def write_m8(path, nb_lines, subjects, cdf, rnd):
+    """
+    Blast m8 file grouped by query, 1 to 10 HSPs by query, subjects drawn with cdf.
+    """
+    outfh = open(path, 'w')
+    line = 0
+    query = 0
+    while line < nb_lines:
+        query += 1
+        score = rnd.uniform(30, 800)
+        for hsp in xrange(min(rnd.randint(1, 10), nb_lines - line)):
+            subject = subjects[draw(cdf, rnd)]
+            print >>outfh, "read_%d\t%s\t%.2f\t%d\t%d\t0\t1\t%d\t%d\t%d\t%.2g\t%.1f" % (query, subject, rnd.uniform(70, 100), rnd.randint(30, 300), rnd.randint(0, 10),
+                                                                                       rnd.randint(30, 300), rnd.randint(1, 3000), rnd.randint(1, 3000), 10 ** -rnd.uniform(1, 50), score)
+            score *= rnd.uniform(0.8, 1.0)
+            line += 1
+    outfh.close()
+
+
+def generate(args):
+    rnd = random.Random(args.seed)
+    if not os.path.isdir(args.outdir):
+        os.makedirs(args.outdir)
+    golden_dir = os.path.join(args.outdir, 'golden')
+    if not os.path.isdir(golden_dir):
+        os.makedirs(golden_dir)
+
+    organisms = make_organisms(args.organisms, rnd)
+    accessions = [('S%07d' % i, rnd.randrange(len(organisms))) for i in xrange(args.accessions)]
+    print >>sys.stderr, "Golden flat files: %d accessions" % len(accessions)
+    write_golden(golden_dir, accessions, organisms, rnd)
+    print >>sys.stderr, "taxodb: %d organisms" % len(organisms)
+    write_taxodb(os.path.join(args.outdir, 'taxodb.bdb'), organisms, rnd)
+    write_gg_db(os.path.join(args.outdir, 'gg.bdb'), args.accessions, organisms, rnd)
+
+    cdf = zipf_cdf(args.accessions, args.skew)
+    # shuffled ranks: the frequent accessions are spread over the Golden store
+    order = range(args.accessions)
+    rnd.shuffle(order)
+    for nb_lines in args.lines:
+        print >>sys.stderr, "m8 files: %d lines" % nb_lines
+        write_m8(os.path.join(args.outdir, 'ncbi_%d.m8' % nb_lines), nb_lines,
+                 ['tr|%s|%s_SYNTH' % (accessions[i][0], accessions[i][0]) for i in order], cdf, rnd)
+        write_m8(os.path.join(args.outdir, 'gg_%d.m8' % nb_lines), nb_lines,
+                 ['gg|GG%07d' % i for i in order], cdf, rnd)
+
+    # rankoptimizer needs a Krona javascript library, only copied in its html outputs
+    jsfh = open(os.path.join(args.outdir, 'krona.js'), 'w')
+    print >>jsfh, "// Krona javascript library stand-in"
+    jsfh.close()
+    paramsfh = open(os.path.join(args.outdir, 'params.json'), 'w')
+    json.dump({'lines': args.lines, 'accessions': args.accessions, 'organisms': args.organisms,
+               'skew': args.skew, 'seed': args.seed}, paramsfh, indent=2, sort_keys=True)
+    paramsfh.close()
+
+
+##############################################################################
+#
+#            Runs
+#
+##############################################################################
+
+
+def run_program(name, command, metrics_file, env, repeat):
+    """
+    Best (lowest wall time) of repeat runs of command, with its --metrics report.
+    """
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        status = subprocess.call(command, env=env)
+        wall = time.time() - start
+        if status:
+            raise TaxoBenchError("%s exited with status %d: %s" % (name, status, ' '.join(command)))
+        if best is None or wall < best['wall_time']:
+            metricsfh = open(metrics_file)
+            best = {'benchmark': name, 'command': command[1:], 'wall_time': wall, 'metrics': json.load(metricsfh)}
+            metricsfh.close()
+    print >>sys.stderr, "%-30s %10.3f s" % (name, best['wall_time'])
+    return best
+
+
+def run(args):
+    datadir = os.path.abspath(args.datadir)
+    paramsfh = open(os.path.join(datadir, 'params.json'))
+    params = json.load(paramsfh)
+    paramsfh.close()
+    workdir = os.path.join(datadir, 'runs')
+    if not os.path.isdir(workdir):
+        os.makedirs(workdir)
+
+    env = dict(os.environ)
+    env['GOLDENDATA'] = os.path.join(datadir, 'golden')
+    env['PYTHONPATH'] = os.pathsep.join([GOLDEN_STANDIN_DIR, SRC_DIR] + [path for path in [os.environ.get('PYTHONPATH')] if path])
+    env['GOLDEN_STANDIN_LATENCY'] = str(args.latency)
+    python = sys.executable
+    metrics_file = os.path.join(workdir, 'metrics.json')
+
+    benchmarks = []
+    for nb_lines in params['lines']:
+        if args.lines and nb_lines not in args.lines:
+            continue
+        ncbi_m8 = os.path.join(datadir, 'ncbi_%d.m8' % nb_lines)
+        ncbi_taxo = os.path.join(workdir, 'ncbi_%d.taxo' % nb_lines)
+        command = [python, os.path.join(SRC_DIR, 'taxoptimizer.py'), '-i', ncbi_m8, '-o', ncbi_taxo, '-t', 'ncbi',
+                   '-b', os.path.join(datadir, 'taxodb.bdb'), '--metrics', metrics_file, '--progress', '0'] + args.taxoptimizer_args.split()
+        benchmarks.append(run_program('taxoptimizer_ncbi_%d' % nb_lines, command, metrics_file, env, args.repeat))
+
+        command = [python, os.path.join(SRC_DIR, 'taxoptimizer.py'), '-i', os.path.join(datadir, 'gg_%d.m8' % nb_lines),
+                   '-o', os.path.join(workdir, 'gg_%d.taxo' % nb_lines), '-t', 'gg', '-b', os.path.join(datadir, 'gg.bdb'),
+                   '--metrics', metrics_file, '--progress', '0']
+        benchmarks.append(run_program('taxoptimizer_gg_%d' % nb_lines, command, metrics_file, env, args.repeat))
+
+        # tree build and every Krona writer
+        prefix = os.path.join(workdir, 'rank_%d' % nb_lines)
+        command = [python, os.path.join(SRC_DIR, 'rankoptimizer.py'), '-i', ncbi_taxo, '-s', os.path.join(datadir, 'krona.js'),
+                   '-k', prefix + '.xml', '-t', prefix + '.txt', '-v', prefix + '.html', '-V', prefix + '_json.html',
+                   '-j', prefix + '.json', '-p', prefix + '.dmp', '-R', '-d', '10',
+                   '--metrics', metrics_file, '--progress', '0'] + args.rankoptimizer_args.split()
+        benchmarks.append(run_program('rankoptimizer_%d' % nb_lines, command, metrics_file, env, args.repeat))
+
+        command = [python, os.path.join(SRC_DIR, 'kronaextract.py'), '-i', prefix + '.xml', '-n', 'Bacteria',
+                   '-o', prefix + '.extract', '--metrics', metrics_file]
+        benchmarks.append(run_program('kronaextract_%d' % nb_lines, command, metrics_file, env, args.repeat))
+
+    results = {'label': args.label,
+               'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+               'machine': {'platform': platform.platform(), 'processor': platform.processor(),
+                           'python': sys.version.split()[0]},
+               'git': git_describe(),
+               'data': params,
+               'golden_latency': args.latency,
+               'benchmarks': benchmarks,
+               }
+    outfh = open(args.outfile, 'w')
+    json.dump(results, outfh, indent=2, sort_keys=True)
+    outfh.write('\n')
+    outfh.close()
+
+
+def git_describe():
+    try:
+        return subprocess.check_output(['git', 'describe', '--always', '--dirty'], cwd=BENCH_DIR, stderr=open(os.devnull, 'w')).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+##############################################################################
+#
+#            Comparison
+#
+##############################################################################
+
+
+def compare(args):
+    results = []
+    for path in [args.old, args.new]:
+        fh = open(path)
+        results.append(dict((bench['benchmark'], bench) for bench in json.load(fh)['benchmarks']))
+        fh.close()
+    old, new = results
+    print "%-40s %12s %12s %8s" % ('benchmark / stage', 'old (s)', 'new (s)', 'new/old')
+    for name in sorted(set(old) & set(new)):
+        rows = [(name, old[name]['wall_time'], new[name]['wall_time'])]
+        old_stages = old[name]['metrics'].get('stages', {})
+        new_stages = new[name]['metrics'].get('stages', {})
+        for stage in sorted(set(old_stages) & set(new_stages)):
+            rows.append(('  ' + stage, old_stages[stage]['wall_time'], new_stages[stage]['wall_time']))
+        rows.append(('  peak RSS (MB)', old[name]['metrics']['peak_rss_kb'] / 1024.0, new[name]['metrics']['peak_rss_kb'] / 1024.0))
+        for label, old_value, new_value in rows:
+            ratio = ''
+            if old_value:
+                ratio = '%.2f' % (new_value / old_value)
+            print "%-40s %12.3f %12.3f %8s" % (label, old_value, new_value, ratio)
+
+
+##############################################################################
+#
+#            MAIN
+#
+##############################################################################
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='taxobench.py',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+                                     description="taxo_pack benchmark with synthetic data and a local Golden stand-in.")
+    subparsers = parser.add_subparsers()
+
+    generate_parser = subparsers.add_parser('generate', formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+                                            help="Generate the synthetic data set.")
+    generate_parser.add_argument("-o", "--outdir", dest="outdir", metavar="Dir", required=True,
+                                 help="Data set directory.")
+    generate_parser.add_argument("-n", "--lines", dest="lines", metavar="int", type=int, nargs='+', default=[10000],
+                                 help="Number of lines of the m8 files (one file by number).")
+    generate_parser.add_argument("-a", "--accessions", dest="accessions", metavar="int", type=int, default=100000,
+                                 help="Number of subject accessions.")
+    generate_parser.add_argument("-g", "--organisms", dest="organisms", metavar="int", type=int, default=5000,
+                                 help="Number of organisms.")
+    generate_parser.add_argument("-z", "--skew", dest="skew", metavar="float", type=float, default=1.1,
+                                 help="Zipf exponent of the accession reuse in the m8 files.")
+    generate_parser.add_argument("-s", "--seed", dest="seed", metavar="int", type=int, default=1,
+                                 help="Random seed.")
+    generate_parser.set_defaults(func=generate)
+
+    run_parser = subparsers.add_parser('run', formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+                                       help="Run the benchmarks on a generated data set.")
+    run_parser.add_argument("-d", "--datadir", dest="datadir", metavar="Dir", required=True,
+                            help="Data set directory (taxobench.py generate).")
+    run_parser.add_argument("-o", "--out", dest="outfile", metavar="File", required=True,
+                            help="JSON results file.")
+    run_parser.add_argument("-l", "--label", dest="label", metavar="str", default='',
+                            help="Label of the results (release, branch, ...).")
+    run_parser.add_argument("-n", "--lines", dest="lines", metavar="int", type=int, nargs='*', default=[],
+                            help="Only run these m8 files sizes.")
+    run_parser.add_argument("-r", "--repeat", dest="repeat", metavar="int", type=int, default=1,
+                            help="Runs by benchmark, the fastest one is kept.")
+    run_parser.add_argument("-L", "--latency", dest="latency", metavar="float", type=float, default=0.0,
+                            help="Simulated Golden latency, seconds by card.")
+    run_parser.add_argument("--taxoptimizer_args", dest="taxoptimizer_args", metavar="str", default='',
+                            help="Additional taxoptimizer ncbi options, e.g. '-w 4 -q 8'.")
+    run_parser.add_argument("--rankoptimizer_args", dest="rankoptimizer_args", metavar="str", default='',
+                            help="Additional rankoptimizer options.")
+    run_parser.set_defaults(func=run)
+
+    compare_parser = subparsers.add_parser('compare', help="Compare two results files.")
+    compare_parser.add_argument("old", metavar="File", help="Reference results.")
+    compare_parser.add_argument("new", metavar="File", help="New results.")
+    compare_parser.set_defaults(func=compare)
+
+    args = parser.parse_args()
+    try:
+        args.func(args)
+    except TaxoBenchError, err:
+        print >>sys.stderr, err
+        sys.exit(1)
@@ -10,8 +10,33 @@
 # version 2.1
 
 import xml.etree.ElementTree as ET
+try:
+    import xml.etree.cElementTree as cET
+except ImportError:
+    cET = ET
+import os
+import re
 import sys
+import mmap
+import heapq
+import struct
+import tempfile
 import argparse
+import collections
+import xml.parsers.expat
+
+import taxoio
+from taxometrics import metrics
+
+
+class KronaExtractError:
+    def __init__(self, err):
+        self.err = err
+
+    def __repr__(self):
+        return "[KronaExtractError] " + self.err
+
+    __str__ = __repr__
 
 
 def extract_reads_from_all_children(nodes, list_of_reads):
@@ -28,6 +53,580 @@ def extract_reads_from_all_children(nodes, list_of_reads):
     return list_of_reads
 
 
+def stream_reads(xmlfh, taxonames, found, rank=None):
+    """
+    Yield (names, read) for the read_members values of the nodes named in
+    taxonames (or of the given rank) and of their descendants, names being
+    the list of the matching nodes the read is under (only valid until the
+    next read). The reads come in the file order (the reads of a node come
+    after those of its childs). The file is parsed as a stream, each element
+    is dropped at its end: the memory doesn't depend on the file size.
+    found[name] counts the matching nodes by name.
+    """
+    path = []      # open elements
+    names = []     # open nodes names
+    matching = []  # open nodes: matching or not
+    matched = []   # names of the open matching nodes
+    for event, elem in cET.iterparse(xmlfh, events=('start', 'end')):
+        if event == 'start':
+            if elem.tag == 'node':
+                name = elem.get('name')
+                names.append(name)
+                match = name in taxonames
+                matching.append(match)
+                if match:
+                    matched.append(name)
+                    found[name] = found.get(name, 0) + 1
+            path.append(elem)
+            continue
+        path.pop()
+        if elem.tag == 'val':
+            if len(path) < 2:
+                pass
+            elif matched and path[-1].tag == 'vals' and path[-2].tag == 'read_members':
+                yield matched, elem.text
+            elif rank is not None and path[-1].tag == 'rank' and path[-2].tag == 'node' and elem.text == rank and not matching[-1]:
+                # <rank> comes before the childs and the read members of its node
+                matching[-1] = True
+                matched.append(names[-1])
+                found[names[-1]] = found.get(names[-1], 0) + 1
+        elif elem.tag == 'node':
+            names.pop()
+            if matching.pop():
+                matched.pop()
+        if path:
+            # elem is the last child of its parent
+            del path[-1][-1]
+
+
+class BatchWriter(object):
+
+    BUFFER_LINES = 65536
+
+    def __init__(self, prefix=None, outfh=None, max_open=64):
+        """
+        Route the reads of several taxa to their own prefix.<name>.seq and
+        prefix.<name>.offset files, and/or to outfh as 'name\tread' lines.
+        The lines are buffered and at most max_open taxa have their files
+        open at once (the least recently written are closed, and reopened
+        in append mode if needed).
+        """
+        self.prefix = prefix
+        self.outfh = outfh
+        self.max_open = max(1, max_open)
+        self.file_names = {}  # taxon name --> file names prefix
+        self.buffers = {}     # taxon name --> read infos
+        self.opened = collections.OrderedDict()  # taxon name --> (seq fh, offset fh)
+        self.created = set()
+        self.nb_lines = 0
+
+    def file_name(self, name):
+        file_name = self.file_names.get(name)
+        if file_name is None:
+            base = '%s.%s' % (self.prefix, re.sub(r'[^A-Za-z0-9_.-]+', '_', name or '') or '_')
+            file_name = base
+            nb = 1
+            while file_name in self.created:
+                nb += 1
+                file_name = '%s_%d' % (base, nb)
+            self.created.add(file_name)
+            self.file_names[name] = file_name
+        return file_name
+
+    def _handles(self, name):
+        handles = self.opened.pop(name, None)
+        if handles is None:
+            if len(self.opened) >= self.max_open:
+                for fh in self.opened.popitem(last=False)[1]:
+                    fh.close()
+            mode = 'a' if name in self.file_names else 'w'
+            file_name = self.file_name(name)
+            handles = (open(file_name + '.seq', mode), open(file_name + '.offset', mode))
+        self.opened[name] = handles
+        return handles
+
+    def write(self, names, read_info):
+        if self.outfh:
+            for name in names:
+                print >>self.outfh, '%s\t%s' % (name, read_info)
+        if self.prefix:
+            for name in names:
+                buf = self.buffers.get(name)
+                if buf is None:
+                    buf = self.buffers[name] = []
+                buf.append(read_info)
+            self.nb_lines += len(names)
+            if self.nb_lines >= self.BUFFER_LINES:
+                self.flush()
+
+    def flush(self):
+        for name, buf in self.buffers.items():
+            outfh_name, outfh_offset = self._handles(name)
+            flds = [read_info.split('\t') for read_info in buf]
+            outfh_name.write(''.join([fld[0] + '\n' for fld in flds]))
+            outfh_offset.write(''.join([fld[1] + '\n' for fld in flds]))
+        self.buffers = {}
+        self.nb_lines = 0
+
+    def close(self):
+        self.flush()
+        for handles in self.opened.values():
+            for fh in handles:
+                fh.close()
+        self.opened.clear()
+
+
+def read_offsets(offsets_file):
+    """
+    The offsets of offsets_file ('-': stdin), the last tab separated field
+    of its lines, in the file order.
+    """
+    if offsets_file == '-':
+        offsetsfh = sys.stdin
+    else:
+        offsetsfh = open(offsets_file)
+    offsets = [int(line.rsplit('\t', 1)[-1]) for line in offsetsfh if line.strip()]
+    if offsetsfh is not sys.stdin:
+        offsetsfh.close()
+    return offsets
+
+
+##############################################################################
+#
+#            Sidecar index: taxon -> read_members byte ranges
+#
+##############################################################################
+
+INDEX_MAGIC = '#kronaextract_index'
+INDEX_VERSION = 1
+
+
+def index_path(krona_xml_file):
+    return krona_xml_file + '.idx'
+
+
+def _file_stamp(path):
+    st = os.stat(path)
+    return '%d\t%d' % (st.st_size, int(st.st_mtime))
+
+
+def build_index(krona_xml_file, idx_file=None):
+    """
+    Write the sidecar index of a plain Krona xml file: one line by node in
+    the file order, 'start\tlength\tend\tname\tpath', with the byte range of
+    the node's read_members element (0 0 if none) and end the line number
+    (exclusive) of its last descendant. The path is the ';' separated names
+    from the root. The header records the xml size and mtime.
+    """
+    if taxoio.compression(krona_xml_file) is not None:
+        raise KronaExtractError("%s: can't index a compressed xml file" % krona_xml_file)
+    nodes = []     # [start, length, end, name, path]
+    opened = []    # indexes in nodes of the open nodes
+    path = []      # open elements
+    parser = xml.parsers.expat.ParserCreate()
+    parser.buffer_text = True
+
+    def start_element(tag, attrs):
+        if tag == 'node':
+            name = attrs.get('name', '')
+            if opened:
+                node_path = nodes[opened[-1]][4] + ';' + name
+            else:
+                node_path = name
+            opened.append(len(nodes))
+            nodes.append([0, 0, 0, name, node_path])
+        elif tag == 'read_members' and path and path[-1] == 'node':
+            nodes[opened[-1]][0] = parser.CurrentByteIndex
+        path.append(tag)
+
+    def end_element(tag):
+        path.pop()
+        if tag == 'node':
+            nodes[opened.pop()][2] = len(nodes)
+        elif tag == 'read_members' and path and path[-1] == 'node':
+            node = nodes[opened[-1]]
+            node[1] = parser.CurrentByteIndex + len('</read_members>') - node[0]
+
+    parser.StartElementHandler = start_element
+    parser.EndElementHandler = end_element
+    xmlfh = open(krona_xml_file, 'rb')
+    try:
+        parser.ParseFile(xmlfh)
+    except xml.parsers.expat.ExpatError, err:
+        raise KronaExtractError("%s: %s" % (krona_xml_file, err))
+    finally:
+        xmlfh.close()
+
+    idx_file = idx_file or index_path(krona_xml_file)
+    idxfh = open(idx_file, 'w')
+    print >>idxfh, '%s\t%d\t%s' % (INDEX_MAGIC, INDEX_VERSION, _file_stamp(krona_xml_file))
+    for start, length, end, name, node_path in nodes:
+        print >>idxfh, '%d\t%d\t%d\t%s\t%s' % (start, length, end, name.encode('utf-8'), node_path.encode('utf-8'))
+    idxfh.close()
+    return len(nodes)
+
+
+class KronaIndex(object):
+
+    def __init__(self, krona_xml_file, idx_file=None):
+        """
+        The sidecar index of krona_xml_file (see build_index). Raise
+        KronaExtractError if it is missing or older than the xml file.
+        """
+        self.krona_xml_file = krona_xml_file
+        idx_file = idx_file or index_path(krona_xml_file)
+        try:
+            idxfh = open(idx_file)
+        except IOError, err:
+            raise KronaExtractError("%s: no index (%s)" % (krona_xml_file, err.strerror))
+        header = idxfh.readline().rstrip('\n').split('\t', 2)
+        if len(header) != 3 or header[0] != INDEX_MAGIC or header[1] != str(INDEX_VERSION):
+            idxfh.close()
+            raise KronaExtractError("%s: not a kronaextract index" % idx_file)
+        if header[2] != _file_stamp(krona_xml_file):
+            idxfh.close()
+            raise KronaExtractError("%s: out of date index, rebuild it with --build_index" % idx_file)
+        self.starts = []
+        self.lengths = []
+        self.ends = []
+        self.by_name = {}
+        for nb, line in enumerate(idxfh):
+            start, length, end, name, node_path = line.rstrip('\n').split('\t')
+            self.starts.append(int(start))
+            self.lengths.append(int(length))
+            self.ends.append(int(end))
+            self.by_name.setdefault(name, []).append(nb)
+            if node_path != name:
+                self.by_name.setdefault(node_path, []).append(nb)
+        idxfh.close()
+
+    def lookup(self, taxoname):
+        """
+        Line numbers of the nodes named taxoname (or of path taxoname).
+        """
+        return self.by_name.get(taxoname, [])
+
+    def ranges(self, nodes):
+        """
+        Byte ranges (start, length) of the read_members of the nodes and of
+        their descendants, in the file order, once each.
+        """
+        ranges = []
+        last = 0
+        for nb in sorted(nodes):
+            for desc in xrange(max(nb, last), self.ends[nb]):
+                if self.lengths[desc]:
+                    ranges.append((self.starts[desc], self.lengths[desc]))
+            last = max(last, self.ends[nb])
+        return ranges
+
+    def reads(self, nodes):
+        """
+        Yield the read_members values of the nodes and of their descendants
+        (a node's reads before its childs'), with a seek and a read by node.
+        """
+        xmlfh = open(self.krona_xml_file, 'rb')
+        try:
+            for start, length in self.ranges(nodes):
+                xmlfh.seek(start)
+                read_m = cET.fromstring(xmlfh.read(length))
+                for vals in read_m.findall('vals'):
+                    for val in vals.findall('val'):
+                        yield val.text
+        finally:
+            xmlfh.close()
+
+
+##############################################################################
+#
+#            FASTA/FASTQ reads: index and extraction
+#
+#  <reads>.idx, sorted by name, memory mapped and binary searched:
+#  header  : magic, key width, version, nb records, reads file size and mtime
+#  records : name (key width bytes, '\0' padded) + offset + length of the record
+##############################################################################
+
+READS_INDEX_MAGIC = 'KXREADS1'
+READS_INDEX_HEADER = struct.Struct('<8sIIQQQ')  # magic, key width, version, nb records, reads size, reads mtime
+READS_INDEX_SPAN = struct.Struct('<QQ')  # offset, length
+
+
+def iter_records(readsfh):
+    """
+    Yield (name, offset, length) for the FASTA or FASTQ records of readsfh,
+    offset the start of the record (the virtual offset for a BGZF file) and
+    length its length in the decompressed content. Multi-line records are
+    supported, FASTQ qualities may start with '@'.
+    """
+    use_tell = getattr(readsfh, 'compression', None) == 'bgzf'
+    upos = 0
+    offset = 0
+    if use_tell:
+        offset = readsfh.tell()
+    line = readsfh.readline()
+    while line and not line.strip():
+        # leading blank lines: the format is given by the first record
+        upos += len(line)
+        if use_tell:
+            offset = readsfh.tell()
+        else:
+            offset = upos
+        line = readsfh.readline()
+    if line and line[0] == '>':
+        # FASTA: a record ends at the next header
+        name = None
+        line_offset = offset
+        while line:
+            if line[0] == '>':
+                if name is not None:
+                    yield name, offset, upos - start
+                name = line[1:].split(None, 1)[0] if line[1:].strip() else ''
+                start = upos
+                offset = line_offset
+            upos += len(line)
+            if use_tell:
+                line_offset = readsfh.tell()
+            else:
+                line_offset = upos
+            line = readsfh.readline()
+        if name is not None:
+            yield name, offset, upos - start
+        return
+    while line:
+        if line[0] != '@':
+            if not line.strip():
+                upos += len(line)
+                if use_tell:
+                    offset = readsfh.tell()
+                else:
+                    offset = upos
+                line = readsfh.readline()
+                continue
+            raise KronaExtractError("not a FASTA or FASTQ file (line: %s)" % line[:50].rstrip())
+        name = line[1:].split(None, 1)[0] if line[1:].strip() else ''
+        length = len(line)
+        seq_len = 0
+        line = readsfh.readline()
+        while line and line[0] != '+':
+            seq_len += len(line.rstrip('\r\n'))
+            length += len(line)
+            line = readsfh.readline()
+        if not line:
+            raise KronaExtractError("truncated FASTQ record: %s" % name)
+        length += len(line)
+        qual_len = 0
+        while qual_len < seq_len:
+            line = readsfh.readline()
+            if not line:
+                raise KronaExtractError("truncated FASTQ record: %s" % name)
+            qual_len += len(line.rstrip('\r\n'))
+            length += len(line)
+        yield name, offset, length
+        upos += length
+        if use_tell:
+            offset = readsfh.tell()
+        else:
+            offset = upos
+        line = readsfh.readline()
+
+
+def _write_run(records, tmpdir):
+    records.sort()
+    fd, path = tempfile.mkstemp(prefix='kronaextract_reads_', dir=tmpdir)
+    fh = os.fdopen(fd, 'w')
+    for name, offset, length in records:
+        fh.write('%s\t%d\t%d\n' % (name, offset, length))
+    fh.close()
+    return path
+
+
+def _read_run(path):
+    fh = open(path)
+    for line in fh:
+        name, offset, length = line[:-1].split('\t')
+        yield name, int(offset), int(length)
+    fh.close()
+
+
+def build_reads_index(reads_file, idx_file=None, tmpdir=None, chunk_size=2000000):
+    """
+    Write the index of a FASTA/FASTQ file (plain, BGZF or compressed): its
+    records sorted by name (external sort of runs of chunk_size records),
+    offsets as in taxoio.lines_at. A name listed several times keeps its
+    first record.
+    """
+    idx_file = idx_file or index_path(reads_file)
+    st = os.stat(reads_file)
+    runs = []
+    records = []
+    key_width = 1
+    readsfh = taxoio.open_input(reads_file, seekable=None)
+    try:
+        try:
+            for record in iter_records(readsfh):
+                records.append(record)
+                if len(record[0]) > key_width:
+                    key_width = len(record[0])
+                if len(records) >= chunk_size:
+                    runs.append(_write_run(records, tmpdir))
+                    records = []
+        except KronaExtractError, err:
+            raise KronaExtractError("%s: %s" % (reads_file, err.err))
+        readsfh.close()
+        if records:
+            runs.append(_write_run(records, tmpdir))
+            records = []
+
+        out = open(idx_file, 'wb')
+        out.write(READS_INDEX_HEADER.pack(READS_INDEX_MAGIC, key_width, INDEX_VERSION, 0, st.st_size, int(st.st_mtime)))
+        nb_records = 0
+        last = None
+        for name, offset, length in heapq.merge(*[_read_run(path) for path in runs]):
+            if name == last:
+                continue
+            last = name
+            out.write(name.ljust(key_width, '\0'))
+            out.write(READS_INDEX_SPAN.pack(offset, length))
+            nb_records += 1
+        out.seek(0)
+        out.write(READS_INDEX_HEADER.pack(READS_INDEX_MAGIC, key_width, INDEX_VERSION, nb_records, st.st_size, int(st.st_mtime)))
+        out.close()
+    finally:
+        for path in runs:
+            os.remove(path)
+    return nb_records
+
+
+class ReadsIndex(object):
+
+    def __init__(self, reads_file, idx_file=None):
+        """
+        Memory mapped view of the index of reads_file (see build_reads_index).
+        Raise KronaExtractError if it is missing or older than reads_file.
+        """
+        idx_file = idx_file or index_path(reads_file)
+        try:
+            self.fh = open(idx_file, 'rb')
+        except IOError, err:
+            raise KronaExtractError("%s: no index (%s)" % (reads_file, err.strerror))
+        try:
+            self.mm = mmap.mmap(self.fh.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, mmap.error), err:
+            self.fh.close()
+            raise KronaExtractError("%s: %s" % (idx_file, err))
+        if len(self.mm) < READS_INDEX_HEADER.size or self.mm[:8] != READS_INDEX_MAGIC:
+            self.close()
+            raise KronaExtractError("%s: not a reads index" % idx_file)
+        magic, self.key_width, version, self.nb_records, size, mtime = READS_INDEX_HEADER.unpack_from(self.mm, 0)
+        st = os.stat(reads_file)
+        if version != INDEX_VERSION or (size, mtime) != (st.st_size, int(st.st_mtime)):
+            self.close()
+            raise KronaExtractError("%s: out of date index" % idx_file)
+        self.record_size = self.key_width + READS_INDEX_SPAN.size
+
+    def spans(self, ids):
+        """
+        query id --> (offset, length) of its record, for the indexed ids.
+        The ids are looked up in order, each search galloping from the
+        previous one: close ids cost a few probes.
+        """
+        spans = {}
+        mm = self.mm
+        header = READS_INDEX_HEADER.size
+        key_width = self.key_width
+        record_size = self.record_size
+        lo = 0
+        for query in sorted(set(ids)):
+            if len(query) > key_width:
+                continue
+            key = query.ljust(key_width, '\0')
+            step = 1
+            hi = lo + 1
+            while hi < self.nb_records and mm[header + hi * record_size:header + hi * record_size + key_width] < key:
+                lo = hi + 1
+                step *= 2
+                hi = lo + step
+            hi = min(hi, self.nb_records)
+            while lo < hi:
+                mid = (lo + hi) // 2
+                pos = header + mid * record_size
+                if mm[pos:pos + key_width] < key:
+                    lo = mid + 1
+                else:
+                    hi = mid
+            if lo < self.nb_records:
+                pos = header + lo * record_size
+                if mm[pos:pos + key_width] == key:
+                    spans[query] = READS_INDEX_SPAN.unpack_from(mm, pos + key_width)
+        return spans
+
+    def close(self):
+        self.mm.close()
+        self.fh.close()
+
+
+def reads_spans(reads_file, ids, idx_file=None):
+    """
+    query id --> (offset, length) of its record, for the ids found in the
+    index of reads_file, built if missing or out of date.
+    """
+    try:
+        index = ReadsIndex(reads_file, idx_file)
+    except KronaExtractError:
+        start = metrics.start()
+        metrics.count('reads_indexed', build_reads_index(reads_file, idx_file))
+        metrics.stop('reads_index', start)
+        index = ReadsIndex(reads_file, idx_file)
+    spans = index.spans(ids)
+    index.close()
+    return spans
+
+
+def coalesce(spans):
+    """
+    Merge the contiguous (offset, length) spans (records following each
+    other in the file, in the same BGZF block for virtual offsets):
+    [(offset, length, [length, ...])] sorted by offset.
+    """
+    runs = []
+    for offset, length in sorted(set(spans)):
+        if runs and runs[-1][0] + runs[-1][1] == offset:
+            runs[-1][1] += length
+            runs[-1][2].append(length)
+        else:
+            runs.append([offset, length, [length]])
+    return runs
+
+
+def iter_spans(reads_file, spans):
+    """
+    Yield (offset, data) for the sorted, distinct spans of reads_file, read
+    by runs of contiguous records.
+    """
+    runs = coalesce(spans)
+    records = dict((run[0], run[2]) for run in runs)
+    for offset, data in taxoio.spans_at(reads_file, [(run[0], run[1]) for run in runs]):
+        pos = 0
+        for length in records[offset]:
+            yield offset + pos, data[pos:pos + length]
+            pos += length
+
+
+def read_ids(ids_file):
+    """
+    The query ids of ids_file ('-': stdin), the first tab separated field
+    of its lines (.seq file of -s, or -o output), in the file order.
+    """
+    if ids_file == '-':
+        idsfh = sys.stdin
+    else:
+        idsfh = open(ids_file)
+    ids = [line.split('\t', 1)[0].strip() for line in idsfh if line.strip()]
+    if idsfh is not sys.stdin:
+        idsfh.close()
+    return ids
+
+
 if __name__ == '__main__':
 
     usage = "kronaextract [options] -i <FILE>  -n <STRING>"
@@ -41,11 +640,22 @@ The output file could be split into two files: the 'prefix.seq' file contains re
     general_options.add_argument("-i", "--in",
                                  dest="krona_xml_file",
                                  help="Xml input file with Krona 2.1 Specification. A rankoptimizer ouptut file is recommended)",
-                                 metavar="file",
-                                 required=True)
+                                 metavar="file")
     general_options.add_argument("-n", "--taxo_name",
                                  dest="taxoname", metavar="STRING",
                                  help="Taxonomic name.")
+    general_options.add_argument("-N", "--taxo_names",
+                                 dest="taxonames_file", metavar="file",
+                                 help="""Batch mode: file of taxonomic names, one by line. The reads of each taxon are written in
+                                 prefix.<name>.seq and prefix.<name>.offset (-s) and/or as 'name<tab>read' lines (-o), in one pass.""")
+    general_options.add_argument("-r", "--rank",
+                                 dest="rank", metavar="STRING",
+                                 help="Batch mode (see -N) on all the nodes of the given rank (genus, family...).")
+    general_options.add_argument("--max_open",
+                                 dest="max_open", metavar="int",
+                                 help="Batch mode: maximum number of taxa with their output files open at once.",
+                                 type=int,
+                                 default=64)
     general_options.add_argument("-o", "--out", dest="outfile",
                                  help="Output file.",
                                  type=argparse.FileType('w'),
@@ -53,21 +663,227 @@ The output file could be split into two files: the 'prefix.seq' file contains re
     general_options.add_argument("-s", "--split_prefix",
                                  dest="prefix", metavar="str",
                                  help="Split output file into two files with the given prefix name")
+    general_options.add_argument("--stream",
+                                 dest="stream",
+                                 help="""Parse the xml as a stream: constant memory whatever the file size (plain or compressed), reads written
+                                 as they are found, in the file order (the reads of a node after those of its childs).""",
+                                 action='store_true',
+                                 default=False)
+    general_options.add_argument("--build_index",
+                                 dest="build_index",
+                                 help="""Write the sidecar index of the (plain) xml file, <in>.idx: taxon names and paths to their
+                                 read members byte ranges. The following extractions use it if it is up to date.""",
+                                 action='store_true',
+                                 default=False)
+    general_options.add_argument("--taxo_file",
+                                 dest="taxo_file", metavar="file",
+                                 help="""Retrieval mode: write (-o, default stdout) the full lines of this taxoptimizer file (plain,
+                                 BGZF or compressed, as given to rankoptimizer) at the offsets of --offsets.""")
+    general_options.add_argument("--offsets",
+                                 dest="offsets_file", metavar="file",
+                                 help="""Retrieval mode: offsets file, one offset by line, as the last tab separated field (.offset
+                                 file of -s, or -o output). '-' for the standard input.""")
+    general_options.add_argument("--request_order",
+                                 dest="request_order",
+                                 help="Retrieval and reads modes: write in the order of the offsets/ids file instead of the file order.",
+                                 action='store_true',
+                                 default=False)
+    general_options.add_argument("--reads",
+                                 dest="reads_file", metavar="file",
+                                 help="""Reads mode: write (-o, default stdout) the FASTA/FASTQ records (plain, BGZF or compressed file)
+                                 of the query ids of --ids. The file is indexed (<reads>.idx) on first use.""")
+    general_options.add_argument("--ids",
+                                 dest="ids_file", metavar="file",
+                                 help="""Reads mode: query ids file, one id by line, as the first tab separated field (.seq file of
+                                 -s, or -o output). '-' for the standard input.""")
+    general_options.add_argument("--metrics",
+                                 dest="metrics",
+                                 metavar="file",
+                                 help="Write a JSON report of the run: time by stage, counters, peak memory.",
+                                 default=None)
 
     args = parser.parse_args()
+    if args.metrics:
+        metrics.enable(args.metrics, 0)
 
     bl_line = 0
 
+    # ===== Retrieval mode: taxoptimizer lines at the extracted offsets
+    if args.taxo_file or args.offsets_file:
+        if not (args.taxo_file and args.offsets_file):
+            parser.error('the retrieval mode needs --taxo_file and --offsets')
+        outfh = args.outfile or sys.stdout
+        start = metrics.start()
+        try:
+            offsets = read_offsets(args.offsets_file)
+            metrics.count('offsets', len(offsets))
+            if args.request_order:
+                lines = dict(taxoio.lines_at(args.taxo_file, offsets))
+                for offset in offsets:
+                    outfh.write(lines[offset])
+                metrics.count('lines_retrieved', len(lines))
+            else:
+                nb_lines = 0
+                for offset, line in taxoio.lines_at(args.taxo_file, offsets):
+                    outfh.write(line)
+                    nb_lines += 1
+                metrics.count('lines_retrieved', nb_lines)
+        except (IOError, ValueError, taxoio.TaxoIOError), err:
+            print >>sys.stderr, err
+            sys.exit(1)
+        metrics.stop('retrieve', start)
+        sys.exit()
+    # ===== Reads mode: FASTA/FASTQ records of the extracted query ids
+    if args.reads_file or args.ids_file:
+        if not (args.reads_file and args.ids_file):
+            parser.error('the reads mode needs --reads and --ids')
+        outfh = args.outfile or sys.stdout
+        try:
+            ids = read_ids(args.ids_file)
+            spans = reads_spans(args.reads_file, set(ids))
+            start = metrics.start()
+            metrics.count('ids', len(ids))
+            metrics.count('reads_found', len(spans))
+            if args.request_order:
+                records = dict(iter_spans(args.reads_file, spans.values()))
+                for query in ids:
+                    if query in spans:
+                        outfh.write(records[spans[query][0]])
+            else:
+                for offset, record in iter_spans(args.reads_file, spans.values()):
+                    outfh.write(record)
+            metrics.stop('reads', start)
+        except (IOError, ValueError, KronaExtractError, taxoio.TaxoIOError), err:
+            print >>sys.stderr, err
+            sys.exit(1)
+        missing = len(set(ids)) - len(spans)
+        if missing:
+            print >>sys.stderr, '%d query ids not found in %s' % (missing, args.reads_file)
+        sys.exit()
+    if not args.krona_xml_file:
+        parser.error('argument -i/--in is required')
+
+    if args.build_index:
+        start = metrics.start()
+        try:
+            metrics.count('nodes_indexed', build_index(args.krona_xml_file))
+        except (IOError, KronaExtractError), err:
+            print >>sys.stderr, err
+            sys.exit(1)
+        metrics.stop('index', start)
+        if not args.taxoname:
+            sys.exit()
+
+    if args.stream:
+        start = metrics.start()
+        if args.prefix:
+            outfh_name = open(args.prefix + '.seq', 'w')
+            outfh_offset = open(args.prefix + '.offset', 'w')
+        found = {}
+        nb_reads = 0
+        try:
+            xmlfh = taxoio.open_input(args.krona_xml_file)
+            for names, read_info in stream_reads(xmlfh, set([args.taxoname]), found):
+                nb_reads += 1
+                if args.outfile:
+                    print >>args.outfile, read_info
+                if args.prefix:
+                    fld = read_info.split('\t')
+                    print >>outfh_name, fld[0]
+                    print >>outfh_offset, fld[1]
+        except (IOError, SyntaxError, taxoio.TaxoIOError), err:
+            print >>sys.stderr, err
+            sys.exit(1)
+        metrics.stop('stream', start)
+        metrics.count('nodes_found', sum(found.values()))
+        metrics.count('reads_extracted', nb_reads)
+        if not found:
+            print >>sys.stderr, 'No result for: %s' % args.taxoname
+        sys.exit()
+
+    # ===== Batch mode: one pass for several taxa
+    if args.taxonames_file or args.rank:
+        if not (args.prefix or args.outfile):
+            print >>sys.stderr, 'Batch mode needs -s and/or -o'
+            sys.exit(1)
+        taxonames = set()
+        if args.taxonames_file:
+            try:
+                namesfh = open(args.taxonames_file)
+            except IOError, err:
+                print >>sys.stderr, err
+                sys.exit(1)
+            taxonames = set([line.strip() for line in namesfh if line.strip()])
+            namesfh.close()
+        if args.taxoname:
+            taxonames.add(args.taxoname)
+        start = metrics.start()
+        writer = BatchWriter(args.prefix, args.outfile, args.max_open)
+        found = {}
+        nb_reads = 0
+        try:
+            xmlfh = taxoio.open_input(args.krona_xml_file)
+            for names, read_info in stream_reads(xmlfh, taxonames, found, args.rank):
+                nb_reads += 1
+                writer.write(names, read_info)
+            writer.close()
+        except (IOError, SyntaxError, taxoio.TaxoIOError), err:
+            print >>sys.stderr, err
+            sys.exit(1)
+        metrics.stop('batch', start)
+        metrics.count('nodes_found', sum(found.values()))
+        metrics.count('taxa_found', len(found))
+        metrics.count('reads_extracted', nb_reads)
+        for name in sorted(taxonames.difference(found)):
+            print >>sys.stderr, 'No result for: %s' % name
+        if args.rank and not found:
+            print >>sys.stderr, 'No result for rank: %s' % args.rank
+        sys.exit()
+
+    # ===== Sidecar index
+    index = None
+    if os.path.exists(index_path(args.krona_xml_file)):
+        try:
+            index = KronaIndex(args.krona_xml_file)
+        except KronaExtractError, err:
+            print >>sys.stderr, "%s, parsing the whole file" % err
+    if index is not None:
+        start = metrics.start()
+        if args.prefix:
+            outfh_name = open(args.prefix + '.seq', 'w')
+            outfh_offset = open(args.prefix + '.offset', 'w')
+        nodes = index.lookup(args.taxoname)
+        metrics.count('nodes_found', len(nodes))
+        if not nodes:
+            print >>sys.stderr, 'No result for: %s' % args.taxoname
+            sys.exit()
+        nb_reads = 0
+        for read_info in index.reads(nodes):
+            nb_reads += 1
+            if args.outfile:
+                print >>args.outfile, read_info
+            if args.prefix:
+                fld = read_info.split('\t')
+                print >>outfh_name, fld[0]
+                print >>outfh_offset, fld[1]
+        metrics.stop('index_extract', start)
+        metrics.count('reads_extracted', nb_reads)
+        sys.exit()
+
     # ===== Tabulated file parsing
+    start = metrics.start()
     try:
         xmltree = ET.parse(args.krona_xml_file)
     except IOError, err:
         print >>sys.stderr, err
         sys.exit(0)
+    metrics.stop('parse', start)
 
+    start = metrics.start()
     root = xmltree.getroot()
 
     nodes = root.findall(".//node/[@name='%s']" % args.taxoname)
+    metrics.count('nodes_found', len(nodes))
     list_of_reads = []
     if not nodes:
         print >>sys.stderr, 'No result for: %s' % args.taxoname
@@ -86,7 +902,10 @@ The output file could be split into two files: the 'prefix.seq' file contains re
 #                print 'Un probleme  a regler: %s reads reel, %s reads theorique' % (len(list_of_reads), nb_reads)
 #        else:
 #            print 'tout est ok: %s reads' % len(list_of_reads)
+    metrics.stop('extract', start)
+    metrics.count('reads_extracted', len(list_of_reads))
 
+    start = metrics.start()
     if args.prefix:
         outfh_name = open(args.prefix + '.seq', 'w')
         outfh_offset = open(args.prefix + '.offset', 'w')
@@ -98,3 +917,4 @@ The output file could be split into two files: the 'prefix.seq' file contains re
             fld = read_info.text.split('\t')
             print >>outfh_name, fld[0]
             print >>outfh_offset, fld[1]
+    metrics.stop('write', start)
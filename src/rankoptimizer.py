@@ -10,10 +10,15 @@
 
 import os
 import sys
+import Queue
 import argparse
+import collections
+import multiprocessing
 
 
+import taxoio
 import rankoptimizerlib
+from taxometrics import metrics, hit_ratios
 
 
 class RankOptimizerError:
@@ -59,13 +64,19 @@ def clean_taxo(sbjct_taxonomy, clean_cellular):
     return sbjct_taxonomy
 
 
-def extract_tot_rank(taxonomy):
-    rank_list = ['superkingdom', 'kingdom', 'subkingdom', 'superphylum', 'phylum', 'subphylum', 'superclass', 'class', 'subclass',
-                 'infraclass', 'superorder', 'order', 'suborder', 'infraorder', 'parvorder', 'superfamily', 'family', 'subfamily', 'tribe',
-                 'subtribe', 'genus', 'subgenus', 'species_group', 'species_subgroup', 'species', 'subspecies', 'varietas', 'forma']
-    fld = taxonomy.split(';')
+RANKS = frozenset(['superkingdom', 'kingdom', 'subkingdom', 'superphylum', 'phylum', 'subphylum', 'superclass', 'class', 'subclass',
+                   'infraclass', 'superorder', 'order', 'suborder', 'infraorder', 'parvorder', 'superfamily', 'family', 'subfamily', 'tribe',
+                   'subtribe', 'genus', 'subgenus', 'species_group', 'species_subgroup', 'species', 'subspecies', 'varietas', 'forma'])
+
+# ## taxonomy string --> parsed lineage, least recently used first
+LINEAGE_CACHE_SIZE = 100000
+_lineages = collections.OrderedDict()
+_lineages_stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+
+def parse_lineage(taxonomy):
     all_nodes = []
-    for node in fld:
+    for node in taxonomy.split(';'):
         rank = ''
         fld_node = node.strip().split('(')
         name = fld_node[0].strip()
@@ -76,12 +87,31 @@ def extract_tot_rank(taxonomy):
             rank = fld_node[-1].split(')')[0].strip()
             name = fld_node[0] + fld_node[1].split(')')[0].strip()
             rank = rank.replace(' ', '_')
-        if rank and rank not in rank_list:
+        if rank and rank not in RANKS:
             name += '_' + rank
             rank = ''
         if name:
-            all_nodes.append((name, rank))
+            all_nodes.append((intern(name), intern(rank)))
+    return tuple(all_nodes)
+
 
+def extract_tot_rank(taxonomy):
+    """
+    extract_tot_rank(taxonomy) --> ((name, rank), ...)
+
+    Parsed lineage, cached by taxonomy string: the tuple is shared by all the
+    queries with this taxonomy.
+    """
+    try:
+        all_nodes = _lineages.pop(taxonomy)
+        _lineages_stats['hits'] += 1
+    except KeyError:
+        all_nodes = parse_lineage(taxonomy)
+        _lineages_stats['misses'] += 1
+        if len(_lineages) >= LINEAGE_CACHE_SIZE:
+            _lineages.popitem(last=False)
+            _lineages_stats['evictions'] += 1
+    _lineages[taxonomy] = all_nodes
     return all_nodes
 
 
@@ -103,12 +133,10 @@ def insert_taxo_tot(taxo_tree, query, pos_line, taxonomy, rank_in_tree, identica
     except:
         return taxo_tree
 
-    if not taxo_tree.has_child(name):
-        if rank_in_tree:
-            taxo_tree.add_child(name, rank)
-        else:
-            taxo_tree.add_child(name, '')
-    child = taxo_tree.get_child(name)
+    if rank_in_tree:
+        child = taxo_tree.get_or_add_child(name, rank)
+    else:
+        child = taxo_tree.get_or_add_child(name, '')
 
     # child.add_queries((query,  pos_line) )
 
@@ -124,12 +152,10 @@ def insert_taxo_tot(taxo_tree, query, pos_line, taxonomy, rank_in_tree, identica
     for name, rank in all_nodes[1:-1]:
         parent = child
         if name:
-            if not parent.has_child(name):
-                if rank_in_tree:
-                    parent.add_child(name, rank)
-                else:
-                    parent.add_child(name, '')
-            child = parent.get_child(name)
+            if rank_in_tree:
+                child = parent.get_or_add_child(name, rank)
+            else:
+                child = parent.get_or_add_child(name, '')
             # child.add_queries((query, pos_line))
             if identical_read and '_' in query:  # # supposed name_n
                 n = query.split('_')[-1]
@@ -147,12 +173,10 @@ def insert_taxo_tot(taxo_tree, query, pos_line, taxonomy, rank_in_tree, identica
     name, rank = all_nodes[-1]
     parent = child
     if name:
-        if not parent.has_child(name):
-            if rank_in_tree:
-                parent.add_child(name, rank)
-            else:
-                parent.add_child(name, '')
-        child = parent.get_child(name)
+        if rank_in_tree:
+            child = parent.get_or_add_child(name, rank)
+        else:
+            child = parent.get_or_add_child(name, '')
         child.add_queries((query, pos_line))
         if identical_read and '_' in query:  # # supposed name_n
             n = query.split('_')[-1]
@@ -186,12 +210,10 @@ def insert_taxo_tot_delta(taxo_tree, query, pos_line, taxonomy, rank_in_tree, id
     except:
         return taxo_tree
 
-    if not taxo_tree.has_child(name):
-        if rank_in_tree:
-            taxo_tree.add_child(name, rank)
-        else:
-            taxo_tree.add_child(name, '')
-    child = taxo_tree.get_child(name)
+    if rank_in_tree:
+        child = taxo_tree.get_or_add_child(name, rank)
+    else:
+        child = taxo_tree.get_or_add_child(name, '')
 
     # child.add_queries((query,  pos_line) )
     if identical_read and '_' in query:  # # supposed name_n
@@ -206,12 +228,10 @@ def insert_taxo_tot_delta(taxo_tree, query, pos_line, taxonomy, rank_in_tree, id
     for name, rank in all_nodes[1:-1]:
         parent = child
         if name:
-            if not parent.has_child(name):
-                if rank_in_tree:
-                    parent.add_child(name, rank)
-                else:
-                    parent.add_child(name, '')
-            child = parent.get_child(name)
+            if rank_in_tree:
+                child = parent.get_or_add_child(name, rank)
+            else:
+                child = parent.get_or_add_child(name, '')
             # child.add_queries((query,  pos_line))
             if identical_read and '_' in query:  # # supposed name_n
                 n = query.split('_')[-1]
@@ -229,12 +249,10 @@ def insert_taxo_tot_delta(taxo_tree, query, pos_line, taxonomy, rank_in_tree, id
     name, rank = all_nodes[-1]
     parent = child
     if name:
-        if not parent.has_child(name):
-            if rank_in_tree:
-                parent.add_child(name, rank)
-            else:
-                parent.add_child(name, '')
-        child = parent.get_child(name)
+        if rank_in_tree:
+            child = parent.get_or_add_child(name, rank)
+        else:
+            child = parent.get_or_add_child(name, '')
         child.add_queries((query, pos_line))
         if identical_read and '_' in query:  # # supposed name_n
             n = query.split('_')[-1]
@@ -270,6 +288,467 @@ def reduce_by_delta(one_query, query, delta_score):
     return one_query
 
 
+def parse_hsp(line, taxcolumn, scorecolumn, blast_line):
+    """
+    parse_hsp(line, ...) --> (query, hsp_score, has a taxonomy column)
+    """
+    fld = line.split('\t')
+    try:
+        query = fld[0]
+    except StandardError, err:
+        print >>sys.stderr, RankOptimizerError("query error:%s line:%s" % (err, blast_line))
+        sys.exit()
+
+    try:
+        if fld[scorecolumn] and fld[scorecolumn][0] == 'e':
+            num = '1' + fld[scorecolumn]
+        else:
+            num = fld[scorecolumn]
+        hsp_score = float(num)
+    except StandardError, err:
+        print >>sys.stderr, RankOptimizerError("score column number error:-C %s in line %s:%s" % (scorecolumn + 1, blast_line, err))
+        sys.exit()
+    try:
+        sbjct_taxonomy = fld[taxcolumn]
+        sbjct_taxonomy = True
+    except:
+        sbjct_taxonomy = False
+    return query, hsp_score, sbjct_taxonomy
+
+
+def add_hsp(query_infos, query, hsp_score, sbjct_taxonomy, pos_line, delta):
+    # {'hsp_score':hsp_score, 'sbjct_taxonomy':sbjct_taxonomy, 'pos_line':pos_line }
+    # ===> (hsp_score,  sbjct_taxonomy, pos_line)
+    # ##### Analyze and stock query
+    if query in query_infos:
+        if not query_infos[query]['max_score'][1] or (sbjct_taxonomy and hsp_score > query_infos[query]['max_score'][0]):
+            query_infos[query]['max_score'] = (hsp_score, sbjct_taxonomy, pos_line)
+        elif (delta and sbjct_taxonomy) and (hsp_score > (query_infos[query]['max_score'][0] * (1 - (delta * 0.01)))):
+            # stock all at one moment. reduce after.
+            if 'delta' in query_infos[query]:
+                query_infos[query]['delta'].append((hsp_score, sbjct_taxonomy, pos_line))
+            else:
+                query_infos[query]['delta'] = [(hsp_score, sbjct_taxonomy, pos_line)]
+        # else:
+        #    print ''
+    else:
+        query_infos[query] = {'max_score': (hsp_score, sbjct_taxonomy, pos_line)}
+
+
+def iter_lines(tabfh):
+    """
+    Yield (line number, pos_line, line) for the lines of tabfh, pos_line
+    computed from the line lengths (or the BGZF virtual offset).
+    """
+    pos_line = 0
+    blast_line = 0
+    try:
+        if getattr(tabfh, 'compression', None) == 'bgzf':
+            while True:
+                pos_line = tabfh.tell()
+                line = tabfh.readline()
+                if not line:
+                    break
+                blast_line += 1
+                yield blast_line, pos_line, line
+        else:
+            for line in tabfh:
+                blast_line += 1
+                yield blast_line, pos_line, line
+                pos_line += len(line)
+    except IOError, err:
+        print >>sys.stderr, RankOptimizerError("readline error:%s line:%s" % (err, blast_line))
+        sys.exit()
+
+
+def read_grouped(tab_lines, taxcolumn, scorecolumn, delta, order=None):
+    """
+    Yield (query, infos, lines) for each block of consecutive lines of a query,
+    lines: pos_line --> line of the block. Nothing is read twice.
+
+    tab_lines yields (line number, pos_line, line) (see iter_lines), a None
+    line ends the current block. order (query --> pos_line of its first
+    line) is filled if given.
+    """
+    query_infos = {}
+    lines = {}
+    current = None
+    blast_line = 0
+    for blast_line, pos_line, line in tab_lines:
+        if not blast_line & 0xffff:
+            metrics.progress('lines_read', blast_line)
+        if line is None:
+            # a line of another worker's query: ends the current block
+            if current is not None:
+                yield current, query_infos[current], lines
+                current = None
+        elif line != '\n':
+            query, hsp_score, sbjct_taxonomy = parse_hsp(line, taxcolumn, scorecolumn, blast_line)
+            if query != current:
+                if current is not None:
+                    yield current, query_infos[current], lines
+                current = query
+                query_infos = {}
+                lines = {}
+                if order is not None:
+                    order.setdefault(query, pos_line)
+            add_hsp(query_infos, query, hsp_score, sbjct_taxonomy, pos_line, delta)
+            lines[pos_line] = line
+    if current is not None:
+        yield current, query_infos[current], lines
+    metrics.progress('lines_read', blast_line)
+
+
+def line_taxonomy(line, taxcolumn, clean):
+    fld = line.split('\t')
+    sbjct_taxonomy = fld[taxcolumn].strip()  # ## taxonomy begin at the 13 column separated by \t
+    # ###### Clean taxonomy
+    if sbjct_taxonomy[-1] == '.':
+        sbjct_taxonomy = sbjct_taxonomy[:-1] + ';'
+    if clean:
+        sbjct_taxonomy = sbjct_taxonomy.replace('cellular organisms ;', '').strip()
+        sbjct_taxonomy = sbjct_taxonomy.replace('cellular organisms;', '').strip()
+    # if repairGB and sbjct_taxonomy:### slow
+    #    sbjct_taxonomy = clean_taxo(sbjct_taxonomy)
+    return sbjct_taxonomy
+
+
+def insert_query(taxo_tree, query, infos, read_line, taxcolumn, args):
+    """
+    Insert in the tree the best HSP of query (and its delta HSPs), read by
+    read_line(pos_line).
+    """
+    pos_line = infos['max_score'][2]
+    try:
+        line = read_line(pos_line)
+    except IOError, err:
+        print >>sys.stderr, RankOptimizerError("%s line:%s" % (err, pos_line))
+        sys.exit()
+    try:
+        sbjct_taxonomy = line_taxonomy(line, taxcolumn, args.clean)
+    except:
+        print >>sys.stderr, 'no taxo found for %s' % query
+        return taxo_tree
+
+    taxo_tree = insert_taxo_tot(taxo_tree, query, pos_line, sbjct_taxonomy, args.rank, args.identical)
+    metrics.count('hsps_inserted')
+
+    if 'delta' in infos:
+        all_delta_taxo = [sbjct_taxonomy]
+        for qd in infos['delta']:
+            pos_line = qd[2]
+            blast_line = read_line(pos_line)
+            try:
+                sbjct_taxonomy = line_taxonomy(blast_line, taxcolumn, args.clean)
+            except:
+                print >>sys.stderr, 'no taxo found for %s' % query
+                continue
+            if sbjct_taxonomy not in all_delta_taxo:
+                taxo_tree = insert_taxo_tot_delta(taxo_tree, query, pos_line, sbjct_taxonomy, args.rank, args.identical)
+                metrics.count('hsps_inserted')
+                all_delta_taxo.append(sbjct_taxonomy)
+    return taxo_tree
+
+
+def read_queries(tab_lines, taxcolumn, scorecolumn, delta, order=None):
+    """
+    First pass of the two pass mode: query --> infos (best HSP and delta HSPs
+    with their pos_line) of the queries of tab_lines (see iter_lines). order
+    (query --> pos_line of its first line) is filled if given.
+    """
+    query_infos = {}
+    blast_line = 0
+    for blast_line, pos_line, line in tab_lines:
+        if line is None or line == '\n':
+            continue
+        query, hsp_score, sbjct_taxonomy = parse_hsp(line, taxcolumn, scorecolumn, blast_line)
+        if order is not None and query not in query_infos:
+            order[query] = pos_line
+        add_hsp(query_infos, query, hsp_score, sbjct_taxonomy, pos_line, delta)
+        if not blast_line & 0xffff:
+            metrics.progress('lines_read', blast_line)
+    metrics.progress('lines_read', blast_line)
+    return query_infos
+
+
+def new_tree(args):
+    if args.compact_tree:
+        return rankoptimizerlib.CompactTree('root').root()
+    return rankoptimizerlib.Taxon('root')
+
+
+def build_tree(args, tabfh, taxo_tree, tab_lines=None, order=None):
+    """
+    Insert in taxo_tree the queries of tabfh, or of tab_lines (a part of
+    the lines of tabfh, see read_grouped) if given: tabfh is then only read
+    for the HSP lines of the two pass mode. The queries are inserted in the
+    order of their first line, kept in order (query --> pos_line of its
+    first line) if given.
+    """
+    taxcolumn = args.taxcolumn - 1
+    scorecolumn = args.scorecolumn - 1
+    if tab_lines is None:
+        tab_lines = iter_lines(tabfh)
+
+    if args.grouped:
+        # ## Single pass: one query block at a time
+        start = metrics.start()
+        nb_queries = 0
+        for query, infos, lines in read_grouped(tab_lines, taxcolumn, scorecolumn, args.delta, order):
+            if args.delta and 'delta' in infos and len(infos['delta']) > 1:
+                infos = reduce_by_delta(infos, query, args.delta)
+            taxo_tree = insert_query(taxo_tree, query, infos, lines.__getitem__, taxcolumn, args)
+            nb_queries += 1
+        metrics.stop('grouped', start)
+        metrics.count('queries', nb_queries)
+        return taxo_tree
+
+    if order is None:
+        order = {}
+    start = metrics.start()
+    query_infos = read_queries(tab_lines, taxcolumn, scorecolumn, args.delta, order)
+    metrics.stop('read', start)
+    metrics.count('queries', len(query_infos))
+
+    if args.delta:
+        start = metrics.start()
+        for query in query_infos.keys():
+            if 'delta' in query_infos[query] and len(query_infos[query]['delta']) > 1:
+                # avant= len(query_infos[query]['delta'])
+                query_infos[query] = reduce_by_delta(query_infos[query], query, args.delta)
+        metrics.stop('delta', start)
+
+    # ## Construct tree structure
+    def read_line(pos_line):
+        tabfh.seek(pos_line)
+        return tabfh.readline()
+
+    start = metrics.start()
+    for query in sorted(query_infos, key=order.get):
+        taxo_tree = insert_query(taxo_tree, query, query_infos.pop(query), read_line, taxcolumn, args)
+    metrics.stop('tree', start)
+    return taxo_tree
+
+
+##############################################################################
+#
+#            Worker processes: partial trees of the queries (-w) or trees of
+#            the datasets (several -i)
+#
+##############################################################################
+
+_worker = {}
+
+
+def _run_job(target, job, results):
+    """
+    Send (job, target(job)) to the parent, (job, {'exit': code}) on error.
+    """
+    metrics.reset()
+    metrics.label = ' job %d:' % job
+    try:
+        result = target(job)
+    except SystemExit, err:
+        results.put((job, {'exit': err.code}))
+        return
+    except BaseException, err:
+        print >>sys.stderr, RankOptimizerError("job %d: %s" % (job, err))
+        results.put((job, {'exit': 1}))
+        return
+    result['metrics'] = metrics.snapshot()
+    results.put((job, result))
+
+
+def run_jobs(target, nb_jobs, nb_processes, feed=None):
+    """
+    run_jobs(target, nb_jobs, nb_processes) --> {job: target(job)}
+
+    Run target(0), ... target(nb_jobs - 1) with at most nb_processes
+    processes at a time. The metrics of the jobs are merged. feed(processes)
+    is called once the first processes are started, to send them their
+    input.
+    """
+    results = multiprocessing.Queue()
+    processes = {}
+    parts = {}
+    next_job = 0
+    failed = False
+    exit_code = None
+    try:
+        while len(parts) < nb_jobs:
+            while next_job < nb_jobs and len(processes) < nb_processes:
+                process = multiprocessing.Process(target=_run_job, args=(target, next_job, results))
+                process.start()
+                processes[next_job] = process
+                next_job += 1
+            if feed is not None:
+                feed(processes)
+                feed = None
+            try:
+                job, part = results.get(True, 1)
+            except Queue.Empty:
+                if [process for process in processes.values() if process.exitcode]:
+                    print >>sys.stderr, RankOptimizerError("a worker process died")
+                    failed = True
+                    exit_code = 1
+                    break
+                continue
+            parts[job] = part
+            processes.pop(job).join()
+            if 'exit' in part:
+                failed = True
+                exit_code = part['exit']
+                break
+        if failed:
+            sys.exit(exit_code)
+    finally:
+        for process in processes.values():
+            if process.is_alive():
+                process.terminate()
+    return parts
+
+
+DISPATCH_LINES = 1000
+DISPATCH_DEPTH = 16
+
+
+def _worker_lines(queue):
+    # lines sent by _dispatch, until None
+    while True:
+        chunk = queue.get()
+        if chunk is None:
+            return
+        for item in chunk:
+            yield item
+
+
+def _worker_tree(worker):
+    """
+    Tree of the queries of the worker partition, and the offset of their
+    first line.
+    """
+    args = _worker['args']
+    tabfh = None
+    if not args.grouped:
+        # HSP lines of the two pass mode
+        tabfh = taxoio.open_input(_worker['tabfh'].name, seekable=None)
+    order = {}
+    taxo_tree = build_tree(args, tabfh, new_tree(args), _worker_lines(_worker['queues'][worker]), order)
+    if tabfh is not None:
+        tabfh.close()
+    return {'tree': taxo_tree, 'order': order}
+
+
+def _put(queue, item, processes):
+    """
+    Put item in queue, False if a worker ended before its input (error).
+    """
+    while True:
+        try:
+            queue.put(item, True, 1)
+            return True
+        except Queue.Full:
+            if [process for process in processes.values() if not process.is_alive()]:
+                return False
+
+
+def _dispatch(tabfh, queues, processes, grouped):
+    """
+    Read tabfh once and send its lines to the workers by hash of the query
+    ID, in chunks. With grouped, a None line ends the block of the previous
+    query in its worker when the next line goes to another one.
+    """
+    nb_workers = len(queues)
+    chunks = [[] for queue in queues]
+    last_query = None
+    last_worker = None
+    blast_line = 0
+    for blast_line, pos_line, line in iter_lines(tabfh):
+        if not blast_line & 0xffff:
+            metrics.progress('lines_read', blast_line)
+        if line == '\n':
+            continue
+        query = line.split('\t', 1)[0]
+        if query != last_query:
+            worker = hash(query) % nb_workers
+            if grouped and last_worker is not None and last_worker != worker:
+                chunks[last_worker].append((blast_line, pos_line, None))
+            last_query = query
+            last_worker = worker
+        chunk = chunks[worker]
+        chunk.append((blast_line, pos_line, line))
+        if len(chunk) >= DISPATCH_LINES:
+            if not _put(queues[worker], chunk, processes):
+                return
+            chunks[worker] = []
+    metrics.progress('lines_read', blast_line)
+    for worker, queue in enumerate(queues):
+        if chunks[worker] and not _put(queue, chunks[worker], processes):
+            return
+        if not _put(queue, None, processes):
+            return
+
+
+def main_workers(args, tabfh):
+    """
+    Build the tree of tabfh with args.workers processes and merge their
+    partial trees. The input is read once, each worker gets the lines of
+    its share of the queries (by hash of the query ID) and inserts them in
+    the order of their first line, reported with its tree: the merged tree
+    is the tree of one process.
+    """
+    queues = [multiprocessing.Queue(DISPATCH_DEPTH) for worker in range(args.workers)]
+    for queue in queues:
+        # all the chunks are read by the workers unless one fails
+        queue.cancel_join_thread()
+    _worker['args'] = args
+    _worker['tabfh'] = tabfh
+    _worker['queues'] = queues
+    start = metrics.start()
+    parts = run_jobs(_worker_tree, args.workers, args.workers,
+                     lambda processes: _dispatch(tabfh, queues, processes, args.grouped))
+    metrics.stop('workers', start)
+
+    for part in parts.values():
+        # read once by the parent
+        part['metrics']['counters'].pop('lines_read', None)
+        metrics.merge(part['metrics'])
+
+    start = metrics.start()
+    order = {}
+    for worker in range(args.workers):
+        order.update(parts[worker].pop('order'))
+    trees = [parts[worker].pop('tree') for worker in range(args.workers)]
+    taxo_tree = rankoptimizerlib.merge_trees(trees, new_tree(args), order.get)
+    metrics.stop('merge', start)
+    return taxo_tree
+
+
+def _dataset_tree(dataset):
+    args = _worker['args']
+    tabfh = taxoio.open_input(args.tabfh[dataset].name, seekable=None)
+    taxo_tree = build_tree(args, tabfh, new_tree(args))
+    tabfh.close()
+    return {'tree': taxo_tree}
+
+
+def main_datasets(args):
+    """
+    Build the tree of each input (one dataset) in parallel, at most
+    args.workers processes at a time, and return the union of the trees:
+    one node for the nodes of the same path, with the count and queries of
+    each dataset.
+    """
+    _worker['args'] = args
+    parts = run_jobs(_dataset_tree, len(args.tabfh), args.workers)
+    for part in parts.values():
+        metrics.merge(part['metrics'])
+    start = metrics.start()
+    taxo_tree = rankoptimizerlib.datasets_tree([parts[dataset].pop('tree') for dataset in range(len(args.tabfh))])
+    metrics.stop('merge', start)
+    return taxo_tree
+
+
 def lca(tree):
     if tree.has_one_child():
         tree = tree.childs[0]
@@ -303,8 +782,10 @@ By default, only the best HSP of each sequence is reported.""")
     general_options = parser.add_argument_group(title="Options", description=None)
 
     general_options.add_argument("-i", "--in", dest="tabfh",
-                                 help="Tabulated input file. Blast report with additional NCBI Taxonomy database informations from taxoptimizer program.",
-                                 type=file,
+                                 help="""Tabulated input file. Blast report with additional NCBI Taxonomy database informations from taxoptimizer program. Plain or bgzip compressed (.gz outputs of taxoptimizer), any compression with -g.
+                                 With several files (one dataset each, read in parallel), the Krona outputs (-k, -v, -j, -V) have one value by dataset, the text output the totals.""",
+                                 type=taxoio.InputFileType(seekable=None),
+                                 nargs='+',
                                  metavar="File",
                                  required=True)
 
@@ -328,43 +809,60 @@ By default, only the best HSP of each sequence is reported.""")
                                  help='Column\'s number with HSP scores',
                                  default=12)
 
+    general_options.add_argument("--metrics",
+                                 dest="metrics",
+                                 metavar="File",
+                                 help="Write a JSON report of the run: time by stage, counters, tree size, peak memory.",
+                                 default=None)
+    general_options.add_argument("--progress",
+                                 dest="progress",
+                                 metavar="Seconds",
+                                 type=int,
+                                 help="With --metrics, report the progress on stderr every given seconds (0: never).",
+                                 default=60)
+
     output_options = parser.add_argument_group(title="Output options", description=None)
     output_options.add_argument("-k", "--krona",
                                 action='store',
                                 dest='kronafh',
                                 metavar="File",
-                                type=argparse.FileType('w'),
+                                type=taxoio.OutputFileType(),
                                 help='xml output file with Krona Specification.',)
     output_options.add_argument("-t", "--text",
                                 action='store',
                                 dest='textfh',
                                 metavar="File",
-                                type=argparse.FileType('w'),
+                                type=taxoio.OutputFileType(),
                                 help='taxonomy abundance with dendrogram tree representation',)
     output_options.add_argument("-v", "--htmlx",
                                 action='store',
                                 dest='htmlxmlfh',
                                 metavar="File",
-                                type=argparse.FileType('w'),
+                                type=taxoio.OutputFileType(),
                                 help='html output with Krona specification and Krona javascript library. xml style',)
     output_options.add_argument("-V", "--htmlj",
                                 action='store',
                                 dest='htmljsonfh',
                                 metavar="File",
-                                type=argparse.FileType('w'),
+                                type=taxoio.OutputFileType(),
                                 help='html output with Krona specification and Krona javascript library. json style',)
     output_options.add_argument("-j", "--json",
                                 action='store',
                                 dest='jsonfh',
                                 metavar="File",
-                                type=argparse.FileType('w'),
+                                type=taxoio.OutputFileType(),
                                 help='json output with Krona specification',)
     output_options.add_argument("-p", "--dump",
                                 action='store',
                                 dest='dumpfh',
                                 metavar="File",
-                                type=argparse.FileType('w'),
-                                help='Python dump output with Krona specification.',)
+                                type=taxoio.OutputFileType(),
+                                help='Binary tree file, loaded by rankoptimizerlib.load_tree().',)
+    output_options.add_argument("--no_indent",
+                                dest="no_indent",
+                                help="Krona xml and json (-k, -v, -j, -V) without indentation nor line breaks: smaller and faster to write.",
+                                action='store_true',
+                                default=False,)
     output_options.add_argument("-a", "--lca",
                                 dest="lca",
                                 help="Report lowest common ancestor of the taxonomic abundance",
@@ -390,6 +888,27 @@ By default, only the best HSP of each sequence is reported.""")
                                   Note: If two queries have the same taxonomy but only one has rank information, queries are in differents nodes into the tree.""",
                                   action='store_true',
                                   default=False,)
+    specific_options.add_argument("-g", "--grouped",
+                                  dest="grouped",
+                                  help="""Single pass mode for inputs grouped by query (Blast order): each query is inserted in the tree when
+                                  its lines are read, nothing is read twice. Memory depends on the tree, not on the number of queries. Nodes and
+                                  reads follow the input order.""",
+                                  action='store_true',
+                                  default=False,)
+    specific_options.add_argument("--compact_tree",
+                                  dest="compact_tree",
+                                  help="""Build the tree in a compact store (arrays of nodes and queries instead of one Python object by node):
+                                  less memory for large samples, a bit slower to build.""",
+                                  action='store_true',
+                                  default=False,)
+    specific_options.add_argument("-w", "--workers",
+                                  action='store',
+                                  dest='workers',
+                                  type=int,
+                                  help="""Number of processes building the tree. The input is read once and each process gets the lines of its
+                                  share of the queries (by hash of the query ID); the partial trees are merged in the tree of one process.
+                                  With several inputs, number of inputs read at a time (default: 1, one by CPU with several inputs).""",
+                                  default=None)
     specific_options.add_argument("-U", "--identical",
                                   dest="identical",
                                   help="""Reintroduce abundance of identical reads in the analyze.
@@ -398,179 +917,86 @@ By default, only the best HSP of each sequence is reported.""")
                                   default=False,)
 
     args = parser.parse_args()
-
-    query_infos = {}
-    taxcolumn = args.taxcolumn - 1
-    scorecolumn = args.scorecolumn - 1
-
-    try:
-        pos_line = args.tabfh.tell()
-        line = args.tabfh.readline()
-        blast_line = 1
-    except IOError, err:
-        print >>sys.stderr, RankOptimizerError("readline error: %s line:%s" % (err, blast_line))
-        sys.exit()
-
-    while line:
-        if line == '\n':
-            try:
-                pos_line = args.tabfh.tell()
-                line = args.tabfh.readline()
-                blast_line += 1
-            except IOError, err:
-                print >>sys.stderr, RankOptimizerError("readline error:%s line:%s" % (err, blast_line))
-                sys.exit()
-            continue
-        fld = line.split('\t')
-        try:
-            query = fld[0]
-        except StandardError, err:
-            print >>sys.stderr, RankOptimizerError("query error:%s line:%s" % (err, blast_line))
-            sys.exit()
-
-        try:
-            if fld[scorecolumn] and fld[scorecolumn][0] == 'e':
-                num = '1' + fld[scorecolumn]
-            else:
-                num = fld[scorecolumn]
-            hsp_score = float(num)
-        except StandardError, err:
-            print >>sys.stderr, RankOptimizerError("score column number error:-C %s in line %s:%s" % (scorecolumn + 1, blast_line, err))
-            sys.exit()
-        try:
-            sbjct_taxonomy = fld[taxcolumn]
-            sbjct_taxonomy = True
-        except:
-            sbjct_taxonomy = False
-
-        # {'hsp_score':hsp_score, 'sbjct_taxonomy':sbjct_taxonomy, 'pos_line':pos_line }
-        # ===> (hsp_score,  sbjct_taxonomy, pos_line)
-        # ##### Analyze and stock query
-        if query in query_infos:
-            if not query_infos[query]['max_score'][1] or (sbjct_taxonomy and hsp_score > query_infos[query]['max_score'][0]):
-                query_infos[query]['max_score'] = (hsp_score, sbjct_taxonomy, pos_line)
-            elif (args.delta and sbjct_taxonomy) and (hsp_score > (query_infos[query]['max_score'][0] * (1 - (args.delta * 0.01)))):
-                # stock all at one moment. reduce after.
-                if 'delta' in query_infos[query]:
-                    query_infos[query]['delta'].append((hsp_score, sbjct_taxonomy, pos_line))
-                else:
-                    query_infos[query]['delta'] = [(hsp_score, sbjct_taxonomy, pos_line)]
-            # else:
-            #    print ''
+    if args.metrics:
+        metrics.enable(args.metrics, args.progress)
+    for tabfh in args.tabfh:
+        if not args.grouped and not taxoio.seekable(tabfh):
+            parser.error("argument -i/--in: %s can't be read twice, use -g (input grouped by query) or recompress it with bgzip" % tabfh.name)
+    if args.workers is None:
+        if len(args.tabfh) > 1:
+            args.workers = min(len(args.tabfh), multiprocessing.cpu_count())
         else:
-            query_infos[query] = {'max_score': (hsp_score, sbjct_taxonomy, pos_line)}
-
-        try:
-            pos_line = args.tabfh.tell()
-            line = args.tabfh.readline()
-            blast_line += 1
-        except IOError, err:
-            print >>sys.stderr, RankOptimizerError("%s line:%s" % (err, blast_line))
-            sys.exit()
-
-    if args.delta:
-        for query in query_infos.keys():
-            if 'delta' in query_infos[query] and len(query_infos[query]['delta']) > 1:
-                # avant= len(query_infos[query]['delta'])
-                query_infos[query] = reduce_by_delta(query_infos[query], query, args.delta)
-
-    # ## Construct tree structure
-    taxo_tree = rankoptimizerlib.Taxon('root')
-
-    for query, infos in query_infos.items():
-        pos_line = infos['max_score'][2]
-        args.tabfh.seek(pos_line)
-        try:
-            line = args.tabfh.readline()
-            fld = line.split('\t')
-        except IOError, err:
-            print >>sys.stderr, RankOptimizerError("%s line:%s" % (err, line))
-            sys.exit()
-        try:
-            sbjct_taxonomy = fld[taxcolumn].strip()  # ## taxonomy begin at the 13 column separated by \t
-            # ###### Clean taxonomy
-            if sbjct_taxonomy[-1] == '.':
-                sbjct_taxonomy = sbjct_taxonomy[:-1] + ';'
-            if args.clean:
-                sbjct_taxonomy = sbjct_taxonomy.replace('cellular organisms ;', '').strip()
-                sbjct_taxonomy = sbjct_taxonomy.replace('cellular organisms;', '').strip()
-            # if repairGB and sbjct_taxonomy:### slow
-            #    sbjct_taxonomy = clean_taxo(sbjct_taxonomy)
-
-        except:
-            print >>sys.stderr, 'no taxo found for %s' % query
-            continue
-
-        taxo_tree = insert_taxo_tot(taxo_tree, query, pos_line, sbjct_taxonomy, args.rank, args.identical)
-
-        if 'delta' in infos:
-            all_delta_taxo = [sbjct_taxonomy]
-            for qd in infos['delta']:
-                pos_line = qd[2]
-                args.tabfh.seek(pos_line)
-                blast_line = args.tabfh.readline()
-                fld = blast_line.split('\t')
-                try:
-                    sbjct_taxonomy = fld[taxcolumn].strip()
-                    # ###### Clean taxonomy
-                    if sbjct_taxonomy[-1] == '.':
-                        sbjct_taxonomy = sbjct_taxonomy[:-1] + ';'
-                    if args.clean:
-                        sbjct_taxonomy = sbjct_taxonomy.replace('cellular organisms ;', '').strip()
-                        sbjct_taxonomy = sbjct_taxonomy.replace('cellular organisms;', '').strip()
-                    # if repairGB and sbjct_taxonomy:### slow
-                    #    sbjct_taxonomy = clean_taxo(sbjct_taxonomy)
-                except:
-                    print >>sys.stderr, 'no taxo found for %s' % query
-                    continue
-                if sbjct_taxonomy not in all_delta_taxo:
-                    taxo_tree = insert_taxo_tot_delta(taxo_tree, query, pos_line, sbjct_taxonomy, args.rank, args.identical)
-                    all_delta_taxo.append(sbjct_taxonomy)
-        # print >>sys.stderr, p.get_memory_info()
-        query_infos.pop(query)
+            args.workers = 1
+    if '<stdin>' in [tabfh.name for tabfh in args.tabfh] and (len(args.tabfh) > 1 or (args.workers > 1 and not args.grouped)):
+        parser.error("argument -i/--in: the standard input can't be read by a worker process")
+    dataset_names = [tabfh.name for tabfh in args.tabfh]
+
+    if len(args.tabfh) > 1:
+        taxo_tree = main_datasets(args)
+    elif args.workers > 1:
+        taxo_tree = main_workers(args, args.tabfh[0])
+    else:
+        taxo_tree = build_tree(args, args.tabfh[0], new_tree(args))
+    if metrics.enabled:
+        metrics.count('tree_nodes', taxo_tree.nb_nodes())
+        metrics.info('caches', hit_ratios({'lineages': dict(_lineages_stats, entries=len(_lineages))}))
 
     # ### output
     if args.textfh:
+        start = metrics.start()
         try:
             tree_repr = rankoptimizerlib.to_tree(taxo_tree, query_name=False)
             print >>args.textfh, tree_repr
         except IOError, err:
             print >>sys.stderr, err
+        metrics.stop('write_text', start)
 
     if args.jsonfh:
+        start = metrics.start()
         try:
-            kronaJson = rankoptimizerlib.KronaJSON(args.jsonfh, args.tabfh.name, taxo_tree)
+            kronaJson = rankoptimizerlib.KronaJSON(args.jsonfh, dataset_names, taxo_tree, pretty=not args.no_indent)
             kronaJson.krona()
         except IOError, err:
             print >>sys.stderr, err
+        metrics.stop('write_json', start)
 
     if args.kronafh:
+        start = metrics.start()
         try:
-            krona_xml = rankoptimizerlib.Krona(args.kronafh, args.tabfh.name, taxo_tree)
+            krona_xml = rankoptimizerlib.Krona(args.kronafh, dataset_names, taxo_tree, pretty=not args.no_indent)
             krona_xml.krona()
         except IOError, err:
             print >>sys.stderr, err
+        metrics.stop('write_krona', start)
 
     if args.htmlxmlfh:
+        start = metrics.start()
         try:
             args.krona_jsfh.seek(0)
-            krona_xml = rankoptimizerlib.Krona(args.htmlxmlfh, args.tabfh.name, taxo_tree)
+            krona_xml = rankoptimizerlib.Krona(args.htmlxmlfh, dataset_names, taxo_tree, pretty=not args.no_indent)
             krona_xml.krona_html(args.krona_jsfh)
         except IOError, err:
             print >>sys.stderr, err
+        metrics.stop('write_html_xml', start)
 
     if args.htmljsonfh:
+        start = metrics.start()
         try:
             args.krona_jsfh.seek(0)
-            krona_json = rankoptimizerlib.KronaJSON(args.htmljsonfh, args.tabfh.name, taxo_tree)
+            krona_json = rankoptimizerlib.KronaJSON(args.htmljsonfh, dataset_names, taxo_tree, pretty=not args.no_indent)
             krona_json.krona_html(args.krona_jsfh)
         except IOError, err:
             print >>sys.stderr, err
+        metrics.stop('write_html_json', start)
 
     if args.dumpfh:
-        import pickle
-        pickle.dump(taxo_tree, args.dumpfh)
-        args.dumpfh.close()
+        start = metrics.start()
+        try:
+            rankoptimizerlib.dump_tree(taxo_tree, args.dumpfh, dataset_names)
+            args.dumpfh.close()
+        except IOError, err:
+            print >>sys.stderr, err
+        metrics.stop('write_dump', start)
 
     if args.lca:
         print 'Lowest common ancestor:', lca(taxo_tree)
@@ -10,6 +10,19 @@
 
 import os
 import sys
+import json
+import mmap
+import struct
+import collections
+from array import array
+
+import taxoio
+
+# 64 bit integers of the arrays (the array module has no 'q' typecode), 32 bit
+# on 32 bit platforms and Windows: the tree file int64 sections are then packed
+# with struct
+INT64 = 'l'
+INT64_ARRAY = array(INT64).itemsize == 8
 
 
 class Taxon(object):
@@ -22,6 +35,7 @@ class Taxon(object):
         self.name = name
         self.parent = None  # Taxon object
         self.childs = []    # list of Taxon object
+        self.child_index = {}  # name --> Taxon object of childs
         self.queriesS = []   # list of tuple [(query, pos_line)]
         self.repr = ''
         self.rank = rank
@@ -34,10 +48,7 @@ class Taxon(object):
         """
         t.has_child(val) --> bool
         """
-        for chld in self.childs:
-            if chld.name == child:
-                return True
-        return False
+        return child in self.child_index
 
     def has_childs(self):
         """
@@ -74,8 +85,8 @@ class Taxon(object):
         """
         t.add_child(child)
 
-        Creates a new Taxon object with child as name and append it as
-        the childs list of t.
+        Creates a new Taxon object with child as name, append it as
+        the childs list of t and return it.
         """
         t = Taxon(child, rank)
         t.parent = self
@@ -89,11 +100,22 @@ class Taxon(object):
             # t.repr = '.\t'
             t.repr = '.'
             self.childs.append(t)
+        self.child_index[child] = t
+        return t
 
     def get_child(self, child):
-        for chld in self.childs:
-            if chld.name == child:
-                return chld
+        return self.child_index.get(child)
+
+    def get_or_add_child(self, child, rank=''):
+        """
+        t.get_or_add_child(name, rank) --> Taxon
+
+        Return the child of t with this name, created (with rank) if missing.
+        """
+        t = self.child_index.get(child)
+        if t is None:
+            t = self.add_child(child, rank)
+        return t
 
 #     def nb_of_queries_in_childs(self):
 #         nb = 0
@@ -104,27 +126,784 @@ class Taxon(object):
     def has_one_child(self):
         return len(self.childs) == 1
 
+    def dataset_counts(self):
+        """
+        t.dataset_counts() --> [nb_querys of each dataset]
+        """
+        return [self.nb_querys]
+
+    def dataset_queries(self):
+        """
+        t.dataset_queries() --> [queriesS of each dataset]
+        """
+        return [self.queriesS]
+
+    def nb_nodes(self):
+        """
+        t.nb_nodes() --> number of Taxon objects in the tree of t
+        """
+        nb = 0
+        stack = [self]
+        while stack:
+            taxon = stack.pop()
+            nb += 1
+            stack.extend(taxon.childs)
+        return nb
+
+
+# #################### Compact tree
+
+
+class CompactTree(object):
+    def __init__(self, name='root'):
+        """
+        tree = CompactTree()
+
+        Struct of arrays taxonomy tree: one entry by node in parallel arrays
+        (parent index, interned name and rank ids, number of queries), the
+        queries of the leaves in three flat arrays. The nodes are handled
+        through CompactTaxon views (tree.root()), with the Taxon interface
+        used by rankoptimizer, Krona, KronaJSON and to_tree.
+
+        The childs (in insertion order) and queriesS of the nodes are built
+        on demand as CSR (offsets, indexes) arrays. Only the arrays are
+        pickled.
+        """
+        self.names = []      # name id --> name
+        self.ranks = ['']    # rank id --> rank
+        self.parent = array('i', [-1])
+        self.name_id = array('i', [0])
+        self.rank_id = array('i', [0])
+        self.nb_querys = array(INT64, [0])
+        self.query_node = array('i')  # query --> node index
+        self.query_pos = array(INT64)  # query --> pos_line
+        self.query_name = []          # query --> query name
+        self._name_index = {}
+        self._rank_index = {'': 0}
+        self._intern(self.names, self._name_index, name)
+        self._init_index()
+
+    def _intern(self, values, index, value):
+        value_id = index.get(value)
+        if value_id is None:
+            value_id = index[value] = len(values)
+            values.append(value)
+        return value_id
+
+    def _init_index(self):
+        # (parent << 32 | name id) --> child index
+        self._child_index = {}
+        for i in xrange(1, len(self.parent)):
+            self._child_index[self.parent[i] << 32 | self.name_id[i]] = i
+        self._childs = None
+        self._queries = None
+
+    def __len__(self):
+        return len(self.parent)
+
+    def __getstate__(self):
+        return (self.names, self.ranks, self.parent, self.name_id, self.rank_id, self.nb_querys,
+                self.query_node, self.query_pos, self.query_name)
+
+    def __setstate__(self, state):
+        (self.names, self.ranks, self.parent, self.name_id, self.rank_id, self.nb_querys,
+         self.query_node, self.query_pos, self.query_name) = state
+        self._name_index = dict((name, i) for i, name in enumerate(self.names))
+        self._rank_index = dict((rank, i) for i, rank in enumerate(self.ranks))
+        self._init_index()
+
+    def root(self):
+        return CompactTaxon(self, 0)
+
+    def child(self, index, name):
+        name_id = self._name_index.get(name)
+        if name_id is None:
+            return -1
+        return self._child_index.get(index << 32 | name_id, -1)
+
+    def add_child(self, index, name, rank=''):
+        name_id = self._intern(self.names, self._name_index, name)
+        child = len(self.parent)
+        self.parent.append(index)
+        self.name_id.append(name_id)
+        self.rank_id.append(self._intern(self.ranks, self._rank_index, rank))
+        self.nb_querys.append(0)
+        self._child_index[index << 32 | name_id] = child
+        self._childs = None
+        return child
+
+    def set_rank(self, index, rank):
+        self.rank_id[index] = self._intern(self.ranks, self._rank_index, rank)
+
+    def add_query(self, index, query, pos_line):
+        self.query_node.append(index)
+        self.query_pos.append(pos_line)
+        self.query_name.append(query)
+        self._queries = None
+
+    def _csr(self, keys):
+        # keys[i]: node of item i --> (offsets, items), items of node n in
+        # items[offsets[n]:offsets[n + 1]], in the order of keys
+        nb = len(self.parent)
+        offsets = array('i', [0]) * (nb + 1)
+        for key in keys:
+            if key >= 0:
+                offsets[key + 1] += 1
+        for n in xrange(nb):
+            offsets[n + 1] += offsets[n]
+        fill = array('i', offsets)
+        items = array('i', [0]) * offsets[nb]
+        for i, key in enumerate(keys):
+            if key >= 0:
+                items[fill[key]] = i
+                fill[key] += 1
+        return offsets, items
+
+    def childs(self, index):
+        if self._childs is None:
+            self._childs = self._csr(self.parent)
+        offsets, items = self._childs
+        return items[offsets[index]:offsets[index + 1]]
+
+    def queries(self, index):
+        if self._queries is None:
+            self._queries = self._csr(self.query_node)
+        offsets, items = self._queries
+        return items[offsets[index]:offsets[index + 1]]
+
+
+class CompactTaxon(object):
+    __slots__ = ('tree', 'index')
+
+    def __init__(self, tree, index):
+        """
+        View of the node index of a CompactTree, with the Taxon interface.
+        """
+        self.tree = tree
+        self.index = index
+
+    def __reduce__(self):
+        return (CompactTaxon, (self.tree, self.index))
+
+    def __eq__(self, other):
+        return isinstance(other, CompactTaxon) and self.tree is other.tree and self.index == other.index
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((id(self.tree), self.index))
+
+    def _get_name(self):
+        return self.tree.names[self.tree.name_id[self.index]]
+
+    def _get_rank(self):
+        return self.tree.ranks[self.tree.rank_id[self.index]]
+
+    def _set_rank(self, rank):
+        self.tree.set_rank(self.index, rank)
+
+    def _get_nb_querys(self):
+        return self.tree.nb_querys[self.index]
+
+    def _set_nb_querys(self, nb):
+        self.tree.nb_querys[self.index] = nb
+
+    def _get_parent(self):
+        parent = self.tree.parent[self.index]
+        if parent < 0:
+            return None
+        return CompactTaxon(self.tree, parent)
+
+    def _get_childs(self):
+        return [CompactTaxon(self.tree, c) for c in self.tree.childs(self.index)]
+
+    def _get_queries(self):
+        tree = self.tree
+        return [(tree.query_name[q], tree.query_pos[q]) for q in tree.queries(self.index)]
+
+    def _get_repr(self):
+        # Taxon.add_child: '.' for the last of several childs, '|' otherwise
+        parent = self.tree.parent[self.index]
+        if parent < 0:
+            return ''
+        brothers = self.tree.childs(parent)
+        if len(brothers) > 1 and brothers[-1] == self.index:
+            return '.'
+        return '|'
+
+    name = property(_get_name)
+    rank = property(_get_rank, _set_rank)
+    nb_querys = property(_get_nb_querys, _set_nb_querys)
+    parent = property(_get_parent)
+    childs = property(_get_childs)
+    queriesS = property(_get_queries)
+    repr = property(_get_repr)
+
+    def has_rank(self):
+        return self.tree.rank_id[self.index] != 0
+
+    def has_child(self, child):
+        return self.tree.child(self.index, child) >= 0
+
+    def has_childs(self):
+        return len(self.tree.childs(self.index)) > 0
+
+    def has_one_child(self):
+        return len(self.tree.childs(self.index)) == 1
+
+    def has_queries(self):
+        return len(self.tree.queries(self.index)) > 0
+
+    def dataset_counts(self):
+        return [self.nb_querys]
+
+    def dataset_queries(self):
+        return [self.queriesS]
+
+    def add_queries(self, query_all):
+        self.tree.add_query(self.index, query_all[0], query_all[1])
+
+    def add_child(self, child, rank=''):
+        return CompactTaxon(self.tree, self.tree.add_child(self.index, child, rank))
+
+    def get_child(self, child):
+        index = self.tree.child(self.index, child)
+        if index < 0:
+            return None
+        return CompactTaxon(self.tree, index)
+
+    def get_or_add_child(self, child, rank=''):
+        index = self.tree.child(self.index, child)
+        if index < 0:
+            index = self.tree.add_child(self.index, child, rank)
+        return CompactTaxon(self.tree, index)
+
+    def nb_nodes(self):
+        if self.index == 0:
+            return len(self.tree)
+        nb = 0
+        stack = [self.index]
+        while stack:
+            index = stack.pop()
+            nb += 1
+            stack.extend(self.tree.childs(index))
+        return nb
+
+
+# #################### Tree merge
+
+
+def _first_keys(tree, key, first):
+    # first[node] = smallest key(query) of the queries of the node and its
+    # descendants, i.e. the insertion that created the node
+    stack = [(tree, False)]
+    while stack:
+        node, done = stack.pop()
+        if done:
+            keys = [key(query) for query, pos_line in node.queriesS]
+            keys.extend([first[c] for c in node.childs])
+            first[node] = min(keys or [float('inf')])
+        else:
+            stack.append((node, True))
+            stack.extend([(c, False) for c in node.childs])
+
+
+def _merge_nodes(target, nodes, key, first, depth):
+    target.nb_querys += sum([n.nb_querys for n in nodes])
+    queries = []
+    for n in nodes:
+        queries.extend(n.queriesS)
+    if key is not None:
+        queries.sort(key=lambda query_all: key(query_all[0]))
+    for query_all in queries:
+        target.add_queries(query_all)
+
+    # name --> (first key, rank among its brothers, child) of the childs with this name
+    groups = collections.OrderedDict()
+    for n in nodes:
+        for i, c in enumerate(n.childs):
+            groups.setdefault(c.name, []).append((first.get(c), i, c))
+    groups = groups.values()
+    if key is not None:
+        # the childs created by the same query are in the same tree, in the
+        # order of their creation
+        for group in groups:
+            group.sort(key=lambda child: child[:2])
+        groups.sort(key=lambda group: group[0][:2])
+    for group in groups:
+        group = [c for f, i, c in group]
+        if depth == 0:
+            # insert_taxo_tot: the rank of a first level node is the one of its creation
+            rank = group[0].rank
+        else:
+            ranks = [c.rank for c in group if c.rank]
+            rank = ranks and ranks[0] or ''
+        child = target.get_or_add_child(group[0].name, rank)
+        _merge_nodes(child, group, key, first, depth + 1)
+
+
+def merge_trees(trees, root=None, key=None):
+    """
+    merge_trees(trees, root) --> root
+
+    Merge the taxonomy trees (Taxon or CompactTaxon roots) in root (a new
+    Taxon by default): nb_querys are summed, childs are united and queriesS
+    concatenated.
+
+    Without key, the trees are taken in order, as consecutive chunks of
+    the input. With key (query --> insertion rank), the trees hold disjoint
+    sets of queries, and childs and queriesS are ordered as if all the
+    queries had been inserted in one tree by increasing key.
+    """
+    if root is None:
+        root = Taxon(trees[0].name)
+    first = {}
+    if key is not None:
+        for tree in trees:
+            _first_keys(tree, key, first)
+    _merge_nodes(root, list(trees), key, first, 0)
+    return root
+
+
+# #################### Datasets
+
+
+class DatasetsTaxon(object):
+    def __init__(self, name, rank='', nodes=None):
+        """
+        t = DatasetsTaxon(name, rank, nodes)
+
+        Node of the union of the trees of several datasets: nodes holds the
+        node of each dataset tree (None if the dataset has no such node).
+        nb_querys and queriesS are the totals of the datasets.
+        """
+        self.name = name
+        self.rank = rank
+        self.nodes = nodes or []
+        self.parent = None
+        self.childs = []
+        self.repr = ''
+
+    def _get_nb_querys(self):
+        return sum(self.dataset_counts())
+
+    def _get_queries(self):
+        queries = []
+        for dataset_queries in self.dataset_queries():
+            queries.extend(dataset_queries)
+        return queries
+
+    nb_querys = property(_get_nb_querys)
+    queriesS = property(_get_queries)
+
+    def dataset_counts(self):
+        return [n is not None and n.nb_querys or 0 for n in self.nodes]
+
+    def dataset_queries(self):
+        return [n is not None and n.queriesS or [] for n in self.nodes]
+
+    def has_rank(self):
+        return self.rank
+
+    def has_childs(self):
+        return not self.childs == []
+
+    def has_one_child(self):
+        return len(self.childs) == 1
+
+    def has_queries(self):
+        return [n for n in self.nodes if n is not None and n.has_queries()] != []
+
+    def add_child(self, child, rank='', nodes=None):
+        t = DatasetsTaxon(child, rank, nodes)
+        t.parent = self
+        if self.childs:
+            self.childs[-1].repr = '|'
+            t.repr = '.'
+        else:
+            t.repr = '|'
+        self.childs.append(t)
+        return t
+
+    def nb_nodes(self):
+        nb = 0
+        stack = [self]
+        while stack:
+            taxon = stack.pop()
+            nb += 1
+            stack.extend(taxon.childs)
+        return nb
+
+
+def datasets_tree(trees):
+    """
+    datasets_tree([tree1, tree2, ...]) --> DatasetsTaxon
+
+    Union of the trees of several datasets (same node: same path of names),
+    the childs in their order of appearance in tree1, tree2, ...
+    """
+    root = DatasetsTaxon(trees[0].name, '', list(trees))
+    stack = [(root, 0)]
+    while stack:
+        node, depth = stack.pop()
+        groups = collections.OrderedDict()  # name --> node of each dataset
+        for dataset, n in enumerate(node.nodes):
+            if n is not None:
+                for c in n.childs:
+                    groups.setdefault(c.name, [None] * len(trees))[dataset] = c
+        for name, nodes in groups.items():
+            if depth == 0:
+                # insert_taxo_tot: the rank of a first level node is the one of its creation
+                ranks = [c.rank for c in nodes if c is not None][:1]
+            else:
+                ranks = [c.rank for c in nodes if c is not None and c.rank]
+            child = node.add_child(name, ranks and ranks[0] or '', nodes)
+            stack.append((child, depth + 1))
+    return root
+
+
+# #################### Binary tree file (rankoptimizer -p)
+#
+# Little endian, every section 8 bytes aligned, n nodes in breadth first
+# order (the childs of a node are consecutive, node 0 is the root), d
+# datasets, q queries, s strings:
+#
+#   header      TREE_HEADER: magic, version, d, n, q, s
+#   datasets    int32[d]        string id of the dataset names
+#   parent      int32[n]        -1 for the root
+#   name        int32[n]        string id
+#   rank        int32[n]        string id ('' : no rank)
+#   first_child int32[n]
+#   nb_childs   int32[n]
+#   counts      int64[n * d]    nb_querys of node i, dataset j at i * d + j
+#   queries     int64[n * d + 1] queries of node i, dataset j:
+#                               queries[i * d + j]:queries[i * d + j + 1]
+#   query_name  int32[q]        string id
+#   query_pos   int64[q]        pos_line
+#   strings     int64[s + 1]    offsets of the strings in the blob
+#   blob
+
+TREE_MAGIC = 'TAXOTREE'
+TREE_VERSION = 1
+TREE_HEADER = struct.Struct('<8sIIQQQ')
+
+
+class TaxoTreeError:
+    def __init__(self, err):
+        self.err = err
+
+    def __repr__(self):
+        return "[TaxoTreeError] " + self.err
+
+    __str__ = __repr__
+
+
+def _write_section(fh, typecode, values):
+    """
+    Write values as little endian typecode items ('i' or 'q'), padded to 8 bytes.
+    """
+    if typecode == 'q' and not INT64_ARRAY:
+        data = struct.pack('<%dq' % len(values), *values)
+    else:
+        if typecode == 'q':
+            typecode = INT64
+        a = array(typecode, values)
+        if sys.byteorder == 'big':
+            a.byteswap()
+        data = a.tostring()
+    fh.write(data)
+    if len(data) % 8:
+        fh.write('\0' * (8 - len(data) % 8))
+
+
+def dump_tree(taxo_tree, fh, dataset_names=None):
+    """
+    dump_tree(taxo_tree, fh)
+
+    Write the tree of taxo_tree (Taxon, CompactTaxon or DatasetsTaxon) in
+    fh, in the binary tree file format, in one breadth first traversal.
+    """
+    strings = []
+    string_ids = {}
+
+    def string_id(value):
+        i = string_ids.get(value)
+        if i is None:
+            i = string_ids[value] = len(strings)
+            strings.append(value)
+        return i
+
+    string_id('')
+    nb_datasets = len(taxo_tree.dataset_counts())
+    if not dataset_names:
+        dataset_names = [''] * nb_datasets
+    datasets = [string_id(name) for name in dataset_names]
+    parent = array('i')
+    name = array('i')
+    rank = array('i')
+    first_child = array('i')
+    nb_childs = array('i')
+    counts = array(INT64)
+    queries = array(INT64, [0])
+    query_name = array('i')
+    query_pos = array(INT64)
+    fifo = collections.deque([(taxo_tree, -1)])
+    nb_nodes = 1
+    while fifo:
+        taxon, parent_index = fifo.popleft()
+        index = len(parent)
+        parent.append(parent_index)
+        name.append(string_id(taxon.name))
+        rank.append(string_id(taxon.rank or ''))
+        childs = taxon.childs
+        first_child.append(nb_nodes)
+        nb_childs.append(len(childs))
+        nb_nodes += len(childs)
+        fifo.extend([(c, index) for c in childs])
+        counts.extend(taxon.dataset_counts())
+        for dataset_queries in taxon.dataset_queries():
+            for query, pos_line in dataset_queries:
+                query_name.append(string_id(query))
+                query_pos.append(pos_line)
+            queries.append(len(query_name))
+
+    offsets = array(INT64, [0])
+    for value in strings:
+        offsets.append(offsets[-1] + len(value))
+    fh.write(TREE_HEADER.pack(TREE_MAGIC, TREE_VERSION, nb_datasets, len(parent), len(query_name), len(strings)))
+    for typecode, values in (('i', datasets), ('i', parent), ('i', name), ('i', rank), ('i', first_child), ('i', nb_childs),
+                             ('q', counts), ('q', queries), ('i', query_name), ('q', query_pos), ('q', offsets)):
+        _write_section(fh, typecode, values)
+    fh.write(''.join(strings))
+
+
+class TreeFile(object):
+    def __init__(self, path):
+        """
+        tree = TreeFile(path)
+
+        Tree file written by dump_tree, mapped in memory (read if it's
+        compressed): only the header is read here, the nodes are read when
+        used, through the FileTaxon views of tree.root().
+        """
+        self.path = path
+        self.fh = None
+        self.data = None
+        if taxoio.compression(path) is None:
+            self.fh = open(path, 'rb')
+            try:
+                self.data = mmap.mmap(self.fh.fileno(), 0, access=mmap.ACCESS_READ)
+            except (mmap.error, ValueError), err:
+                raise TaxoTreeError("%s: %s" % (path, err))
+        else:
+            fh = taxoio.open_input(path)
+            self.data = fh.read()
+            fh.close()
+        if len(self.data) < TREE_HEADER.size:
+            raise TaxoTreeError("%s: not a tree file" % path)
+        magic, version, self.nb_datasets, self.nb_nodes, self.nb_queries, self.nb_strings = TREE_HEADER.unpack_from(self.data, 0)
+        if magic != TREE_MAGIC:
+            raise TaxoTreeError("%s: not a tree file" % path)
+        if version != TREE_VERSION:
+            raise TaxoTreeError("%s: tree file version %d, %d expected" % (path, version, TREE_VERSION))
+        offset = TREE_HEADER.size
+        sections = {}
+        for section, itemsize, nb in (('datasets', 4, self.nb_datasets), ('parent', 4, self.nb_nodes), ('name', 4, self.nb_nodes),
+                                      ('rank', 4, self.nb_nodes), ('first_child', 4, self.nb_nodes), ('nb_childs', 4, self.nb_nodes),
+                                      ('counts', 8, self.nb_nodes * self.nb_datasets), ('queries', 8, self.nb_nodes * self.nb_datasets + 1),
+                                      ('query_name', 4, self.nb_queries), ('query_pos', 8, self.nb_queries), ('strings', 8, self.nb_strings + 1)):
+            sections[section] = offset
+            offset += (itemsize * nb + 7) & ~7
+        self.sections = sections
+        self.blob = offset
+        if len(self.data) < offset:
+            raise TaxoTreeError("%s: truncated tree file" % path)
+
+    def close(self):
+        if self.fh:
+            self.data.close()
+            self.fh.close()
+            self.fh = None
+
+    def int32(self, section, index):
+        return _INT32.unpack_from(self.data, self.sections[section] + 4 * index)[0]
+
+    def int64(self, section, index):
+        return _INT64.unpack_from(self.data, self.sections[section] + 8 * index)[0]
+
+    def int64s(self, section, start, nb):
+        return struct.unpack_from('<%dq' % nb, self.data, self.sections[section] + 8 * start)
+
+    def string(self, string_id):
+        start, end = struct.unpack_from('<2q', self.data, self.sections['strings'] + 8 * string_id)
+        return self.data[self.blob + start:self.blob + end]
+
+    def dataset_names(self):
+        return [self.string(self.int32('datasets', i)) for i in range(self.nb_datasets)]
+
+    def root(self):
+        return FileTaxon(self, 0)
+
+
+_INT32 = struct.Struct('<i')
+_INT64 = struct.Struct('<q')
+
+
+class FileTaxon(object):
+    __slots__ = ('tree', 'index')
+
+    def __init__(self, tree, index):
+        """
+        Read only view of the node index of a TreeFile, with the Taxon
+        interface.
+        """
+        self.tree = tree
+        self.index = index
+
+    def __eq__(self, other):
+        return isinstance(other, FileTaxon) and self.tree is other.tree and self.index == other.index
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((id(self.tree), self.index))
+
+    @property
+    def name(self):
+        return self.tree.string(self.tree.int32('name', self.index))
+
+    @property
+    def rank(self):
+        return self.tree.string(self.tree.int32('rank', self.index))
+
+    @property
+    def parent(self):
+        parent = self.tree.int32('parent', self.index)
+        if parent < 0:
+            return None
+        return FileTaxon(self.tree, parent)
+
+    @property
+    def childs(self):
+        first = self.tree.int32('first_child', self.index)
+        return [FileTaxon(self.tree, c) for c in xrange(first, first + self.tree.int32('nb_childs', self.index))]
+
+    @property
+    def nb_querys(self):
+        return sum(self.dataset_counts())
+
+    @property
+    def queriesS(self):
+        queries = []
+        for dataset_queries in self.dataset_queries():
+            queries.extend(dataset_queries)
+        return queries
+
+    @property
+    def repr(self):
+        # Taxon.add_child: '.' for the last of several childs, '|' otherwise
+        parent = self.tree.int32('parent', self.index)
+        if parent < 0:
+            return ''
+        nb_childs = self.tree.int32('nb_childs', parent)
+        if nb_childs > 1 and self.index == self.tree.int32('first_child', parent) + nb_childs - 1:
+            return '.'
+        return '|'
+
+    def dataset_counts(self):
+        return list(self.tree.int64s('counts', self.index * self.tree.nb_datasets, self.tree.nb_datasets))
+
+    def dataset_queries(self):
+        tree = self.tree
+        bounds = tree.int64s('queries', self.index * tree.nb_datasets, tree.nb_datasets + 1)
+        queries = []
+        for d in range(tree.nb_datasets):
+            queries.append([(tree.string(tree.int32('query_name', q)), tree.int64('query_pos', q)) for q in xrange(bounds[d], bounds[d + 1])])
+        return queries
+
+    def has_rank(self):
+        return self.tree.int32('rank', self.index) != 0
+
+    def has_childs(self):
+        return self.tree.int32('nb_childs', self.index) > 0
+
+    def has_one_child(self):
+        return self.tree.int32('nb_childs', self.index) == 1
+
+    def has_queries(self):
+        tree = self.tree
+        start = self.index * tree.nb_datasets
+        return tree.int64('queries', start) != tree.int64('queries', start + tree.nb_datasets)
+
+    def get_child(self, child):
+        for c in self.childs:
+            if c.name == child:
+                return c
+        return None
+
+    def nb_nodes(self):
+        if self.index == 0:
+            return self.tree.nb_nodes
+        nb = 0
+        stack = [self]
+        while stack:
+            taxon = stack.pop()
+            nb += 1
+            stack.extend(taxon.childs)
+        return nb
+
+
+def load_tree(path):
+    """
+    load_tree(path) --> root FileTaxon of the tree file written by dump_tree
+    """
+    return TreeFile(path).root()
+
+
 # #################### Krona
 
 
 class ElementXML(object):
+    # lines kept before a write
+    BUFFER_LINES = 4096
 
-    def __init__(self, outfh=None, indent=None):
+    def __init__(self, outfh=None, indent=None, pretty=True):
+        """
+        Elements are buffered, flush() writes them. Without pretty, neither
+        indentation nor line breaks.
+        """
         self.outfh = outfh
         self.indent = indent  # xml file indentation
+        self.pretty = pretty
+        if pretty:
+            self.eol = '\n'
+        else:
+            self.eol = ''
+        self.buffer = []
+
+    def write_line(self, line):
+        self.buffer.append(self.space() + line + self.eol)
+        if len(self.buffer) >= self.BUFFER_LINES:
+            self.flush()
+
+    def flush(self):
+        self.outfh.write(''.join(self.buffer))
+        del self.buffer[:]
 
     def start_elem(self, element, attr=''):
         # <element attributes>
-        print >>self.outfh, '%s<%s%s>' % (self.space(), element, attr)
+        self.write_line('<%s%s>' % (element, attr))
 
     def end_elem(self, element):
         # </element>
-        print >>self.outfh, '%s</%s>' % (self.space(), element)
+        self.write_line('</%s>' % element)
 
     def complete_elem(self, element, value, attr=''):
         # <element attributes>value</element>
         if value:
-            print >>self.outfh, '%s<%s%s>%s</%s>' % (self.space(), element, attr, self.html_str(value), element)
+            self.write_line('<%s%s>%s</%s>' % (element, attr, self.html_str(value), element))
 
 #     def newLine(self):
 #         print >>self.outfh, ''
@@ -139,21 +918,25 @@ class ElementXML(object):
         return self.indent
 
     def space(self):
-        return '  ' * self.indent
+        if self.pretty:
+            return '  ' * self.indent
+        return ''
 
     def html_str(self, value):
         if isinstance(value, str):
             # value = value.replace('&', '&amp;')
-            value = value.replace('>', '&gt;')
-            value = value.replace('<', '&lt;')
+            if '>' in value:
+                value = value.replace('>', '&gt;')
+            if '<' in value:
+                value = value.replace('<', '&lt;')
             return value
         else:
             return str(value)
 
 
 class KronaDTD (ElementXML):
-    def __init__(self, outfh=None, indent=None, collapse='true', key='true'):
-        ElementXML.__init__(self, outfh=outfh, indent=indent)
+    def __init__(self, outfh=None, indent=None, collapse='true', key='true', pretty=True):
+        ElementXML.__init__(self, outfh=outfh, indent=indent, pretty=pretty)
         self.elems_attributes = {'krona': {'collapse': collapse, 'key': key},
                                  'attributes': {'magnitude': 'reads'},
                                  }
@@ -195,6 +978,9 @@ class KronaDTD (ElementXML):
         # </krona>
         self.decrease_indent()
         self.end_elem('krona')
+        if not self.pretty:
+            self.buffer.append('\n')
+        self.flush()
 
     def color(self, color_values):
         # <color attribute="..." valueStart="..." valueEnd="..." hueStart="..." hueEnd="..." ...></color>
@@ -229,24 +1015,45 @@ class KronaDTD (ElementXML):
         self.decrease_indent()
         self.end_elem('attributes')
 
-    def node(self, child_nodes):  # taxon
+    def node(self, taxon):
         # <node name='' href=''></node>
         # node_attributes={'name:'','href':''}
-        node_attributes, rankNbRead_values, query_list_values, child_nodes = self._to_krona_node(child_nodes)
-        self.start_elem('node', self._attr2str(node_attributes))
-        self.increase_indent()
-        # <sample_attr_1>
-        # rankNbRead_values = [(name, [(v1,href),(v,href)...])] plusieurs val, si plusieurs dataset
-        for san, sav in rankNbRead_values:
-            self.sample_attr(san, sav)
-        # <sample_list_1>
-
-        for c in child_nodes:
-            self.node(c)
-        for sln, slv in query_list_values:
-            self.sample_list(sln, slv)
-        self.decrease_indent()
-        self.end_elem('node')
+        # Depth first, with an explicit stack of the taxons to write and of the
+        # (query_list_values,) ends of the open nodes. The lines of
+        # start_elem, sample_attr, ... are built here, one call by node.
+        eol = self.eol
+        html_str = self.html_str
+        attr2str = self._attr2str
+        buffer = self.buffer
+        stack = [taxon]
+        while stack:
+            taxon = stack.pop()
+            if isinstance(taxon, tuple):
+                # <sample_list_1>
+                for sln, slv in taxon[0]:
+                    self.sample_list(sln, slv)
+                self.decrease_indent()
+                self.end_elem('node')
+                continue
+            node_attributes, rankNbRead_values, query_list_values, child_nodes = self._to_krona_node(taxon)
+            space = self.space()
+            buffer.append('%s<node%s>%s' % (space, attr2str(node_attributes), eol))
+            # <sample_attr_1>
+            # rankNbRead_values = [(name, [(v1,href),(v,href)...])] plusieurs val, si plusieurs dataset
+            space1 = self.pretty and space + '  ' or ''
+            space2 = self.pretty and space + '    ' or ''
+            for san, sav in rankNbRead_values:
+                if sav:
+                    buffer.append('%s<%s>%s' % (space1, san, eol))
+                    for vl, av in sav:
+                        if vl:
+                            buffer.append('%s<val%s>%s</val>%s' % (space2, attr2str(av), html_str(vl), eol))
+                    buffer.append('%s</%s>%s' % (space1, san, eol))
+            self.increase_indent()
+            if len(buffer) >= self.BUFFER_LINES:
+                self.flush()
+            stack.append((query_list_values,))
+            stack.extend(reversed(child_nodes))
 
     def _to_krona_node(self, taxon):
         node_attributes = {'name': taxon.name}
@@ -259,13 +1066,14 @@ class KronaDTD (ElementXML):
         # for c in taxon.childs:
         #    self.toKronaNode(c )
 
-        read_values = ('reads', [(taxon.nb_querys, {})])
+        # one val by dataset (str: 0 is written too)
+        read_values = ('reads', [(str(nb_querys), {}) for nb_querys in taxon.dataset_counts()])
         # blast_values = ('blast',[(taxon.nb_querys, {})])
         list_values_qry = []
         # list_values_blast = []
         if taxon.has_queries():
-            for query in taxon.queriesS:
-                list_values_qry.append(("%-40s\t%s" % (query[0], query[1]), {}))
+            for queries in taxon.dataset_queries():
+                list_values_qry.append([("%-40s\t%s" % (query[0], query[1]), {}) for query in queries])
                 # list_values_blast.append((query[1], {}))
         # list_values = [('read_members',list_values_qry), ('blast_members',list_values_blast)]
         query_list_values = [('read_members', list_values_qry)]
@@ -288,44 +1096,47 @@ class KronaDTD (ElementXML):
         self.complete_elem('val', value, self._attr2str(val_attribute))
 
     def sample_list(self, sple_list_name, sple_list_values):
-        if sple_list_values:
+        # sple_list_values: [[(val, attribute), ...] of each dataset]
+        if [vals for vals in sple_list_values if vals]:
             self.start_elem(sple_list_name)
             self.increase_indent()
-            self.start_elem('vals')
-            self.increase_indent()
-            for vl, av in sple_list_values:
+            for vals in sple_list_values:
+                self.start_elem('vals')
                 # <val herf=''>7</val>
-                self.val(vl, av)
-            self.decrease_indent()
-            self.end_elem('vals')
+                space = self.pretty and self.space() + '  ' or ''
+                self.buffer.extend(['%s<val%s>%s</val>%s' % (space, self._attr2str(av), self.html_str(vl), self.eol) for vl, av in vals if vl])
+                self.end_elem('vals')
             self.decrease_indent()
             self.end_elem(sple_list_name)
 
     def _attr2str(self, attrs):
-        s = ''
-        for k, v in attrs.items():
-            if v:
-                s += ' %s="%s"' % (k, str(v))
-        return s
+        return ''.join([' %s="%s"' % (k, str(v)) for k, v in attrs.items() if v])
 
     def _setAttr(self, elem, attr, value):
         self.attributes[elem][attr] = value
 
 
 class Krona (KronaDTD):
-    def __init__(self,  outfh=None, file_name=None, taxo_tree=None, collapse='false', key='true'):
+    def __init__(self,  outfh=None, file_name=None, taxo_tree=None, collapse='false', key='true', pretty=True):
         """
         * Object for translating one treeobject into one Krona xml file.
+        * file_name: dataset name, or list of the dataset names of a
+          datasets_tree.
+        * pretty: indented xml, one element by line.
         """
-        KronaDTD.__init__(self, outfh=outfh, indent=0, collapse=collapse, key=key)
+        KronaDTD.__init__(self, outfh=outfh, indent=0, collapse=collapse, key=key, pretty=pretty)
         self.taxo_tree = taxo_tree
         self.file_name = file_name
+        if isinstance(file_name, list):
+            self.dataset_names = file_name
+        else:
+            self.dataset_names = [file_name]
 
     def krona(self):
         self.indent = 0
         # xmlKrona = KronaDTD(self.outfh, self.indent)
         self.start_krona()
-        self.datasets([self.file_name])
+        self.datasets(self.dataset_names)
         # color_values = {'attribute':'', 'default':'true'}
         # xmlKrona.color(color_values)
         attributes_values = {'sample_attr': [('reads', {'display': 'Nb of reads', 'listAll': 'read_members'}),
@@ -346,7 +1157,7 @@ class Krona (KronaDTD):
         # xmlKrona = KronaDTD(self.outfh, self.indent, self.krona_url, self.krona_local)
         self.header_html(krona_jsfh)
         self.start_krona()
-        self.datasets([self.file_name])
+        self.datasets(self.dataset_names)
         # color_values = {'attribute':'', 'default':'true'}
         # xmlKrona.color(color_values)
         attributes_values = {'sample_attr': [('reads', {'display': 'Nb of reads', 'listAll': 'read_members'}),
@@ -375,76 +1186,55 @@ class ElementJSON(object):
     <e> <a>text</a> <a>text</a> </e> "e": {"a": ["text", "text"]}
     <e> text <a>text</a> </e>        "e": {"#text": "text", "a": "text"}
     """
+    # characters kept before a write
+    BUFFER_SIZE = 1 << 16
 
-    def __init__(self, outfh=None, indent=None):
+    def __init__(self, outfh=None, indent=None, pretty=True):
+        """
+        Values are encoded by the json module and buffered, flush() writes
+        them. Without pretty, no white space between the tokens.
+        """
         self.outfh = outfh
-        self.indent = indent  # xml file indentation
+        self.indent = indent  # json file indentation
+        self.pretty = pretty
+        if pretty:
+            separators = (', ', ': ')
+        else:
+            separators = (',', ':')
+        self.encoder = json.JSONEncoder(separators=separators)
+        # names which are not utf-8
+        self.latin1_encoder = json.JSONEncoder(separators=separators, encoding='latin-1')
+        self.colon = separators[1]
+        self.coma = separators[0]
+        self.buffer = []
+        self.size = 0
+
+    def write(self, text):
+        self.buffer.append(text)
+        self.size += len(text)
+        if self.size >= self.BUFFER_SIZE:
+            self.flush()
+
+    def flush(self):
+        self.outfh.write(''.join(self.buffer))
+        del self.buffer[:]
+        self.size = 0
+
+    def encode(self, value):
+        try:
+            return self.encoder.encode(value)
+        except UnicodeDecodeError:
+            return self.latin1_encoder.encode(value)
+
+    def member(self, element, value):
+        # "e": value
+        return self.encode(element) + self.colon + self.encode(value)
 
     def space(self):
+        if self.pretty:
+            return '\n' + '  ' * self.indent
         return ''
 
-    def start_brace(self):
-        # {
-        print >>self.outfh, '{',
-
-    def end_brace(self, coma=''):
-        # }
-        print >>self.outfh, '}%s' % (coma),
-
-    def start_element(self, element):
-        # element:
-        print >>self.outfh, '"%s":' % (element),
-
-#     def end_element(self, coma=''):
-#         # element:
-#         print >>self.outfh, '%s' % (coma),
-
-    def elem_attributes(self, k_attr={}, coma=''):
-        # krona = {'collapse':'true', 'key':'true'}
-        # 'collapse':'true', 'key':'true',
-        st = ''
-        for k, v in k_attr.items():
-            st += '"%s":"%s",' % (k, v)
-        print >>self.outfh, st[:-1] + coma,
-
-    def complete_simple_element(self, element, value, coma=''):
-        # <e>text</e>  ==>   "e": "text"
-        print >>self.outfh, '"%s":%s%s' % (element, value, coma),
-
-    def complete_simple_element_str(self, element, value, coma=''):
-        # <e>text</e>  ==>   "e": "text"
-        return '"%s":%s%s' % (element, value, coma)
-
-    def complete_simple_dbl_quote_element(self, element, value, coma=''):
-        # <e>text</e>  ==>   "e": "text"
-        print >>self.outfh, '"%s":"%s"%s' % (element, value, coma),
-
-    def complete_simple_dbl_quote_element_str(self, element, value, coma=''):
-        # <e>text</e>  ==>   "e": "text"
-        return '"%s":"%s"%s' % (element, value, coma)
-
-    def complete_complex_brace_element(self, element, value_str, coma=''):
-        # <e>text</e>  ==>   "e": "text"
-        print >>self.outfh, '"%s":{%s}%s' % (element, value_str, coma),
-
-    def complete_complex_brace_element_str(self, element, value_str, coma=''):
-        # <e>text</e>  ==>   "e": "text"
-        return '"%s":{%s}%s' % (element, value_str, coma),
-
-    def complete_element_with_attr(self, element, value, attrs={}, coma=''):
-        # <e attr="value">text</e>   ==>   "e": {"attr": "value", "#text": "text"}
-        print >>self.outfh, '"%s":{' % (element),
-        self.elem_attributes(self, attrs)
-        print >>self.outfh, '"__text":"%s"' % (value),
-        print >>self.outfh, '}%s' % (coma),
-
-    def start_list_element(self, element):
-        # element: [
-        print >>self.outfh, '"%s":[' % (element),
-
-    def end_list_element(self, coma=''):
-        print >>self.outfh, ']%s' % (coma),
-
     def increase_indent(self):
         self.indent += 1
 
@@ -457,9 +1247,9 @@ class ElementJSON(object):
 
 class KronaJSONDTD (ElementJSON):
 
-    def __init__(self, outfh=None, indent=None, collapse='true', key='true'):
-        ElementJSON.__init__(self, outfh=outfh, indent=indent)
-        self.elems_attributes = {'krona': {'_collapse': collapse, '_key': key},
+    def __init__(self, outfh=None, indent=None, collapse='true', key='true', pretty=True):
+        ElementJSON.__init__(self, outfh=outfh, indent=indent, pretty=pretty)
+        self.elems_attributes = {'krona': collections.OrderedDict([('_key', key), ('_collapse', collapse)]),
                                  'attributes': {'_magnitude': 'reads'},
                                  }
 
@@ -513,135 +1303,78 @@ class KronaJSONDTD (ElementJSON):
         """
 
     def start_krona_with_attr(self):
-        # <krona collapse='true' key = 'true'...> ==> {krona : {'collapse':'true', 'key':'true',
-        # krona={'collapse':'true', 'key':'true'}
-        self.start_brace()
-        self.start_element('krona')
-        self.start_brace()
-        if 'krona' in self.elems_attributes:
-            self.elem_attributes(self.elems_attributes['krona'], coma=',')
+        # <krona collapse='true' key = 'true'...> ==> {"krona": {"_collapse": "true", "_key": "true",
+        self.write('{' + self.encode('krona') + self.colon + '{')
+        for k, v in self.elems_attributes['krona'].items():
+            self.write(self.member(k, v) + self.coma)
 
     def end_krona(self):
-        # </krona> ==>}}
-        self.end_brace()
-        self.end_brace()
+        # </krona> ==> }}
+        self.write('}}\n')
+        self.flush()
 
     def datasets(self, datasets_values):
-        # datasets_values:[set1, set2, ...]
         # <datasets><dataset>text1</dataset><dataset>text2</datatset></datasets>
-        # <e> <a>text1</a> <a>text2</a> </e> ==> "e": {"a": ["text1", "text2"]}
-        self.complete_simple_dbl_quote_element('dataset', datasets_values, coma=',')
+        # ==> "dataset": "text1" (one dataset) or "dataset": ["text1", "text2"]
+        if len(datasets_values) == 1:
+            datasets_values = datasets_values[0]
+        self.write(self.member('dataset', datasets_values) + self.coma)
 
     def attributes(self):
-        # <attributes magnitude="reads"> ... </attributes> ==> attributes: {magnitude: "reads" ,
-        # 'attributes':{'magnitude': 'reads'},
-        self.start_element('attributes')
-        self.start_brace()
-        self.elem_attributes(self.elems_attributes['attributes'], coma=',')
-
-        # <attribute display="Nb of reads" listAll="read_members">reads</attribute> ==> attribute: [{display:"Nb of reads" , listAll:"read_members", #text:"reads"},
-        # <attribute mono="true" display="Rank">rank</attribute>                    ==>   {"mono":"true", "display":"Rank", #text : "rank"}],
-        self.start_list_element('attribute')
-        # ('reads', {'display':'Nb of reads', 'listAll':'read_members'})
-        self.start_brace()
-        self.elem_attributes({'_display': 'Nb of reads', '_listAll': 'read_members'}, coma=',')
-        print >>self.outfh, '"__text":"%s"' % ('reads'),
-        self.end_brace(coma=',')
-
-        # ('rank', {'display':'Rank', 'mono':'true'})
-        self.start_brace()
-        self.elem_attributes({'_display': 'Rank', '_mono': 'true'}, coma=',')
-        print >>self.outfh, '"__text":"%s"' % ('rank'),
-        self.end_brace()
-
-        self.end_list_element(coma=',')
-
-        # <list>read_members</list> ==> list:  read_members
-        self.complete_simple_dbl_quote_element('list', 'read_members')
-
-        # </attributes> ==>}}
-        self.end_brace(coma=',')
-
-    def node(self, node, coma=','):  # taxon
-        node_attributes, nb_reads, rank, read_members, child_nodes = self._to_krona_node(node)
-        # node_attributes={'name:'','href':''}
-        # <node name='' href=''> ... </node> ==> ==> node: {name: "" , href: "",
-
-        self.start_list_element('node')
-
-        self.start_brace()
-        self.elem_attributes(node_attributes, ',')
-
-        # <sample_attr_1> ==> sample_attr_1:
-
-        self.complete_complex_brace_element('reads',  self.complete_simple_dbl_quote_element_str('val',  nb_reads, ''), ',')
-        if rank:
-            self.complete_complex_brace_element('rank',  self.complete_simple_dbl_quote_element_str('val',  rank, ''), ',')
-
-        if len(child_nodes) > 1:
-            self.start_list_element('node')
-            for c in child_nodes[:-1]:
-                self.node_without_node(c, ',')
-                print >>self.outfh, ',',
-            self.node_without_node(child_nodes[-1], '')
-            self.end_list_element()
-        elif child_nodes:
+        # <attributes magnitude="reads">
+        #   <attribute display="Nb of reads" listAll="read_members">reads</attribute>
+        #   <attribute mono="true" display="Rank">rank</attribute>
+        #   <list>read_members</list>
+        # </attributes>
+        # ==> "attributes": {"_magnitude": "reads", "attribute": [{"_listAll": "read_members", "_display": "Nb of reads", "__text": "reads"},
+        #                                                        {"_mono": "true", "_display": "Rank", "__text": "rank"}],
+        #                    "list": "read_members"}
+        attributes = collections.OrderedDict(self.elems_attributes['attributes'].items())
+        attributes['attribute'] = [collections.OrderedDict([('_listAll', 'read_members'), ('_display', 'Nb of reads'), ('__text', 'reads')]),
+                                   collections.OrderedDict([('_mono', 'true'), ('_display', 'Rank'), ('__text', 'rank')])]
+        attributes['list'] = 'read_members'
+        self.write(self.member('attributes', attributes) + self.coma)
+
+    def node(self, taxon):
+        # <node name=''> <reads>..</reads> <rank>..</rank> <node>..</node> <read_members>..</read_members> </node>
+        # ==> "node": [{"_name": "", "reads": {"val": ""}, "rank": {"val": ""}, "node": [...], "read_members": {"vals": {"val": [...]}}}]
+        # Depth first, one chunk by node, with an explicit stack of the
+        # (taxon, first of its brothers) to write and of the ends of the open
+        # nodes.
+        self.write(self.encode('node') + self.colon + '[')
+        self.increase_indent()
+        stack = [(taxon, True)]
+        while stack:
+            taxon, first = stack.pop()
+            if taxon is None:
+                # end of a node with childs: first is its read_members
+                self.decrease_indent()
+                self.write(']' + first + '}')
+                continue
+            node_attributes, nb_reads, rank, read_members, child_nodes = self._to_krona_node(taxon)
+            chunk = ['{' + self.member('_name', node_attributes['_name']),
+                     self.member('reads', {'val': nb_reads})]
+            if rank:
+                chunk.append(self.member('rank', {'val': rank}))
             if read_members:
-                coma = ','
+                read_members = self.coma + self.member('read_members', {'vals': read_members})
             else:
-                coma = ','  # coma =''
-            self.node(child_nodes[0], coma)
-            # coma = ''
-        # <sample_list_1>
-        # read_members = {'vals':{'vals':[a,b,c,d]}}
-
-#        if read_members:
-#            self.start_list_element('read_members')
-#            for info_dict in read_members[:-1]:
-#                self.elem_attributes(info_dict, '')
-#            self.elem_attributes(read_members[0])
-#            self.end_list_element()
-
-        if read_members:
-            self.start_element('read_members')
-            self.start_brace()
-            self.complete_complex_brace_element('vals',  self.complete_simple_element_str('val',  read_members, ''), '')
-            self.end_brace(coma=',')
-
-        self.end_brace()
-        self.end_list_element(coma)
-
-    def node_without_node(self, node,  coma=','):  # taxon
-        node_attributes, nb_reads, rank, read_members, child_nodes = self._to_krona_node(node)
-        # node_attributes={'name:'','href':''}
-        # <node name='' href=''> ... </node> ==> ==> node: {name: "" , href: "",
-
-        self.start_brace()
-        self.elem_attributes(node_attributes, ',')
-
-        # <sample_attr_1> ==> sample_attr_1:
-        self.complete_complex_brace_element('reads',  self.complete_simple_dbl_quote_element_str('val',  nb_reads, ''), ',')
-        if rank:
-            self.complete_complex_brace_element('rank',  self.complete_simple_dbl_quote_element_str('val',  rank, ''), ',')
-
-        if len(child_nodes) > 1:
-            self.start_list_element('node')
-            for c in child_nodes[:-1]:
-                self.node_without_node(c, ',')
-                print >>self.outfh, ',',
-            self.node_without_node(child_nodes[-1], '')
-            self.end_list_element()
-        elif child_nodes:
-            self.node(child_nodes[0], '')
-        # <sample_list_1>
-        # read_members = {'vals':{'vals':[a,b,c,d]}}
-        if read_members:
-            self.start_element('read_members')
-            self.start_brace()
-            self.complete_complex_brace_element('vals',  self.complete_simple_element_str('val',  read_members, ''), '')
-            self.end_brace(coma=',')
-
-        self.end_brace()
+                read_members = ''
+            if first:
+                space = self.space()
+            else:
+                space = self.coma.strip() + self.space()
+            if child_nodes:
+                chunk.append(self.encode('node') + self.colon + '[')
+                self.write(space + self.coma.join(chunk))
+                self.increase_indent()
+                stack.append((None, read_members))
+                stack.extend([(c, False) for c in reversed(child_nodes[1:])])
+                stack.append((child_nodes[0], True))
+            else:
+                self.write(space + self.coma.join(chunk) + read_members + '}')
+        self.decrease_indent()
+        self.write(']')
 
     def _to_krona_node(self, taxon):
         node_attributes = {'_name': taxon.name.replace(':', '_').replace('"', '_')}
@@ -651,32 +1384,40 @@ class KronaJSONDTD (ElementJSON):
             rank_values = ''
 
         child_nodes = taxon.childs
-        # for c in taxon.childs:
-        #    self.toKronaNode(c )
-
-        list_values_qry = []
+        # one val by dataset
+        nb_reads = [str(nb_querys) for nb_querys in taxon.dataset_counts()]
+        read_members = []
         if taxon.has_queries():
-            for query in taxon.queriesS:
-                list_values_qry.append(query[0].replace(':', '_').replace('"', '_') + '\t%s' % query[1])
-                # list_values_qry.append({'name':query[0].replace(':', '_').replace('"', '_') + '\t%s' % query[1]})
-        read_members = list_values_qry
+            for queries in taxon.dataset_queries():
+                read_members.append({'val': [query[0].replace(':', '_').replace('"', '_') + '\t%s' % query[1] for query in queries]})
+        if len(nb_reads) == 1:
+            nb_reads = nb_reads[0]
+            if read_members:
+                read_members = read_members[0]
 
-        return node_attributes, taxon.nb_querys, rank_values, read_members, child_nodes
+        return node_attributes, nb_reads, rank_values, read_members, child_nodes
 
 
 class KronaJSON(KronaJSONDTD):
-    def __init__(self,  outfh=None, file_name=None, taxo_tree=None, collapse='false', key='true'):
+    def __init__(self,  outfh=None, file_name=None, taxo_tree=None, collapse='false', key='true', pretty=True):
         """
-        * Object for translating one treeobject into one Krona xml file.
+        * Object for translating one treeobject into one Krona json file.
+        * file_name: dataset name, or list of the dataset names of a
+          datasets_tree.
+        * pretty: one node by line, indented.
         """
-        KronaJSONDTD.__init__(self, outfh=outfh, indent=0, collapse=collapse, key=key)
+        KronaJSONDTD.__init__(self, outfh=outfh, indent=0, collapse=collapse, key=key, pretty=pretty)
         self.taxo_tree = taxo_tree
         self.file_name = file_name
+        if isinstance(file_name, list):
+            self.dataset_names = file_name
+        else:
+            self.dataset_names = [file_name]
 
     def krona(self):
         self.indent = 0
         self.start_krona_with_attr()
-        self.datasets(self.file_name)
+        self.datasets(self.dataset_names)
         self.attributes()
         self.node(self.taxo_tree)
         self.end_krona()
@@ -686,7 +1427,7 @@ class KronaJSON(KronaJSONDTD):
         self.header_html(krona_jsfh)
         self.indent = 0
         self.start_krona_with_attr()
-        self.datasets(self.file_name)
+        self.datasets(self.dataset_names)
         self.attributes()
         self.node(self.taxo_tree)
         self.end_krona()
@@ -0,0 +1,699 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+# Corinne Maufrais
+# Institut Pasteur, Centre d'informatique pour les biologistes
+# corinne.maufrais@pasteur.fr
+#
+# version 2.1
+
+import os
+import sys
+import bz2
+import zlib
+import mmap
+import Queue
+import struct
+import atexit
+import argparse
+import threading
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+class TaxoIOError:
+    def __init__(self, err):
+        self.err = err
+
+    def __repr__(self):
+        return "[TaxoIOError] " + self.err
+
+    __str__ = __repr__
+
+
+##############################################################################
+#
+#            Compression detection
+#
+##############################################################################
+
+MAGIC = [('gzip', '\x1f\x8b'),
+         ('bz2', 'BZh'),
+         ('xz', '\xfd7zXZ\x00'),
+         ('zstd', '\x28\xb5\x2f\xfd'),
+         ]
+
+EXTENSIONS = {'.gz': 'bgzf',
+              '.bgz': 'bgzf',
+              '.bz2': 'bz2',
+              '.xz': 'xz',
+              '.zst': 'zstd',
+              }
+
+CHUNK_SIZE = 1024 * 1024
+QUEUE_DEPTH = 8
+
+
+def compression(path):
+    """
+    compression(path) --> None, 'bgzf', 'gzip', 'bz2', 'xz' or 'zstd'
+
+    Compression of the path file, detected by its first bytes.
+    """
+    fh = open(path, 'rb')
+    try:
+        head = fh.read(18)
+    finally:
+        fh.close()
+    for name, magic in MAGIC:
+        if head.startswith(magic):
+            if name == 'gzip' and is_bgzf_header(head):
+                return 'bgzf'
+            return name
+    return None
+
+
+def compression_of_name(path):
+    """
+    Compression expected for an output file, from its extension.
+    """
+    return EXTENSIONS.get(os.path.splitext(path)[1].lower())
+
+
+def check_codec(name):
+    if name == 'xz' and lzma is None:
+        raise TaxoIOError("xz (de)compression needs the lzma module (backports.lzma with python 2)")
+    if name == 'zstd' and zstandard is None:
+        raise TaxoIOError("zstd (de)compression needs the zstandard module")
+
+
+##############################################################################
+#
+#            Streams (de)compressed in a thread
+#
+##############################################################################
+
+
+def _new_decompressor(name):
+    if name in ['gzip', 'bgzf']:
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    elif name == 'bz2':
+        return bz2.BZ2Decompressor()
+    elif name == 'xz':
+        return lzma.LZMADecompressor()
+    elif name == 'zstd':
+        return zstandard.ZstdDecompressor().decompressobj()
+
+
+def iter_decompress(fh, name, bufsize=CHUNK_SIZE):
+    """
+    Yield the decompressed chunks of fh. Concatenated streams (gzip members,
+    BGZF blocks, pbzip2 streams, ...) are read one after the other.
+    """
+    decompressor = _new_decompressor(name)
+    data = fh.read(bufsize)
+    while data:
+        try:
+            out = decompressor.decompress(data)
+        except EOFError:
+            # the previous stream ended exactly at the end of a chunk
+            decompressor = _new_decompressor(name)
+            continue
+        if out:
+            yield out
+        data = getattr(decompressor, 'unused_data', '')
+        if data:
+            decompressor = _new_decompressor(name)
+        else:
+            data = fh.read(bufsize)
+
+
+class _Failure(object):
+    def __init__(self, exc_info):
+        self.exc_info = exc_info
+
+
+class DecompressedReader(object):
+
+    def __init__(self, path, name, depth=QUEUE_DEPTH):
+        """
+        r = DecompressedReader(path, 'gzip')
+
+        Read-only file object on the decompressed content of path. The
+        decompression runs in a background thread, at most depth chunks
+        ahead of the reader.
+        """
+        check_codec(name)
+        self.name = path
+        self.compression = name
+        self.raw = open(path, 'rb')
+        self.queue = Queue.Queue(depth)
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+        self.stopped = False
+        self.thread = threading.Thread(target=self._run, name='decompress')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self):
+        try:
+            for chunk in iter_decompress(self.raw, self.compression):
+                if self.stopped:
+                    break
+                self.queue.put(chunk)
+            self.queue.put(None)
+        except BaseException:
+            self.queue.put(_Failure(sys.exc_info()))
+
+    def _next_chunk(self):
+        if self.eof:
+            return None
+        chunk = self.queue.get()
+        if chunk is None:
+            self.eof = True
+        elif isinstance(chunk, _Failure):
+            self.eof = True
+            raise IOError("%s: decompression error, %s" % (self.name, chunk.exc_info[1]))
+        return chunk
+
+    def readline(self):
+        while True:
+            end = self.buf.find('\n', self.pos)
+            if end >= 0:
+                line = self.buf[self.pos:end + 1]
+                self.pos = end + 1
+                return line
+            chunk = self._next_chunk()
+            if chunk is None:
+                line = self.buf[self.pos:]
+                self.buf = ''
+                self.pos = 0
+                return line
+            self.buf = self.buf[self.pos:] + chunk
+            self.pos = 0
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buf) - self.pos < size:
+            chunk = self._next_chunk()
+            if chunk is None:
+                break
+            self.buf = self.buf[self.pos:] + chunk
+            self.pos = 0
+        if size < 0:
+            size = len(self.buf) - self.pos
+        data = self.buf[self.pos:self.pos + size]
+        self.pos += len(data)
+        return data
+
+    def __iter__(self):
+        return iter(self.readline, '')
+
+    def close(self):
+        # closed before the end: stop the thread before closing its file
+        self.stopped = True
+        while self.thread.is_alive():
+            try:
+                self.queue.get(timeout=0.1)
+            except Queue.Empty:
+                pass
+        self.raw.close()
+
+
+class CompressedWriter(object):
+
+    def __init__(self, path, name, level=6, depth=QUEUE_DEPTH):
+        """
+        w = CompressedWriter(path, 'bz2')
+
+        Write-only file object compressing in path. The compression runs in a
+        background thread. Closed at exit if not closed before.
+        """
+        check_codec(name)
+        self.name = path
+        self.compression = name
+        self.raw = open(path, 'wb')
+        if name == 'bgzf':
+            self.compressor = BgzfCompressor(level)
+        elif name == 'bz2':
+            self.compressor = bz2.BZ2Compressor(max(level, 1))
+        elif name == 'xz':
+            self.compressor = lzma.LZMACompressor(preset=level)
+        elif name == 'zstd':
+            self.compressor = zstandard.ZstdCompressor(level=level).compressobj()
+        self.buf = []
+        self.size = 0
+        self.error = None
+        self.closed = False
+        self.queue = Queue.Queue(depth)
+        self.thread = threading.Thread(target=self._run, name='compress')
+        self.thread.daemon = True
+        self.thread.start()
+        atexit.register(self.close)
+
+    def _run(self):
+        while True:
+            data = self.queue.get()
+            if self.error:
+                if data is None:
+                    break
+                continue
+            try:
+                if data is None:
+                    self.raw.write(self.compressor.flush())
+                    break
+                self.raw.write(self.compressor.compress(data))
+            except BaseException, err:
+                self.error = err
+
+    def _check(self):
+        if self.error:
+            raise IOError("%s: compression error, %s" % (self.name, self.error))
+
+    def write(self, data):
+        self.buf.append(data)
+        self.size += len(data)
+        if self.size >= CHUNK_SIZE:
+            self.flush()
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def flush(self):
+        self._check()
+        if self.buf:
+            self.queue.put(''.join(self.buf))
+            self.buf = []
+            self.size = 0
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        if self.buf:
+            self.queue.put(''.join(self.buf))
+            self.buf = []
+        self.queue.put(None)
+        self.thread.join()
+        self.raw.close()
+        self._check()
+
+
+##############################################################################
+#
+#            BGZF: gzip compatible blocks of at most 64 KB, seekable
+#
+#  A virtual offset is (block file offset << 16) | offset in the block data,
+#  as in samtools/htslib.
+##############################################################################
+
+BGZF_BLOCK_DATA = 0xff00
+BGZF_MAX_BLOCK = 0x10000
+BGZF_EOF = '\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00\x1b\x00\x03\x00\x00\x00\x00\x00\x00\x00\x00\x00'
+
+
+def is_bgzf_header(head):
+    return len(head) >= 16 and head[:4] == '\x1f\x8b\x08\x04' and head[12:14] == 'BC'
+
+
+def bgzf_block(data, level=6):
+    """
+    bgzf_block(data) --> compressed BGZF block(s) of data
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    cdata = compressor.compress(data) + compressor.flush()
+    bsize = 18 + len(cdata) + 8
+    if bsize > BGZF_MAX_BLOCK:
+        # incompressible data
+        half = len(data) / 2
+        return bgzf_block(data[:half], level) + bgzf_block(data[half:], level)
+    header = '\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff' + struct.pack('<H2sHH', 6, 'BC', 2, bsize - 1)
+    return header + cdata + struct.pack('<II', zlib.crc32(data) & 0xffffffff, len(data))
+
+
+class BgzfCompressor(object):
+    """
+    compress()/flush() interface of the zlib compressors, writing BGZF blocks.
+    """
+
+    def __init__(self, level=6):
+        self.level = level
+        self.rest = ''
+
+    def compress(self, data):
+        data = self.rest + data
+        nb = len(data) / BGZF_BLOCK_DATA
+        blocks = [bgzf_block(data[i * BGZF_BLOCK_DATA:(i + 1) * BGZF_BLOCK_DATA], self.level) for i in xrange(nb)]
+        self.rest = data[nb * BGZF_BLOCK_DATA:]
+        return ''.join(blocks)
+
+    def flush(self):
+        data = ''
+        if self.rest:
+            data = bgzf_block(self.rest, self.level)
+            self.rest = ''
+        return data + BGZF_EOF
+
+
+class BgzfReader(object):
+
+    def __init__(self, path):
+        """
+        r = BgzfReader(path)
+
+        Read-only file object on a BGZF file, with tell()/seek() on virtual
+        offsets.
+        """
+        self.name = path
+        self.compression = 'bgzf'
+        self.raw = open(path, 'rb')
+        self._load_block(0)
+
+    def _load_block(self, start):
+        self.raw.seek(start)
+        header = self.raw.read(12)
+        if not header:
+            self.block_start = start
+            self.next_block = start
+            self.data = ''
+            self.pos = 0
+            return False
+        if len(header) < 12 or header[:4] != '\x1f\x8b\x08\x04':
+            raise IOError("%s: not a BGZF block at offset %d" % (self.name, start))
+        xlen = struct.unpack('<H', header[10:12])[0]
+        extra = self.raw.read(xlen)
+        bsize = None
+        i = 0
+        while i + 4 <= xlen:
+            sid, slen = extra[i:i + 2], struct.unpack('<H', extra[i + 2:i + 4])[0]
+            if sid == 'BC':
+                bsize = struct.unpack('<H', extra[i + 4:i + 6])[0] + 1
+            i += 4 + slen
+        if bsize is None:
+            raise IOError("%s: no BGZF block size at offset %d" % (self.name, start))
+        cdata = self.raw.read(bsize - 12 - xlen - 8)
+        crc, isize = struct.unpack('<II', self.raw.read(8))
+        data = zlib.decompress(cdata, -zlib.MAX_WBITS)
+        if len(data) != isize or zlib.crc32(data) & 0xffffffff != crc:
+            raise IOError("%s: corrupted BGZF block at offset %d" % (self.name, start))
+        self.block_start = start
+        self.next_block = start + bsize
+        self.data = data
+        self.pos = 0
+        return True
+
+    def tell(self):
+        if self.pos == len(self.data) and self.next_block != self.block_start:
+            return self.next_block << 16
+        return (self.block_start << 16) | self.pos
+
+    def seek(self, voffset, whence=0):
+        if whence != 0:
+            raise IOError("BGZF files are only seekable on virtual offsets")
+        start, pos = voffset >> 16, voffset & 0xffff
+        if start != self.block_start or not self.data:
+            self._load_block(start)
+        if pos > len(self.data):
+            raise IOError("%s: bad virtual offset %d" % (self.name, voffset))
+        self.pos = pos
+
+    def _next_block(self):
+        """
+        Load the block following the current one, False at the end of the file.
+        """
+        if self.next_block == self.block_start:
+            return False
+        return self._load_block(self.next_block)
+
+    def readline(self):
+        parts = []
+        while True:
+            end = self.data.find('\n', self.pos)
+            if end >= 0:
+                parts.append(self.data[self.pos:end + 1])
+                self.pos = end + 1
+                break
+            parts.append(self.data[self.pos:])
+            self.pos = len(self.data)
+            if not self._next_block():
+                break
+        return ''.join(parts)
+
+    def read(self, size=-1):
+        parts = []
+        while size != 0:
+            if self.pos == len(self.data):
+                if not self._next_block():
+                    break
+                continue
+            if size < 0:
+                part = self.data[self.pos:]
+            else:
+                part = self.data[self.pos:self.pos + size]
+                size -= len(part)
+            self.pos += len(part)
+            parts.append(part)
+        return ''.join(parts)
+
+    def __iter__(self):
+        return iter(self.readline, '')
+
+    def close(self):
+        self.raw.close()
+
+
+##############################################################################
+#
+#            Opening
+#
+##############################################################################
+
+
+def open_input(path, seekable=False):
+    """
+    open_input(path, seekable=False) --> file object
+
+    Plain files are opened as usual. gzip, bz2, xz and zstd files are
+    decompressed in a thread. With seekable=True (tell()/seek() needed), a
+    compressed file must be BGZF (bgzip, or .gz written by taxoptimizer).
+    With seekable=None, BGZF files are opened seekable and the other
+    compressed files are decompressed in a thread.
+    """
+    name = compression(path)
+    if name is None:
+        return open(path, 'r')
+    if seekable is None and name == 'bgzf':
+        return BgzfReader(path)
+    if seekable:
+        if name != 'bgzf':
+            raise TaxoIOError("%s: %s compressed files can't be read twice, recompress it with bgzip" % (path, name))
+        return BgzfReader(path)
+    return DecompressedReader(path, name)
+
+
+def open_output(path, name=None, level=6):
+    """
+    open_output(path) --> file object
+
+    The compression is given by the path extension (.gz: BGZF, .bz2, .xz,
+    .zst) if name is None.
+    """
+    if name is None:
+        name = compression_of_name(path)
+    if name is None:
+        return open(path, 'w')
+    return CompressedWriter(path, name, level)
+
+
+def seekable(fh):
+    """
+    True if fh supports tell() and seek().
+    """
+    try:
+        fh.tell()
+    except (IOError, AttributeError):
+        return False
+    return True
+
+
+class InputFileType(object):
+    """
+    argparse type opening an input with open_input.
+    """
+
+    def __init__(self, seekable=False):
+        self.seekable = seekable
+
+    def __call__(self, string):
+        if string == '-':
+            if self.seekable is True:
+                raise argparse.ArgumentTypeError("standard input can't be read twice")
+            return sys.stdin
+        try:
+            return open_input(string, self.seekable)
+        except IOError, err:
+            raise argparse.ArgumentTypeError("can't open '%s': %s" % (string, err))
+        except TaxoIOError, err:
+            raise argparse.ArgumentTypeError(err.err)
+
+
+class OutputFileType(object):
+    """
+    argparse type opening an output with open_output.
+    """
+
+    def __call__(self, string):
+        if string == '-':
+            return sys.stdout
+        try:
+            return open_output(string)
+        except IOError, err:
+            raise argparse.ArgumentTypeError("can't open '%s': %s" % (string, err))
+        except TaxoIOError, err:
+            raise argparse.ArgumentTypeError(err.err)
+
+
+##############################################################################
+#
+#            Lines at offsets
+#
+##############################################################################
+
+
+def lines_at(path, offsets):
+    """
+    Yield (offset, line) for the sorted, distinct offsets of line starts in
+    path: byte offsets of a plain file, read through mmap, virtual offsets of
+    a BGZF file, offsets in the decompressed content of the other compressed
+    files (decompressed once, reading forward). Offsets as recorded by
+    rankoptimizer (pos_line).
+    """
+    offsets = sorted(set(offsets))
+    name = compression(path)
+    if name is None:
+        fh = open(path, 'rb')
+        size = os.fstat(fh.fileno()).st_size
+        if not size:
+            fh.close()
+            if offsets:
+                raise TaxoIOError("%s: offset %d beyond the end of the file" % (path, offsets[0]))
+            return
+        mm = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            for offset in offsets:
+                if offset < 0 or offset >= size:
+                    raise TaxoIOError("%s: offset %d beyond the end of the file" % (path, offset))
+                if offset and mm[offset - 1] != '\n':
+                    raise TaxoIOError("%s: offset %d is not a line start" % (path, offset))
+                end = mm.find('\n', offset)
+                if end < 0:
+                    end = size
+                else:
+                    end += 1
+                yield offset, mm[offset:end]
+        finally:
+            mm.close()
+            fh.close()
+    elif name == 'bgzf':
+        fh = BgzfReader(path)
+        try:
+            for offset in offsets:
+                fh.seek(offset)
+                line = fh.readline()
+                if not line:
+                    raise TaxoIOError("%s: virtual offset %d beyond the end of the file" % (path, offset))
+                yield offset, line
+        finally:
+            fh.close()
+    else:
+        fh = DecompressedReader(path, name)
+        try:
+            pos = 0
+            last = '\n'
+            for offset in offsets:
+                while pos < offset:
+                    data = fh.read(min(offset - pos, CHUNK_SIZE))
+                    if not data:
+                        raise TaxoIOError("%s: offset %d beyond the end of the file" % (path, offset))
+                    pos += len(data)
+                    last = data[-1]
+                if pos > offset or last != '\n':
+                    raise TaxoIOError("%s: offset %d is not a line start" % (path, offset))
+                line = fh.readline()
+                if not line:
+                    raise TaxoIOError("%s: offset %d beyond the end of the file" % (path, offset))
+                pos += len(line)
+                last = line[-1]
+                yield offset, line
+        finally:
+            fh.close()
+
+
+def spans_at(path, spans):
+    """
+    Yield (offset, data) for the sorted, distinct (offset, length) spans of
+    path, offsets as in lines_at (BGZF: virtual offset of the span start,
+    length in the decompressed content).
+    """
+    spans = sorted(set(spans))
+    name = compression(path)
+    if name is None:
+        fh = open(path, 'rb')
+        size = os.fstat(fh.fileno()).st_size
+        if not size:
+            fh.close()
+            if spans:
+                raise TaxoIOError("%s: offset %d beyond the end of the file" % (path, spans[0][0]))
+            return
+        mm = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            for offset, length in spans:
+                if offset < 0 or offset + length > size:
+                    raise TaxoIOError("%s: offset %d beyond the end of the file" % (path, offset))
+                yield offset, mm[offset:offset + length]
+        finally:
+            mm.close()
+            fh.close()
+    elif name == 'bgzf':
+        fh = BgzfReader(path)
+        try:
+            for offset, length in spans:
+                fh.seek(offset)
+                data = fh.read(length)
+                if len(data) != length:
+                    raise TaxoIOError("%s: virtual offset %d beyond the end of the file" % (path, offset))
+                yield offset, data
+        finally:
+            fh.close()
+    else:
+        fh = DecompressedReader(path, name)
+        try:
+            pos = 0
+            for offset, length in spans:
+                if offset < pos:
+                    raise TaxoIOError("%s: overlapping spans at offset %d" % (path, offset))
+                while pos < offset:
+                    data = fh.read(min(offset - pos, CHUNK_SIZE))
+                    if not data:
+                        raise TaxoIOError("%s: offset %d beyond the end of the file" % (path, offset))
+                    pos += len(data)
+                data = fh.read(length)
+                if len(data) != length:
+                    raise TaxoIOError("%s: offset %d beyond the end of the file" % (path, offset))
+                pos += length
+                yield offset, data
+        finally:
+            fh.close()
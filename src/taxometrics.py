@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+# Corinne Maufrais
+# Institut Pasteur, Centre d'informatique pour les biologistes
+# corinne.maufrais@pasteur.fr
+#
+# version 2.1
+
+import os
+import sys
+import time
+import json
+import atexit
+import resource
+
+# CPU time of the calling thread: RUSAGE_THREAD (Linux), missing from the
+# resource module of Python 2
+RUSAGE_THREAD = getattr(resource, 'RUSAGE_THREAD', None)
+if RUSAGE_THREAD is None and sys.platform.startswith('linux'):
+    RUSAGE_THREAD = 1
+
+
+def thread_cpu():
+    """
+    CPU time of the calling thread, None if the platform doesn't give it.
+    """
+    if RUSAGE_THREAD is None:
+        return None
+    usage = resource.getrusage(RUSAGE_THREAD)
+    return usage.ru_utime + usage.ru_stime
+
+
+class Metrics(object):
+
+    def __init__(self):
+        """
+        Stage timings and counters of a run, shared by the taxo_pack programs
+        through the module level metrics object. Disabled (no-op) until
+        enable() is called.
+
+        Stages may be nested (the Golden stage includes its BDB gets): their
+        times don't add up to the run time. The CPU time of a stage is the one
+        of the thread running it, not of the reader, writer and compression
+        threads (None in the report if the platform doesn't give it).
+        """
+        self.enabled = False
+        self.path = None
+        self.label = ''
+        self.progress_interval = 0
+        self.reset()
+
+    def reset(self):
+        self.stages = {}
+        self.counters = {}
+        self.infos = {}
+        self.start_wall = time.time()
+        self.last_progress = self.start_wall
+
+    def enable(self, path=None, progress_interval=60, label=''):
+        """
+        Record the metrics, written as JSON in path at exit, with a progress
+        line on stderr every progress_interval seconds (0: none).
+        """
+        self.enabled = True
+        self.path = path
+        self.label = label
+        self.progress_interval = progress_interval
+        self.reset()
+        if path:
+            atexit.register(self.write)
+
+    def start(self):
+        if self.enabled:
+            return time.time(), thread_cpu()
+
+    def stop(self, name, start):
+        """
+        Add the time elapsed since start (returned by start()) to the name stage.
+        """
+        if start is None:
+            return
+        stage = self.stages.get(name)
+        if stage is None:
+            stage = self.stages[name] = [0.0, 0.0, 0]
+        stage[0] += time.time() - start[0]
+        if start[1] is not None:
+            stage[1] += thread_cpu() - start[1]
+        stage[2] += 1
+
+    def count(self, name, nb=1):
+        if self.enabled:
+            self.counters[name] = self.counters.get(name, 0) + nb
+
+    def info(self, name, value):
+        if self.enabled:
+            self.infos[name] = value
+
+    def progress(self, name, value):
+        """
+        Set the name counter, printing it with its rate on stderr if the progress
+        interval is elapsed.
+        """
+        if not self.enabled:
+            return
+        self.counters[name] = value
+        if not self.progress_interval:
+            return
+        now = time.time()
+        if now - self.last_progress >= self.progress_interval:
+            self.last_progress = now
+            elapsed = now - self.start_wall
+            print >>sys.stderr, "[progress]%s %d %s in %ds (%.0f %s/s)" % (self.label, value, name, elapsed, value / max(elapsed, 1e-6), name)
+
+    def snapshot(self):
+        """
+        Stages and counters, to be merged in the metrics of another process.
+        """
+        return {'stages': self.stages, 'counters': self.counters}
+
+    def merge(self, snapshot):
+        for name, (wall, cpu, calls) in snapshot['stages'].items():
+            stage = self.stages.setdefault(name, [0.0, 0.0, 0])
+            stage[0] += wall
+            stage[1] += cpu
+            stage[2] += calls
+        for name, nb in snapshot['counters'].items():
+            self.counters[name] = self.counters.get(name, 0) + nb
+
+    def report(self):
+        self_usage = resource.getrusage(resource.RUSAGE_SELF)
+        children_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        if RUSAGE_THREAD is None:
+            stages = dict((name, {'wall_time': wall, 'cpu_time': None, 'calls': calls}) for name, (wall, cpu, calls) in self.stages.items())
+        else:
+            stages = dict((name, {'wall_time': wall, 'cpu_time': cpu, 'calls': calls}) for name, (wall, cpu, calls) in self.stages.items())
+        report = {'program': os.path.basename(sys.argv[0]),
+                  'argv': sys.argv[1:],
+                  'wall_time': time.time() - self.start_wall,
+                  'cpu_time': self_usage.ru_utime + self_usage.ru_stime,
+                  'children_cpu_time': children_usage.ru_utime + children_usage.ru_stime,
+                  # KB on Linux
+                  'peak_rss_kb': self_usage.ru_maxrss,
+                  'children_peak_rss_kb': children_usage.ru_maxrss,
+                  'stages': stages,
+                  'counters': self.counters,
+                  }
+        report.update(self.infos)
+        return report
+
+    def write(self, path=None):
+        path = path or self.path
+        if not path or not self.enabled:
+            return
+        try:
+            fh = open(path, 'w')
+            json.dump(self.report(), fh, indent=2, sort_keys=True)
+            fh.write('\n')
+            fh.close()
+        except IOError, err:
+            print >>sys.stderr, "[metrics] %s" % err
+        self.path = None
+
+
+def hit_ratios(cache_stats):
+    """
+    Add the hit ratio of each {'hits': ., 'misses': .} cache statistics.
+    """
+    for stats in cache_stats.values():
+        lookups = stats.get('hits', 0) + stats.get('misses', 0)
+        if lookups:
+            stats['hit_ratio'] = float(stats['hits']) / lookups
+    return cache_stats
+
+
+metrics = Metrics()
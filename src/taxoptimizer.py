@@ -12,8 +12,19 @@
 import os
 import sys
 import argparse
+import shutil
+import tempfile
+import Queue
+import collections
+import cStringIO
+import multiprocessing
 from bsddb3 import db as bdb
 
+import taxoio
+import taxometrics
+import taxoptimizerlib
+from taxometrics import metrics
+
 class GoldenError:
     def __init__(self, err):
         self.err = err
@@ -156,24 +167,8 @@ def parse(flatFile, DE):
 
 
 def doGolden(db, ac, DE):
-    # ########################## db ref
-    if db in['sp', 'sw', 'swissprot', 'tr', 'trembl']:
-        db = 'uniprot'
-    elif db in ['emb', 'dbj']:
-        db = 'embl'
-    elif db in ['gb']:
-        db = 'genbank'
-    elif db in ['gp']:
-        db = 'genpept'
-    elif db in ['ref']:
-        db = 'refseq'
-    elif db in ['rdpii']:
-        db = 'rdpii'
-    elif db[0:8] == 'embl_wgs':
-        db = 'embl_wgs'
-    elif db[0:8] == 'genbank_wgs':
-        db = 'genbank_wgs'
-    elif db in ['pir', 'pdb', 'tpg', 'tpe', 'tpd', 'prf']:
+    db = goldenDb(db)
+    if db is None:
         return '', '', '', ''
     try:
         flatFile = Golden.access(db, ac)
@@ -188,10 +183,10 @@ def doGolden(db, ac, DE):
         return '', '', '', ''
 
 
-# Builds query input string
-def buildQueryStr(txt_line, db, acc, l_cards, cnt_cards, l_lines):
-    # vlegrand@pasteur.fr development
-    skip_db = False
+def goldenDb(db):
+    """
+    Golden database name of a blast db tag, None for databases without Golden flat files.
+    """
     if db in['sp', 'sw', 'swissprot', 'tr', 'trembl']:
         db = 'uniprot'
     elif db in ['emb', 'dbj']:
@@ -206,20 +201,113 @@ def buildQueryStr(txt_line, db, acc, l_cards, cnt_cards, l_lines):
         db = 'rdpii'
     elif db[0:8] == 'embl_wgs':
         db = 'embl_wgs'
-    elif db[0:8] == 'genbank_wgs':
+    elif db.startswith('genbank_wgs'):
         db = 'genbank_wgs'
     elif db in ['pir', 'pdb', 'tpg', 'tpe', 'tpd', 'prf']:
-        # return '', '', '', ''
-        skip_db = True
-    if not skip_db:
-        l_cards += db
-        l_cards += ":"
-        l_cards += acc
-        l_cards += "\n"
-    cnt_cards += 1
-    li = InputLine(txt_line, acc, skip_db)
-    l_lines.append(li)
-    return l_cards, cnt_cards, l_lines
+        return None
+    return db
+
+
+class BatchPlanner(object):
+    # a batch never holds more than max_cards * MAX_LINES_FACTOR lines
+    MAX_LINES_FACTOR = 10
+
+    def __init__(self, max_cards, allTaxo=None, cache=None, description=False, resolver=None):
+        """
+        p = BatchPlanner(max_cards, allTaxo, cache, description, resolver)
+
+        Build the Golden batches from the input lines. Only the accessions
+        neither annotated (allTaxo, persistent cache, resolver) nor already
+        queued in the current batch become cards. The annotations found at
+        planning time are kept with the batch (batchTaxo) so that every
+        InputLine is resolved in printResults even if allTaxo evicts them
+        meanwhile. resolver(db, acc) returns an Annotation or None.
+        """
+        self.max_cards = max_cards
+        self.allTaxo = allTaxo
+        self.cache = cache
+        self.description = description
+        self.resolver = resolver
+        self.cards_sent = 0
+        self.cards_saved = 0
+        self.resolved = 0
+        self._reset()
+
+    def _reset(self):
+        self.l_cards = []
+        self.l_lines = []
+        self.batchTaxo = {}
+        self.queued = set()
+
+    def add(self, txt_line, db, acc):
+        db = goldenDb(db)
+        if db is None:
+            self.l_lines.append(InputLine(txt_line, acc, True))
+            return
+        self.l_lines.append(InputLine(txt_line, acc, False))
+        if acc in self.batchTaxo or acc in self.queued:
+            self.cards_saved += 1
+            return
+        taxo = None
+        if self.allTaxo is not None:
+            taxo = self.allTaxo.get(acc)
+        if taxo is None and self.cache:
+            record = self.cache.get(db + ':' + acc, self.description)
+            if record:
+                taxo = taxoptimizerlib.Annotation(db, *record)
+                if self.allTaxo is not None:
+                    self.allTaxo[acc] = taxo
+        if taxo is None and self.resolver:
+            taxo = self.resolver(db, acc)
+            if taxo is not None:
+                if self.allTaxo is not None:
+                    self.allTaxo[acc] = taxo
+                self.resolved += 1
+        if taxo is not None:
+            self.batchTaxo[acc] = taxo
+            self.cards_saved += 1
+            return
+        self.queued.add(acc)
+        self.l_cards.append(db + ':' + acc)
+
+    def add_unparsed(self, txt_line):
+        self.l_lines.append(InputLine(txt_line, '', True))
+
+    def full(self):
+        return len(self.l_cards) >= self.max_cards or len(self.l_lines) >= self.max_cards * self.MAX_LINES_FACTOR
+
+    def flush(self):
+        """
+        p.flush() --> (l_cards, l_lines, batchTaxo)
+        """
+        if self.l_cards:
+            l_cards = "\n".join(self.l_cards) + "\n"
+        else:
+            l_cards = ""
+        self.cards_sent += len(self.l_cards)
+        batch = (l_cards, self.l_lines, self.batchTaxo)
+        self._reset()
+        return batch
+
+    def stats(self):
+        return {'cards_sent': self.cards_sent, 'cards_saved': self.cards_saved, 'resolved': self.resolved}
+
+def indexAnnotation(acc_index, db, acc, allTaxId, osVSoc_bdb, taxonomy=None):
+    """
+    Annotate acc with the accession index (acc --> taxid --> scientific name)
+    and the NCBI taxonomy (taxid --> taxonomy) or the taxodb BDB (name -->
+    taxonomy), without Golden. None if acc is not indexed or has no taxonomy.
+    """
+    taxid = acc_index.taxid(acc)
+    if taxid is None:
+        return None
+    taxo = taxoptimizerlib.Annotation(db, acc_index.name(taxid), str(taxid))
+    taxo = extractTaxo(taxo, allTaxId, osVSoc_bdb, taxonomy)
+    if not taxo.orgName and taxonomy:
+        taxo.orgName = taxonomy.name(taxid)
+    if not taxo.taxoFull:
+        return None
+    return taxo
 
 ##############################################################################
 #
@@ -231,22 +319,37 @@ def buildQueryStr(txt_line, db, acc, l_cards, cnt_cards, l_lines):
 ##############################################################################
 
 
-def doGoldenMulti(allTaxo, l_cards, DE, allTaxId, osVSoc_bdb):
+def doGoldenMulti(allTaxo, l_cards, DE, allTaxId, osVSoc_bdb, cache=None, batchTaxo=None, taxonomy=None):
+    """
+    Annotate with Golden the accessions of l_cards (deduplicated by BatchPlanner).
+    batchTaxo, if any, also receives the annotations: allTaxo is bounded and
+    may have dropped some of them before printResults.
+    """
     idx_res = 0
     lst_input = l_cards.split("\n")
+    if batchTaxo is None:
+        batchTaxo = {}
+    start = metrics.start()
+    metrics.count('golden_batches')
+    metrics.count('golden_cards', l_cards.count("\n"))
     try:
         flatFile = Golden.access_new(l_cards)
         while (flatFile is not None):
             db_acc = lst_input[idx_res]
             l_db_acc = db_acc.split(":")
             acc = l_db_acc[1]
-            if acc not in allTaxo:
-                allTaxo[acc] = {'db': l_db_acc[0]}
-                allTaxo[acc]['orgName'], allTaxo[acc]['taxId'], allTaxo[acc]['taxoLight'], allTaxo[acc]['DE'] = parse(flatFile, DE)  # orgName, taxId, taxoLight, description
-                allTaxo, allTaxId = extractTaxoFrom_osVSocBDB_multi(acc, allTaxo, allTaxId, osVSoc_bdb)
+            if acc not in batchTaxo:
+                taxo = taxoptimizerlib.Annotation(l_db_acc[0])
+                taxo.orgName, taxo.taxId, taxo.taxoLight, taxo.DE = parse(flatFile, DE)  # orgName, taxId, taxoLight, description
+                taxo = extractTaxo(taxo, allTaxId, osVSoc_bdb, taxonomy)
+                allTaxo[acc] = taxo
+                batchTaxo[acc] = taxo
+                if cache:
+                    cache.put(db_acc, taxo.record(), DE)
 
             flatFile = Golden.access_new(l_cards)
             idx_res += 1
+        metrics.stop('golden', start)
         return allTaxo
     except IOError, err:
         print >>sys.stderr, err, l_cards
@@ -255,21 +358,23 @@ def doGoldenMulti(allTaxo, l_cards, DE, allTaxId, osVSoc_bdb):
 
 # display results from allTaxo dictionnary.
 def printResults(l_lines, allTaxo, outfh, notaxfhout, splitFile):
+    annotated = 0
     for li in l_lines:
         taxonomy = ''
         if not li.skip_db:
-            if 'taxoFull' in allTaxo[li.acc]:
-                taxonomy = allTaxo[li.acc]['taxoFull']
-            else:
-                taxonomy = allTaxo[li.acc]['taxoLight']
+            taxo = allTaxo[li.acc]
+            taxonomy = taxo.taxonomy()
 
         if taxonomy:
-            print >>outfh, li.orig_line, "\t%s\t%s\t%s" % (allTaxo[li.acc]['orgName'], taxonomy, allTaxo[li.acc]['DE'])
+            print >>outfh, li.orig_line, "\t%s\t%s\t%s" % (taxo.orgName, taxonomy, taxo.DE)
+            annotated += 1
         else:
             if notaxfhout:
                 print >>notaxfhout, li.orig_line
             if not splitFile:
                 print >>outfh, li.orig_line
+    metrics.count('hsps_annotated', annotated)
+    metrics.count('hsps_without_taxonomy', len(l_lines) - annotated)
 
 ##############################################################################
 #
@@ -279,49 +384,66 @@ def printResults(l_lines, allTaxo, outfh, notaxfhout, splitFile):
 
 
 def extractTaxoFrom_osVSocBDB(acc, allTaxo, allTaxId, BDB):
-    taxonomy = allTaxo[acc]['taxoLight']
-    orgName = allTaxo[acc]['orgName']
-    if orgName and orgName not in allTaxId:
-        taxoFull = BDB.get(str(orgName))
-        if taxoFull:
-            allTaxo[acc]['taxoFull'] = taxoFull
-            allTaxId[orgName] = taxoFull
-            allTaxo[acc]['taxoLight'] = ''
-            taxonomy = taxoFull
-    elif orgName:
-        allTaxo[acc]['taxoFull'] = allTaxId[orgName]
-        allTaxo[acc]['taxoLight'] = ''
-        taxonomy = allTaxId[orgName]
+    taxo = allTaxo[acc]
+    taxonomy = taxo.taxoLight
+    taxo, allTaxId = extractTaxoFrom_osVSocBDB_multi(taxo, allTaxId, BDB)
+    if taxo.taxoFull:
+        taxonomy = taxo.taxoFull
     return taxonomy, allTaxo, allTaxId
 
 
-def extractTaxoFrom_osVSocBDB_multi(acc, allTaxo, allTaxId, BDB):
-    orgName = allTaxo[acc]['orgName']
-    if orgName and orgName not in allTaxId:
-        taxoFull = BDB.get(str(orgName))
+def extractTaxoFrom_osVSocBDB_multi(taxo, allTaxId, BDB):
+    orgName = taxo.orgName
+    if orgName:
+        taxoFull = allTaxId.get(orgName)
+        if taxoFull is None:
+            start = metrics.start()
+            taxoFull = BDB.get(str(orgName))
+            metrics.stop('bdb_get', start)
+            metrics.count('bdb_gets')
+            if taxoFull:
+                allTaxId[orgName] = taxoFull
         if taxoFull:
-            allTaxo[acc]['taxoFull'] = taxoFull
-            allTaxId[orgName] = taxoFull
-            allTaxo[acc]['taxoLight'] = ''
-    elif orgName:
-        allTaxo[acc]['taxoFull'] = allTaxId[orgName]
-        allTaxo[acc]['taxoLight'] = ''
-    return allTaxo, allTaxId
+            taxo.taxoFull = taxoFull
+            taxo.taxoLight = ''
+    return taxo, allTaxId
+
+
+def extractTaxoFrom_taxonomy(taxo, taxonomy):
+    # OX/TaxID field --> taxid --> lineage
+    lineage = taxonomy.lineage(taxoptimizerlib.taxid_of(taxo.taxId))
+    if lineage:
+        taxo.taxoFull = lineage
+        taxo.taxoLight = ''
+    return taxo
 
 
-def extractTaxoFrom_accVSos_ocBDB(acc, allTaxo, BDB):
+def extractTaxo(taxo, allTaxId, osVSoc_bdb=None, taxonomy=None):
+    """
+    Full taxonomy of an annotation: by taxid with the NCBI taxonomy first,
+    then by organism name with the taxodb BDB.
+    """
+    if taxonomy:
+        taxo = extractTaxoFrom_taxonomy(taxo, taxonomy)
+    if not taxo.taxoFull and osVSoc_bdb is not None:
+        taxo, allTaxId = extractTaxoFrom_osVSocBDB_multi(taxo, allTaxId, osVSoc_bdb)
+    return taxo
+
+
+def extractTaxoFrom_accVSos_ocBDB(acc, allTaxo, BDB, db=''):
     # 'acc: os_@#$_oc'
-    # allTaxo[acc]['orgName'], allTaxo[acc]['taxId'], allTaxo[acc]['taxoLight'], allTaxo[acc]['DE']
-    allTaxo[acc] = {'taxId': '', 'taxoLight': '', 'DE': '', 'orgName': ''}
+    # allTaxo[acc].orgName, allTaxo[acc].taxId, allTaxo[acc].taxoLight, allTaxo[acc].DE
+    taxo = taxoptimizerlib.Annotation(db)
+    start = metrics.start()
     os_oc = BDB.get(acc)
+    metrics.stop('bdb_get', start)
+    metrics.count('bdb_gets')
     if os_oc:
         os_oc_fld = os_oc.split('_@#$_')
-        allTaxo[acc]['orgName'] = os_oc_fld[0]
-        allTaxo[acc]['taxoFull'] = os_oc_fld[1]
-
-        return allTaxo[acc]['taxoFull'], allTaxo
-    else:
-        return '', allTaxo
+        taxo.orgName = os_oc_fld[0]
+        taxo.taxoFull = os_oc_fld[1]
+    allTaxo[acc] = taxo
+    return taxo.taxoFull, taxo
 
 
 def column_analyser(fldcolumn, db):
@@ -342,22 +464,22 @@ def column_analyser(fldcolumn, db):
     return acc, db
 
 
-def main_ncbi(tabfh, outfh, osVSoc_bdb, column, separator, max_cards, notaxofh=None, db=None, splitfile=False, description=False):
-    allTaxo = {}
-    allTaxId = {}
+def read_ncbi_lines(tabfh, column, separator, notaxofh=None, db=None):
+    """
+    Read the tabulated file and yield (txt_line, db, acc) for each HSP,
+    (txt_line, None, None) for the lines without acc or db.
+    """
     try:
         line = tabfh.readline()
         lineNb = 1
     except EOFError, err:
         print >>sys.stderr, err
         sys.exit()
-    l_cards = ""
-    cnt_cards = 0
-    l_lines = []
     while line:
         fld = line.split()
         if line == '\n':
             line = tabfh.readline()
+            lineNb += 1
             continue
         try:
             fldcolumn = fld[column - 1].split(separator)
@@ -368,27 +490,11 @@ def main_ncbi(tabfh, outfh, osVSoc_bdb, column, separator, max_cards, notaxofh=N
         acc, db = column_analyser(fldcolumn, db)
 
         if not acc or not db:
-            if not splitfile:
-                print >>outfh, line[:-1]
             if notaxofh:
-                print >>notaxofh, line[:-1]
                 print >>sys.stderr, TaxOptimizerError("Parsing: no acc and db in %s with separator=%s (line %s)" % (fld[column - 1], separator, lineNb))
-            try:
-                line = tabfh.readline()
-                lineNb += 1
-            except EOFError, err:
-                print >>sys.stderr, err
-                print >>sys.stderr, TaxOptimizerError("in line %s" % (lineNb))
-                sys.exit()
-            continue
+            yield line[:-1], None, None
         elif db not in ['silva', 'gg']:
-            l_cards, cnt_cards, l_lines = buildQueryStr(line[:-1], db, acc, l_cards, cnt_cards, l_lines)
-            if cnt_cards == max_cards:
-                allTaxo = doGoldenMulti(allTaxo, l_cards, description, allTaxId, osVSoc_bdb)
-                printResults(l_lines, allTaxo, outfh, notaxofh, splitfile)
-                l_cards = ""
-                l_lines = []
-                cnt_cards = 0
+            yield line[:-1], db, acc
 
         try:
             line = tabfh.readline()
@@ -396,17 +502,187 @@ def main_ncbi(tabfh, outfh, osVSoc_bdb, column, separator, max_cards, notaxofh=N
         except EOFError, err:
             print >>sys.stderr, err
             print >>sys.stderr, TaxOptimizerError("in line %s" % (lineNb))
-
             sys.exit()
-        lineNb += 1
+        if not lineNb & 0xffff:
+            metrics.progress('lines_read', lineNb)
+    metrics.progress('lines_read', lineNb - 1)
+
+
+def plan_batches(lines, planner):
+    """
+    Yield the (l_cards, l_lines, batchTaxo) batches built by planner. Lines
+    without acc or db are kept in l_lines (skip_db) so that the output
+    follows the input line order.
+    """
+    start = metrics.start()
+    for txt_line, db, acc in lines:
+        if db is None:
+            planner.add_unparsed(txt_line)
+        else:
+            planner.add(txt_line, db, acc)
+        if planner.full():
+            metrics.stop('read', start)
+            yield planner.flush()
+            start = metrics.start()
+    metrics.stop('read', start)
+    if planner.l_lines:
+        yield planner.flush()
+
+
+def read_ncbi_batches(tabfh, column, separator, planner, notaxofh=None, db=None):
+    return plan_batches(read_ncbi_lines(tabfh, column, separator, notaxofh, db), planner)
+
+
+def writeResults(l_lines, batchTaxo, outfh, notaxofh, splitfile, writer=None):
+    """
+    printResults, directly or through the writer thread of the pipeline.
+    """
+    start = metrics.start()
+    if writer is None:
+        printResults(l_lines, batchTaxo, outfh, notaxofh, splitfile)
+        metrics.stop('write', start)
+        return
+    out = cStringIO.StringIO()
+    notaxo = None
+    if notaxofh:
+        notaxo = cStringIO.StringIO()
+    printResults(l_lines, batchTaxo, out, notaxo, splitfile)
+    if notaxo:
+        writer.write(out.getvalue(), notaxo.getvalue())
+    else:
+        writer.write(out.getvalue(), '')
+    metrics.stop('write', start)
 
-    if cnt_cards != 0:
-        allTaxo = doGoldenMulti(allTaxo, l_cards, description, allTaxId, osVSoc_bdb)
-        printResults(l_lines, allTaxo, outfh, notaxofh, splitfile)
 
+def main_ncbi(tabfh, outfh, osVSoc_bdb, column, separator, max_cards, notaxofh=None, db=None, splitfile=False, description=False, workers=1, bdbfile=None, cache=None,
+              allTaxo=None, allTaxId=None, acc_index=None, taxonomy=None, queue_depth=0):
+    """
+    Return the in memory cache and Golden cards statistics.
 
-def main_gg_silva(tabfh, outfh, accVosocBDB, column, separator, notaxofh=None, db=None, splitfile=False, description=False):
-    allTaxo = {}
+    With queue_depth, reading/parsing and writing run in their own threads,
+    linked to the lookup stage by queues of at most queue_depth items, so
+    the next batch is read while the current one is resolved and the
+    previous one written.
+    """
+    if allTaxo is None:
+        allTaxo = taxoptimizerlib.LRUCache()
+    if allTaxId is None:
+        allTaxId = taxoptimizerlib.LRUCache()
+    resolver = None
+    if acc_index:
+        def resolver(db, acc):
+            return indexAnnotation(acc_index, db, acc, allTaxId, osVSoc_bdb, taxonomy)
+    planner = BatchPlanner(max_cards, allTaxo, cache, description, resolver)
+    lines = read_ncbi_lines(tabfh, column, separator, notaxofh, db)
+    writer = None
+    if queue_depth:
+        lines = taxoptimizerlib.threaded_iter(lines, queue_depth)
+        writer = taxoptimizerlib.ThreadedWriter(queue_depth, outfh, notaxofh)
+    batches = plan_batches(lines, planner)
+    try:
+        if workers > 1:
+            stats = main_ncbi_workers(batches, outfh, bdbfile, workers, notaxofh, splitfile, description, cache, allTaxo, allTaxId, taxonomy, writer)
+        else:
+            for l_cards, l_lines, batchTaxo in batches:
+                if l_cards:
+                    doGoldenMulti(allTaxo, l_cards, description, allTaxId, osVSoc_bdb, cache, batchTaxo, taxonomy)
+                writeResults(l_lines, batchTaxo, outfh, notaxofh, splitfile, writer)
+            stats = {'allTaxo': allTaxo.stats(), 'allTaxId': allTaxId.stats()}
+    finally:
+        if writer:
+            writer.close()
+    stats['golden'] = planner.stats()
+    return stats
+
+
+##############################################################################
+#
+#            Golden Multi in a pool of processes (--workers).
+#
+#  Each worker owns its Golden handle, a read-only osVSoc_bdb and a bounded
+#  allTaxId cache; the NCBI taxonomy, loaded before the fork, is shared.
+#  Workers only annotate the batch cards: planning, allTaxo,
+#  the persistent cache and the output stay in the main process, which
+#  writes the batches back in input order.
+##############################################################################
+
+_ncbi_worker = {}
+
+
+def _init_ncbi_worker(bdbfile, description, max_entries, max_bytes):
+    osVSoc_bdb = None
+    if bdbfile:
+        osVSoc_bdb = bdb.DB()
+        osVSoc_bdb.open(bdbfile, None, bdb.DB_HASH, bdb.DB_RDONLY)
+    _ncbi_worker['osVSoc_bdb'] = osVSoc_bdb
+    _ncbi_worker['allTaxId'] = taxoptimizerlib.LRUCache(max_entries, max_bytes)
+    _ncbi_worker['description'] = description
+    # the worker metrics are sent back to the parent with the results
+    metrics.reset()
+    metrics.progress_interval = 0
+
+
+def _resolve_ncbi_batch(l_cards):
+    batchTaxo = {}
+    try:
+        doGoldenMulti(batchTaxo, l_cards, _ncbi_worker['description'], _ncbi_worker['allTaxId'], _ncbi_worker['osVSoc_bdb'], taxonomy=_ncbi_worker['taxonomy'])
+    except SystemExit:
+        # doGoldenMulti already reported the error on stderr
+        raise IOError("Golden error in worker %s" % os.getpid())
+    records = [(acc, taxo.db, taxo.record()) for acc, taxo in batchTaxo.items()]
+    return records, (os.getpid(), _ncbi_worker['allTaxId'].stats(), metrics.snapshot())
+
+
+def _write_ncbi_batch(batch, result, outfh, notaxofh, splitfile, description, cache, allTaxo, workers_stats, writer=None):
+    l_cards, l_lines, batchTaxo = batch
+    if result is not None:
+        records, (pid, allTaxId_stats, worker_metrics) = result.get()
+        workers_stats[pid] = allTaxId_stats, worker_metrics
+        for acc, db, record in records:
+            taxo = taxoptimizerlib.Annotation(db, *record)
+            allTaxo[acc] = taxo
+            batchTaxo[acc] = taxo
+            if cache:
+                cache.put(db + ':' + acc, record, description)
+    writeResults(l_lines, batchTaxo, outfh, notaxofh, splitfile, writer)
+
+
+def main_ncbi_workers(batches, outfh, bdbfile, workers, notaxofh=None, splitfile=False, description=False, cache=None, allTaxo=None, allTaxId=None, taxonomy=None, writer=None):
+    # inherited by the forked workers
+    _ncbi_worker['taxonomy'] = taxonomy
+    pool = multiprocessing.Pool(workers, _init_ncbi_worker, (bdbfile, description, allTaxId.max_entries, allTaxId.max_bytes))
+    pending = collections.deque()
+    workers_stats = {}
+    try:
+        for batch in batches:
+            result = None
+            if batch[0]:
+                result = pool.apply_async(_resolve_ncbi_batch, (batch[0],))
+            pending.append((batch, result))
+            # bounded number of batches in flight, written back in input order
+            if len(pending) >= 2 * workers:
+                batch, result = pending.popleft()
+                _write_ncbi_batch(batch, result, outfh, notaxofh, splitfile, description, cache, allTaxo, workers_stats, writer)
+        while pending:
+            batch, result = pending.popleft()
+            _write_ncbi_batch(batch, result, outfh, notaxofh, splitfile, description, cache, allTaxo, workers_stats, writer)
+    except IOError, err:
+        pool.terminate()
+        print >>sys.stderr, TaxOptimizerError("%s" % err)
+        sys.exit()
+    pool.close()
+    pool.join()
+    total = allTaxId.stats()
+    for allTaxId_stats, worker_metrics in workers_stats.values():
+        for key in total:
+            total[key] += allTaxId_stats[key]
+        metrics.merge(worker_metrics)
+    return {'allTaxo': allTaxo.stats(), 'allTaxId': total}
+
+
+def main_gg_silva(tabfh, outfh, accVosocBDB, column, separator, notaxofh=None, db=None, splitfile=False, description=False, allTaxo=None):
+    if allTaxo is None:
+        allTaxo = taxoptimizerlib.LRUCache()
     try:
         line = tabfh.readline()
         lineNb = 1
@@ -414,7 +690,12 @@ def main_gg_silva(tabfh, outfh, accVosocBDB, column, separator, notaxofh=None, d
         print >>sys.stderr, err
         sys.exit()
     DE = ''
+    annotated = 0
+    nb_lines = 0
     while line:
+        nb_lines += 1
+        if not nb_lines & 0xffff:
+            metrics.progress('lines_read', nb_lines)
         fld = line.split()
         if line == '\n':
             line = tabfh.readline()
@@ -443,20 +724,17 @@ def main_gg_silva(tabfh, outfh, accVosocBDB, column, separator, notaxofh=None, d
             continue
         else:
             taxonomy = ''
-            if acc in allTaxo:
-                if 'taxoFull' in allTaxo[acc]:
-                    taxonomy = allTaxo[acc]['taxoFull']
-                else:
-                    taxonomy = allTaxo[acc]['taxoLight']
+            taxo = allTaxo.get(acc)
+            if taxo is not None:
+                taxonomy = taxo.taxonomy()
                 if description:
-                    DE = allTaxo[acc]['DE']
+                    DE = taxo.DE
             else:
-                taxonomy = ''
-                allTaxo[acc] = {'db': db}
-                taxonomy, allTaxo = extractTaxoFrom_accVSos_ocBDB(acc, allTaxo, accVosocBDB)
+                taxonomy, taxo = extractTaxoFrom_accVSos_ocBDB(acc, allTaxo, accVosocBDB, db)
 
             if taxonomy:
-                print >>outfh, line[:-1], "\t%s\t%s\t%s" % (allTaxo[acc]['orgName'], taxonomy, DE)
+                print >>outfh, line[:-1], "\t%s\t%s\t%s" % (taxo.orgName, taxonomy, DE)
+                annotated += 1
             else:
                 if notaxofh:
                     print >>notaxofh, line[:-1]
@@ -472,6 +750,273 @@ def main_gg_silva(tabfh, outfh, accVosocBDB, column, separator, notaxofh=None, d
 
             sys.exit()
         lineNb += 1
+    metrics.progress('lines_read', nb_lines)
+    metrics.count('hsps_annotated', annotated)
+
+
+##############################################################################
+#
+#            Run on an input (the whole file or a shard)
+#
+##############################################################################
+
+
+def cache_signature(args):
+    taxo_files = [path for path in [args.bdbfile] if path]
+    if args.taxdump:
+        taxo_files += [os.path.join(args.taxdump, 'nodes.dmp'), os.path.join(args.taxdump, 'names.dmp')]
+    return taxoptimizerlib.file_signature(taxo_files + taxoptimizerlib.golden_index_files(GOLDENDATA))
+
+
+def run_taxoptimizer(args, tabfh, outfh, notaxofh=None, cache=None):
+    """
+    Open the taxonomy databases of args, annotate tabfh in outfh (and
+    notaxofh) and return the in memory cache statistics.
+    """
+    allTaxo = taxoptimizerlib.LRUCache(args.mem_cache_size, args.mem_cache_mb * 1024 * 1024)
+    allTaxId = taxoptimizerlib.LRUCache(args.mem_cache_size, args.mem_cache_mb * 1024 * 1024)
+    cache_stats = {}
+    if args.bdbtype == 'ncbi':
+        osVSoc_bdb = None
+        if args.bdbfile:
+            osVSoc_bdb = bdb.DB()
+            try:
+                osVSoc_bdb.open(args.bdbfile, None, bdb.DB_HASH, bdb.DB_RDONLY)
+            except StandardError, err:
+                print >>sys.stderr, TaxOptimizerError("NCBI TaxoDB database open error, %s" % err)
+                sys.exit()
+
+        taxonomy = None
+        if args.taxdump:
+            try:
+                taxonomy = taxoptimizerlib.NCBITaxonomy(os.path.join(args.taxdump, 'nodes.dmp'), os.path.join(args.taxdump, 'names.dmp'))
+            except (IOError, ValueError, IndexError), err:
+                print >>sys.stderr, TaxOptimizerError("NCBI Taxonomy dump files error, %s" % err)
+                sys.exit()
+
+        acc_index = None
+        if args.acc_index and args.description:
+            print >>sys.stderr, TaxOptimizerError("The accession index has no description (DE), -I is ignored with -e")
+        elif args.acc_index:
+            try:
+                acc_index = taxoptimizerlib.AccessionIndex(args.acc_index)
+            except (IOError, taxoptimizerlib.TaxoCacheError), err:
+                print >>sys.stderr, TaxOptimizerError("Accession index open error, %s" % err)
+                sys.exit()
+
+        cache_stats = main_ncbi(tabfh, outfh, osVSoc_bdb, args.column, args.separator, args.max_cards, notaxofh, args.database, args.splitfile, args.description,
+                                args.workers, args.bdbfile, cache, allTaxo, allTaxId, acc_index, taxonomy, args.queue_depth)
+        if osVSoc_bdb is not None:
+            osVSoc_bdb.close()
+        if acc_index:
+            acc_index.close()
+    elif args.bdbtype in ['gg', 'silva']:
+        accVosocBDB = bdb.DB()
+        try:
+            accVosocBDB.open(args.bdbfile, None, bdb.DB_HASH, bdb.DB_RDONLY)
+        except StandardError, err:
+            print >>sys.stderr, TaxOptimizerError("Taxonomy Berkeley database open error, %s" % err)
+            sys.exit()
+        main_gg_silva(tabfh, outfh, accVosocBDB, args.column, args.separator, notaxofh, args.database, args.splitfile, args.description, allTaxo)
+        accVosocBDB.close()
+        cache_stats = {'allTaxo': allTaxo.stats()}
+    return cache_stats
+
+
+def merge_stats(l_stats):
+    """
+    Sum the statistics returned by the shards.
+    """
+    merged = {}
+    for stats in l_stats:
+        for name, counters in stats.items():
+            total = merged.setdefault(name, dict.fromkeys(counters, 0))
+            for key, value in counters.items():
+                total[key] += value
+    return merged
+
+
+_shard = {}
+
+
+def _run_shard(shard, start, end, outname, notaxoname, results):
+    """
+    Process the [start, end[ byte range of the input in outname (and
+    notaxoname), then send (shard, statistics) to the parent.
+    """
+    args = _shard['args']
+    cache = None
+    metrics.reset()
+    metrics.label = ' shard %d:' % shard
+    try:
+        tabfh = taxoptimizerlib.RangeReader(args.tabfh.name, start, end)
+        outfh = open(outname, 'w')
+        notaxofh = None
+        if notaxoname:
+            notaxofh = open(notaxoname, 'w')
+        if args.cache_dir:
+            # the parent holds the cache generation, the shards only join it
+            cache = taxoptimizerlib.PersistentCache(args.cache_dir, _shard['signature'], args.cache_size, attach=True)
+        stats = run_taxoptimizer(args, tabfh, outfh, notaxofh, cache)
+        if cache:
+            stats['persistent_cache'] = {'hits': cache.hits, 'misses': cache.misses}
+        stats['metrics'] = metrics.snapshot()
+        outfh.close()
+        if notaxofh:
+            notaxofh.close()
+        tabfh.close()
+    except SystemExit, err:
+        results.put((shard, {'exit': err.code}))
+        return
+    except BaseException, err:
+        print >>sys.stderr, TaxOptimizerError("shard %d: %s" % (shard, err))
+        results.put((shard, {'exit': 1}))
+        return
+    finally:
+        if cache:
+            cache.close()
+    results.put((shard, stats))
+
+
+def main_shards(args, signature=None):
+    """
+    Split the input in newline aligned byte ranges, one process by range,
+    and concatenate the shard outputs in the input order. The shards share
+    the persistent cache (-C) so an accession resolved by a shard is not
+    resolved again by the others.
+    """
+    ranges = taxoptimizerlib.split_ranges(args.tabfh.name, args.shards)
+    cache = None
+    if args.cache_dir:
+        # start the run generation before the shards attach to the cache
+        try:
+            cache = taxoptimizerlib.PersistentCache(args.cache_dir, signature, args.cache_size)
+        except (StandardError, taxoptimizerlib.TaxoCacheError), err:
+            print >>sys.stderr, TaxOptimizerError("Persistent cache open error, %s" % err)
+            sys.exit()
+    outdir = None
+    if os.path.isfile(args.outfh.name):
+        outdir = os.path.dirname(os.path.abspath(args.outfh.name))
+    tmpdir = tempfile.mkdtemp(prefix='taxo_shards_', dir=outdir)
+    _shard['args'] = args
+    _shard['signature'] = signature
+    results = multiprocessing.Queue()
+    processes = []
+    l_stats = {}
+    failed = False
+    exit_code = None
+    try:
+        for shard, (start, end) in enumerate(ranges):
+            outname = os.path.join(tmpdir, '%d.out' % shard)
+            notaxoname = None
+            if args.notaxofh:
+                notaxoname = os.path.join(tmpdir, '%d.notaxo' % shard)
+            process = multiprocessing.Process(target=_run_shard, args=(shard, start, end, outname, notaxoname, results))
+            process.start()
+            processes.append(process)
+        while len(l_stats) < len(processes):
+            try:
+                shard, stats = results.get(True, 1)
+            except Queue.Empty:
+                if [process for process in processes if process.exitcode]:
+                    print >>sys.stderr, TaxOptimizerError("a shard process died")
+                    failed = True
+                    exit_code = 1
+                    break
+                continue
+            l_stats[shard] = stats
+            if 'exit' in stats and not failed:
+                failed = True
+                exit_code = stats['exit']
+        for process in processes:
+            process.join()
+        if failed:
+            sys.exit(exit_code)
+        for shard in range(len(processes)):
+            taxoptimizerlib.copy_file(os.path.join(tmpdir, '%d.out' % shard), args.outfh)
+            if args.notaxofh:
+                taxoptimizerlib.copy_file(os.path.join(tmpdir, '%d.notaxo' % shard), args.notaxofh)
+    finally:
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+        shutil.rmtree(tmpdir, True)
+        if cache:
+            cache.close()
+    for stats in l_stats.values():
+        metrics.merge(stats.pop('metrics'))
+    return merge_stats(l_stats.values())
+
+
+##############################################################################
+#
+#            Accession index: taxoptimizer.py index build
+#
+##############################################################################
+
+
+def goldenCrawl(cardsfh, outfh, max_cards):
+    """
+    Write 'acc\ttaxid\torganism' lines for the db:acc cards of cardsfh, using Golden.
+    """
+    l_cards = []
+    line = cardsfh.readline()
+    while True:
+        if line.strip():
+            l_cards.append(line.strip())
+        if l_cards and (len(l_cards) == max_cards or not line):
+            batchTaxo = {}
+            doGoldenMulti(batchTaxo, "\n".join(l_cards) + "\n", False, {}, None)
+            for acc, taxo in batchTaxo.items():
+                taxid = taxoptimizerlib.taxid_of(taxo.taxId)
+                if taxid is not None:
+                    print >>outfh, "%s\t%s\t%s" % (acc, taxid, taxo.orgName)
+            l_cards = []
+        if not line:
+            break
+        line = cardsfh.readline()
+
+
+def main_index(argv):
+    parser = argparse.ArgumentParser(prog='taxoptimizer.py index build',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+                                     description="Build the accession --> taxid index used by the -I option.")
+    parser.add_argument("-a", "--acc2taxid", dest="acc2taxid",
+                        help="NCBI accession2taxid file(s), gzip or not.",
+                        metavar="File", nargs='*', default=[])
+    parser.add_argument("-g", "--golden_cards", dest="cardsfh",
+                        help="File of db:acc cards (one by line) to crawl with Golden.",
+                        metavar="File", type=taxoio.InputFileType())
+    parser.add_argument("-n", "--names", dest="names_dmp",
+                        help="NCBI Taxonomy names.dmp file, for the scientific names of the taxids.",
+                        metavar="File")
+    parser.add_argument("-o", "--out", dest="index_file",
+                        help="Index file.", metavar="File", required=True)
+    parser.add_argument("-T", "--tmpdir", dest="tmpdir",
+                        help="Directory for the temporary sorted runs.", metavar="Dir", default=None)
+    parser.add_argument("-m", "--max_cards", dest="max_cards", type=int,
+                        help="Maximum cards number used by Golden2.0 in the crawl.", default=500)
+    args = parser.parse_args(argv)
+
+    acc2taxid = list(args.acc2taxid)
+    crawl_file = None
+    if args.cardsfh:
+        fd, crawl_file = tempfile.mkstemp(prefix='taxo_crawl_', dir=args.tmpdir)
+        crawlfh = os.fdopen(fd, 'w')
+        goldenCrawl(args.cardsfh, crawlfh, args.max_cards)
+        crawlfh.close()
+        acc2taxid.append(crawl_file)
+    if not acc2taxid:
+        parser.error("at least one of -a or -g is required")
+    try:
+        nb = taxoptimizerlib.build_accession_index(acc2taxid, args.index_file, args.names_dmp, args.tmpdir)
+    except (IOError, OSError), err:
+        print >>sys.stderr, TaxOptimizerError("Accession index build error, %s" % err)
+        sys.exit(1)
+    finally:
+        if crawl_file:
+            os.remove(crawl_file)
+    print >>sys.stderr, "%d accessions indexed in %s" % (nb, args.index_file)
 
 
 ##############################################################################
@@ -483,6 +1028,10 @@ def main_gg_silva(tabfh, outfh, accVosocBDB, column, separator, notaxofh=None, d
 
 if __name__ == '__main__':
 
+    if sys.argv[1:3] == ['index', 'build']:
+        main_index(sys.argv[3:])
+        sys.exit(0)
+
     parser = argparse.ArgumentParser(prog='taxoptimizer.py',
                                      formatter_class=argparse.ArgumentDefaultsHelpFormatter,
                                      description="Parse a blast output report and add NCBI, SILVA or Greengenes Taxonomy database information in each HSP.")
@@ -490,22 +1039,26 @@ if __name__ == '__main__':
     general_options = parser.add_argument_group(title="Options", description=None)
 
     general_options.add_argument("-i", "--in", dest="tabfh",
-                                 help="Tabulated input file. (Recommended, Blast m8 file)",
+                                 help="Tabulated input file. (Recommended, Blast m8 file), plain or compressed (gzip, bz2, xz, zstd)",
                                  metavar="File",
-                                 type=file,
+                                 type=taxoio.InputFileType(),
                                  required=True)
     general_options.add_argument("-o", "--out",
                                  action='store',
                                  dest='outfh',
                                  metavar="File",
-                                 type=argparse.FileType('w'),
-                                 help='Output file',
+                                 type=taxoio.OutputFileType(),
+                                 help='Output file, compressed according to its extension (.gz: bgzip, .bz2, .xz, .zst)',
                                  required=True)
     general_options.add_argument("-b", "--bdb",
                                  dest="bdbfile",
-                                 help="Berleley DB file generated by taxodb_ncbi (https://github.com/C3BI-pasteur-fr/taxodb_ncbi) or taxo_rrna programs (https://github.com/C3BI-pasteur-fr/taxo_rrna)",
+                                 help="Berleley DB file generated by taxodb_ncbi (https://github.com/C3BI-pasteur-fr/taxodb_ncbi) or taxo_rrna programs (https://github.com/C3BI-pasteur-fr/taxo_rrna). Optional for ncbi with -D.",
                                  metavar="File",
-                                 required=True
+                                 )
+    general_options.add_argument("-D", "--taxdump",
+                                 dest="taxdump",
+                                 help="Directory with the NCBI Taxonomy names.dmp and nodes.dmp files. Lineages are resolved by taxid (OX/TaxID) before the -b file (ncbi only).",
+                                 metavar="Dir",
                                  )
     general_options.add_argument("-t", "--bdb_type",
                                  dest="bdbtype",
@@ -540,7 +1093,7 @@ if __name__ == '__main__':
                                  action='store',
                                  dest='notaxofh',
                                  metavar="File",
-                                 type=argparse.FileType('w'),
+                                 type=taxoio.OutputFileType(),
                                  help='Only show lines without a taxonomy correspondance. Could be used with -x option.',)
     general_options.add_argument('-d', '--database', metavar='str',
                                  dest='database',
@@ -548,6 +1101,17 @@ if __name__ == '__main__':
                                  help="Supposed that all blast HSPs match this database. Not used for Silva and Greengenes databases",
                                  default=None,
                                  )
+    general_options.add_argument("--metrics",
+                                 dest="metrics",
+                                 metavar="File",
+                                 help="Write a JSON report of the run: time by stage, counters, cache hit ratios, peak memory.",
+                                 default=None)
+    general_options.add_argument("--progress",
+                                 dest="progress",
+                                 metavar="Seconds",
+                                 type=int,
+                                 help="With --metrics, report the progress on stderr every given seconds (0: never).",
+                                 default=60)
     golden_options = parser.add_argument_group(title="Golden options", description=None)
     golden_options.add_argument("-m", "--max_cards",
                                 action='store',
@@ -555,29 +1119,103 @@ if __name__ == '__main__':
                                 type=int,
                                 help='Maximum cards number used by Golden2.0 in analyses',
                                 default=500)
+    golden_options.add_argument("-I", "--acc_index",
+                                action='store',
+                                dest='acc_index',
+                                metavar="File",
+                                help='Accession index built with "taxoptimizer.py index build". Indexed accessions are annotated without Golden (NCBI only, not used with -e).',
+                                default=None)
+    golden_options.add_argument("--shards",
+                                action='store',
+                                dest='shards',
+                                type=int,
+                                help='Split the input file in this number of newline aligned byte ranges processed by separate processes (each one with -w workers). Outputs are concatenated in the input order.',
+                                default=1)
+    golden_options.add_argument("-q", "--queue_depth",
+                                action='store',
+                                dest='queue_depth',
+                                type=int,
+                                help='Pipeline mode: read, annotate and write in parallel threads linked by queues of this depth (memory bound). 0: sequential.',
+                                default=0)
+    golden_options.add_argument("-w", "--workers",
+                                action='store',
+                                dest='workers',
+                                type=int,
+                                help='Number of processes resolving Golden batches in parallel. Output keeps the input line order.',
+                                default=1)
+    cache_options = parser.add_argument_group(title="Cache options", description=None)
+    cache_options.add_argument("-C", "--cache_dir",
+                               action='store',
+                               dest='cache_dir',
+                               metavar="Dir",
+                               help='Directory of a persistent accession annotation cache shared across runs. The cache is emptied when the Golden indexes, the -b or the -D files change.',
+                               default=None)
+    cache_options.add_argument("-S", "--cache_size",
+                               action='store',
+                               dest='cache_size',
+                               type=int,
+                               help='Maximum number of accessions kept in the persistent cache (least recently used are evicted).',
+                               default=1000000)
+    cache_options.add_argument("--mem_cache_size",
+                               action='store',
+                               dest='mem_cache_size',
+                               type=int,
+                               help='Maximum number of accessions (and of organisms) annotated in memory, by process. 0: no limit.',
+                               default=1000000)
+    cache_options.add_argument("--mem_cache_mb",
+                               action='store',
+                               dest='mem_cache_mb',
+                               type=int,
+                               help='Approximate memory budget (MB) of each in memory annotation cache, by process. 0: no limit.',
+                               default=0)
+    cache_options.add_argument("--cache_stats",
+                               dest="cache_stats",
+                               help="Report in memory cache hits, misses and evictions on stderr.",
+                               action='store_true',
+                               default=False,)
 
     args = parser.parse_args()
+    if args.metrics:
+        metrics.enable(args.metrics, args.progress)
 
     # ===== Tabulated file parsing
     NCBITAXODB_BDB = 'taxodb.bdb'
     GGTAXODB_BDB = 'gg_accVosoc.bdb'
     SILVATAXODB_BDB = 'silva_accVosoc.bdb'
 
-    if args.bdbtype == 'ncbi':
-        osVSoc_bdb = bdb.DB()
-        try:
-            osVSoc_bdb.open(args.bdbfile, None, bdb.DB_HASH, bdb.DB_RDONLY)
-        except StandardError, err:
-            print >>sys.stderr, TaxOptimizerError("NCBI TaxoDB database open error, %s" % err)
-            sys.exit()
+    if not args.bdbfile and not (args.bdbtype == 'ncbi' and args.taxdump):
+        parser.error("argument -b/--bdb is required")
+    if args.shards > 1 and (not os.path.isfile(args.tabfh.name) or getattr(args.tabfh, 'compression', None)):
+        parser.error("argument --shards: the input must be a regular uncompressed file")
 
-        main_ncbi(args.tabfh, args.outfh, osVSoc_bdb, args.column, args.separator, args.max_cards, args.notaxofh, args.database, args.splitfile, args.description)
-        osVSoc_bdb.close()
-    elif args.bdbtype in ['gg', 'silva']:
-        accVosocBDB = bdb.DB()
-        try:
-            accVosocBDB.open(args.bdbfile, None, bdb.DB_HASH, bdb.DB_RDONLY)
-        except StandardError, err:
-            print >>sys.stderr, TaxOptimizerError("Taxonomy Berkeley database open error, %s" % err)
-            sys.exit()
-        main_gg_silva(args.tabfh, args.outfh, accVosocBDB, args.column, args.separator, args.notaxofh, args.database, args.splitfile, args.description)
\ No newline at end of file
+    signature = None
+    if args.cache_dir:
+        signature = cache_signature(args)
+    if args.shards > 1:
+        cache_stats = main_shards(args, signature)
+    else:
+        cache = None
+        if args.cache_dir:
+            try:
+                cache = taxoptimizerlib.PersistentCache(args.cache_dir, signature, args.cache_size)
+            except (StandardError, taxoptimizerlib.TaxoCacheError), err:
+                print >>sys.stderr, TaxOptimizerError("Persistent cache open error, %s" % err)
+                sys.exit()
+        cache_stats = run_taxoptimizer(args, args.tabfh, args.outfh, args.notaxofh, cache)
+        if cache:
+            cache_stats['persistent_cache'] = {'hits': cache.hits, 'misses': cache.misses}
+            cache.close()
+    if 'golden' in cache_stats:
+        metrics.info('golden', cache_stats['golden'])
+    metrics.info('caches', taxometrics.hit_ratios(dict((name, stats) for name, stats in cache_stats.items() if name != 'golden')))
+
+    if args.cache_stats:
+        for name in ['allTaxo', 'allTaxId']:
+            if name in cache_stats:
+                print >>sys.stderr, taxoptimizerlib.format_cache_stats(name, cache_stats[name])
+        if 'golden' in cache_stats:
+            print >>sys.stderr, "Golden cards: %(cards_sent)d sent, %(cards_saved)d saved (%(resolved)d by the accession index)" % cache_stats['golden']
+
+    args.outfh.close()
+    if args.notaxofh:
+        args.notaxofh.close()
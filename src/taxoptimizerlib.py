@@ -0,0 +1,756 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+# Corinne Maufrais
+# Institut Pasteur, Centre d'informatique pour les biologistes
+# corinne.maufrais@pasteur.fr
+#
+# version 2.1
+
+import os
+import re
+import sys
+import gzip
+import mmap
+import heapq
+import shutil
+import struct
+import tempfile
+import array
+import Queue
+import threading
+import collections
+from bsddb3 import db as bdb
+
+
+class TaxoCacheError:
+    def __init__(self, err):
+        self.err = err
+
+    def __repr__(self):
+        return "[TaxoCacheError] " + self.err
+
+
+def file_signature(paths):
+    """
+    file_signature([path, ...]) --> str
+
+    Identify a set of files by name, size and modification time.
+    """
+    sign = []
+    for path in sorted(paths):
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        sign.append('%s:%d:%d' % (os.path.abspath(path), st.st_size, int(st.st_mtime)))
+    return '|'.join(sign)
+
+
+def golden_index_files(goldendata):
+    """
+    Golden index files (goldin output) stored at the top of the GOLDENDATA directories.
+    """
+    files = []
+    for directory in goldendata.split(os.pathsep):
+        if not os.path.isdir(directory):
+            continue
+        for name in os.listdir(directory):
+            path = os.path.join(directory, name)
+            if os.path.isfile(path):
+                files.append(path)
+    return files
+
+
+##############################################################################
+#
+#            In memory accession annotations
+#
+##############################################################################
+
+
+class Annotation(object):
+    """
+    Compact annotation of one accession, replacing the allTaxo[acc] dictionary.
+    """
+    __slots__ = ('db', 'orgName', 'taxId', 'taxoLight', 'taxoFull', 'DE')
+
+    def __init__(self, db='', orgName='', taxId='', taxoLight='', taxoFull='', DE=''):
+        self.db = db
+        self.orgName = orgName
+        self.taxId = taxId
+        self.taxoLight = taxoLight
+        self.taxoFull = taxoFull
+        self.DE = DE
+
+    def taxonomy(self):
+        if self.taxoFull:
+            return self.taxoFull
+        return self.taxoLight
+
+    def record(self):
+        # --> (orgName, taxId, taxoLight, taxoFull, DE)
+        return self.orgName, self.taxId, self.taxoLight, self.taxoFull, self.DE
+
+    def size(self):
+        return sys.getsizeof(self) + sum([sys.getsizeof(getattr(self, attr)) for attr in self.__slots__])
+
+
+class LRUCache(object):
+    # approximate cost of one entry in the ordered dictionary
+    ENTRY_OVERHEAD = 200
+
+    def __init__(self, max_entries=0, max_bytes=0):
+        """
+        c = LRUCache(max_entries, max_bytes)
+
+        Dictionary like cache bounded by a number of entries and/or an
+        approximate number of bytes (0: no bound). The least recently used
+        entries are evicted first.
+        """
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.data = collections.OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _sizeof(self, key, value):
+        if isinstance(value, Annotation):
+            return self.ENTRY_OVERHEAD + sys.getsizeof(key) + value.size()
+        return self.ENTRY_OVERHEAD + sys.getsizeof(key) + sys.getsizeof(value)
+
+    def __len__(self):
+        return len(self.data)
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def get(self, key, default=None):
+        try:
+            value = self.data.pop(key)
+        except KeyError:
+            self.misses += 1
+            return default
+        self.data[key] = value
+        self.hits += 1
+        return value
+
+    def __getitem__(self, key):
+        value = self.get(key, self)
+        if value is self:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        if key in self.data:
+            self.nbytes -= self._sizeof(key, self.data.pop(key))
+        self.data[key] = value
+        self.nbytes += self._sizeof(key, value)
+        while len(self.data) > 1 and ((self.max_entries and len(self.data) > self.max_entries) or
+                                      (self.max_bytes and self.nbytes > self.max_bytes)):
+            old_key, old_value = self.data.popitem(last=False)
+            self.nbytes -= self._sizeof(old_key, old_value)
+            self.evictions += 1
+
+    def stats(self):
+        return {'entries': len(self.data), 'bytes': self.nbytes,
+                'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+
+
+def format_cache_stats(name, stats):
+    lookups = stats['hits'] + stats['misses']
+    if lookups:
+        ratio = 100.0 * stats['hits'] / lookups
+    else:
+        ratio = 0.0
+    return "%s: %d entries (~%d bytes), %d hits, %d misses (%.1f%% hits), %d evictions" % (name, stats['entries'], stats['bytes'],
+                                                                                          stats['hits'], stats['misses'], ratio, stats['evictions'])
+
+
+##############################################################################
+#
+#            Persistent accession annotation cache (--cache_dir)
+#
+#  'db:acc' --> (orgName, taxId, taxoLight, taxoFull, DE)
+#  Records are kept in a Berkeley DB hash shared by all the taxoptimizer
+#  processes through a Concurrent Data Store environment. The cache is
+#  emptied when the Golden indexes or the taxodb file change.
+##############################################################################
+
+
+class PersistentCache(object):
+    FIELD_SEP = '\x1f'
+    META_SIGNATURE = '\x00signature'
+    META_GENERATION = '\x00generation'
+
+    def __init__(self, cache_dir, signature, max_entries=1000000, attach=False):
+        """
+        c = PersistentCache(cache_dir, signature)
+
+        Open (or create) the cache stored in cache_dir. signature identifies the
+        Golden indexes and taxodb file used to fill the cache. With attach=True
+        the cache is only joined (by a worker process): no invalidation, no
+        eviction.
+        """
+        self.cache_dir = cache_dir
+        self.signature = signature
+        self.max_entries = max_entries
+        self.attach = attach
+        self.hits = 0
+        self.misses = 0
+        if not os.path.isdir(cache_dir):
+            try:
+                os.makedirs(cache_dir)
+            except OSError, err:
+                raise TaxoCacheError("cache directory error, %s" % err)
+        self.env = bdb.DBEnv()
+        self.env.open(cache_dir, bdb.DB_CREATE | bdb.DB_INIT_CDB | bdb.DB_INIT_MPOOL)
+        self.db = bdb.DB(self.env)
+        self.db.open('annotations.bdb', None, bdb.DB_HASH, bdb.DB_CREATE)
+
+        if attach:
+            self.generation = int(self.db.get(self.META_GENERATION) or 0)
+            return
+        if self.db.get(self.META_SIGNATURE) != signature:
+            self.db.truncate()
+            self.db.put(self.META_SIGNATURE, signature)
+        # one generation by run, used to evict the least recently used records
+        self.generation = int(self.db.get(self.META_GENERATION) or 0) + 1
+        self.db.put(self.META_GENERATION, str(self.generation))
+        self.db.sync()
+
+    def get(self, db_acc, description=False):
+        """
+        c.get('db:acc', description) --> (orgName, taxId, taxoLight, taxoFull, DE) or None
+        """
+        value = self.db.get(db_acc)
+        if value is None:
+            self.misses += 1
+            return None
+        fld = value.split(self.FIELD_SEP)
+        if description and fld[1] != '1':
+            # stored by a run without description
+            self.misses += 1
+            return None
+        if int(fld[0]) < self.generation:
+            self.db.put(db_acc, self.FIELD_SEP.join([str(self.generation)] + fld[1:]))
+        self.hits += 1
+        if not description:
+            # stored by a run with description: no DE without -e
+            fld[-1] = ''
+        return tuple(fld[2:])
+
+    def put(self, db_acc, record, description=False):
+        if description:
+            de = '1'
+        else:
+            de = '0'
+        self.db.put(db_acc, self.FIELD_SEP.join([str(self.generation), de] + list(record)))
+
+    def sync(self):
+        self.db.sync()
+
+    def evict(self):
+        """
+        Remove the records of the oldest generations to come back under 90% of max_entries.
+        """
+        # full count of the database records, less the two '\x00' metadata records
+        nb_entries = self.db.stat()['ndata'] - 2
+        if nb_entries <= self.max_entries:
+            return 0
+        nb_evict = nb_entries - int(self.max_entries * 0.9)
+        oldest = []
+        cursor = self.db.cursor()
+        rec = cursor.first()
+        while rec:
+            key, value = rec
+            if key[0] != '\x00':
+                oldest.append((int(value.split(self.FIELD_SEP, 1)[0]), key))
+            rec = cursor.next()
+        cursor.close()
+        for generation, key in heapq.nsmallest(nb_evict, oldest):
+            self.db.delete(key)
+        return nb_evict
+
+    def close(self):
+        if not self.attach:
+            self.evict()
+        self.db.close()
+        self.env.close()
+
+
+##############################################################################
+#
+#            Accession --> taxid index (taxoptimizer.py index build)
+#
+#  header  : magic, key width, number of records, names table offset and size
+#  records : accession (key width bytes, '\0' padded) + taxid, sorted by accession
+#  names   : (taxid, offset) entries sorted by taxid, then the names strings
+#  The file is memory mapped and binary searched.
+##############################################################################
+
+ACC_INDEX_MAGIC = 'TXACIDX1'
+ACC_INDEX_HEADER = struct.Struct('<8sIIQQQ')  # magic, key width, reserved, nb records, names offset, nb names
+ACC_INDEX_TAXID = struct.Struct('<I')
+ACC_INDEX_NAME = struct.Struct('<IQ')  # taxid, offset in the names strings
+
+
+def taxid_of(taxId):
+    """
+    taxid_of('NCBI_TaxID=9606 {ECO:0000313};') --> 9606, None without taxid
+
+    Integer taxid of an OX (uniprot, embl) or TaxID (genbank) field.
+    """
+    m = re.search(r'(\d+)', taxId)
+    if m:
+        return int(m.group(1))
+    return None
+
+
+def open_text(path):
+    if path.endswith('.gz'):
+        return gzip.open(path)
+    return open(path)
+
+
+def read_names_dmp(names_dmp):
+    """
+    Scientific names {taxid: name} of a NCBI Taxonomy names.dmp file.
+    """
+    names = {}
+    fh = open_text(names_dmp)
+    for line in fh:
+        fld = line.split('\t|\t')
+        if len(fld) > 3 and fld[3].startswith('scientific name'):
+            names[int(fld[0])] = fld[1]
+    fh.close()
+    return names
+
+
+def _iter_acc2taxid(path, names):
+    # accession2taxid: accession  accession.version  taxid  gi (with header)
+    # crawl output   : accession  taxid  [organism name]
+    fh = open_text(path)
+    for line in fh:
+        fld = line.rstrip('\n').split('\t')
+        if len(fld) >= 4:
+            acc, taxid = fld[0], fld[2]
+        elif len(fld) >= 2:
+            acc, taxid = fld[0], fld[1]
+            if len(fld) == 3 and fld[2] and taxid.isdigit() and int(taxid) not in names:
+                names[int(taxid)] = fld[2]
+        else:
+            continue
+        if not taxid.isdigit():
+            continue  # header
+        yield acc.split('.')[0], int(taxid)
+    fh.close()
+
+
+def _write_run(records, tmpdir):
+    records.sort()
+    fd, path = tempfile.mkstemp(prefix='taxo_accidx_', dir=tmpdir)
+    fh = os.fdopen(fd, 'w')
+    for acc, taxid in records:
+        fh.write('%s\t%d\n' % (acc, taxid))
+    fh.close()
+    return path
+
+
+def _read_run(path):
+    fh = open(path)
+    for line in fh:
+        acc, taxid = line[:-1].split('\t')
+        yield acc, int(taxid)
+    fh.close()
+
+
+def build_accession_index(acc2taxid_files, index_file, names_dmp=None, tmpdir=None, chunk_size=2000000):
+    """
+    build_accession_index([file, ...], index_file, names_dmp) --> number of accessions
+
+    External sort of the accession2taxid files into sorted runs, then merge
+    into the fixed width index file. When an accession is listed several
+    times, the smallest taxid is kept.
+    """
+    names = {}
+    runs = []
+    key_width = 1
+    records = []
+    try:
+        for path in acc2taxid_files:
+            for acc, taxid in _iter_acc2taxid(path, names):
+                records.append((acc, taxid))
+                if len(acc) > key_width:
+                    key_width = len(acc)
+                if len(records) >= chunk_size:
+                    runs.append(_write_run(records, tmpdir))
+                    records = []
+        if records:
+            runs.append(_write_run(records, tmpdir))
+            records = []
+        if names_dmp:
+            # names.dmp takes precedence over the crawled organism names
+            names.update(read_names_dmp(names_dmp))
+
+        out = open(index_file, 'wb')
+        out.write(ACC_INDEX_HEADER.pack(ACC_INDEX_MAGIC, key_width, 0, 0, 0, 0))
+        nb_records = 0
+        taxids = set()
+        last = None
+        for acc, taxid in heapq.merge(*[_read_run(path) for path in runs]):
+            if acc == last:
+                continue
+            last = acc
+            out.write(acc.ljust(key_width, '\0'))
+            out.write(ACC_INDEX_TAXID.pack(taxid))
+            taxids.add(taxid)
+            nb_records += 1
+
+        names_offset = out.tell()
+        kept = sorted([taxid for taxid in taxids if taxid in names])
+        offset = 0
+        for taxid in kept:
+            out.write(ACC_INDEX_NAME.pack(taxid, offset))
+            offset += len(names[taxid])
+        out.write(ACC_INDEX_NAME.pack(0, offset))  # end of the last name
+        for taxid in kept:
+            out.write(names[taxid])
+        out.seek(0)
+        out.write(ACC_INDEX_HEADER.pack(ACC_INDEX_MAGIC, key_width, 0, nb_records, names_offset, len(kept)))
+        out.close()
+    finally:
+        for path in runs:
+            os.remove(path)
+    return nb_records
+
+
+class AccessionIndex(object):
+
+    def __init__(self, index_file):
+        """
+        i = AccessionIndex(index_file)
+
+        Read only, memory mapped view of a build_accession_index file.
+        """
+        self.fh = open(index_file, 'rb')
+        try:
+            self.mm = mmap.mmap(self.fh.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, mmap.error), err:
+            raise TaxoCacheError("accession index %s: %s" % (index_file, err))
+        if len(self.mm) < ACC_INDEX_HEADER.size:
+            raise TaxoCacheError("accession index %s: truncated file" % index_file)
+        magic, self.key_width, reserved, self.nb_records, self.names_offset, self.nb_names = ACC_INDEX_HEADER.unpack_from(self.mm, 0)
+        if magic != ACC_INDEX_MAGIC:
+            raise TaxoCacheError("accession index %s: not an accession index file" % index_file)
+        self.record_size = self.key_width + ACC_INDEX_TAXID.size
+        self.names_strings = self.names_offset + (self.nb_names + 1) * ACC_INDEX_NAME.size
+
+    def taxid(self, acc):
+        """
+        i.taxid(acc) --> int, None if acc is not indexed
+        """
+        if len(acc) > self.key_width:
+            return None
+        key = acc.ljust(self.key_width, '\0')
+        mm = self.mm
+        lo = 0
+        hi = self.nb_records
+        while lo < hi:
+            mid = (lo + hi) // 2
+            pos = ACC_INDEX_HEADER.size + mid * self.record_size
+            cur = mm[pos:pos + self.key_width]
+            if cur < key:
+                lo = mid + 1
+            elif cur > key:
+                hi = mid
+            else:
+                return ACC_INDEX_TAXID.unpack_from(mm, pos + self.key_width)[0]
+        return None
+
+    def name(self, taxid):
+        """
+        i.name(taxid) --> scientific name, '' if unknown
+        """
+        lo = 0
+        hi = self.nb_names
+        while lo < hi:
+            mid = (lo + hi) // 2
+            cur, offset = ACC_INDEX_NAME.unpack_from(self.mm, self.names_offset + mid * ACC_INDEX_NAME.size)
+            if cur < taxid:
+                lo = mid + 1
+            elif cur > taxid:
+                hi = mid
+            else:
+                end = ACC_INDEX_NAME.unpack_from(self.mm, self.names_offset + (mid + 1) * ACC_INDEX_NAME.size)[1]
+                return self.mm[self.names_strings + offset:self.names_strings + end]
+        return ''
+
+    def close(self):
+        self.mm.close()
+        self.fh.close()
+
+
+##############################################################################
+#
+#            NCBI Taxonomy from names.dmp/nodes.dmp (--taxdump)
+#
+#  parent, rank and name arrays indexed by taxid, interned rank and name
+#  tables. Lineages are built on demand and cached by taxid.
+##############################################################################
+
+
+def _grow(arr, size):
+    if size > len(arr):
+        arr.extend(array.array(arr.typecode, [0]) * max(size - len(arr), len(arr)))
+
+
+class NCBITaxonomy(object):
+
+    def __init__(self, nodes_dmp, names_dmp, cache_size=100000):
+        """
+        t = NCBITaxonomy(nodes_dmp, names_dmp)
+
+        Load the NCBI Taxonomy dump files (gzip or not).
+        """
+        self.parent = array.array('i')
+        self.rank = array.array('B')
+        self.name_id = array.array('i')
+        self.ranks = ['no rank']
+        self.names = ['']
+        self.lineages = LRUCache(cache_size)
+        self._load_nodes(nodes_dmp)
+        self._load_names(names_dmp)
+
+    def _load_nodes(self, nodes_dmp):
+        ranks = {'no rank': 0}
+        fh = open_text(nodes_dmp)
+        for line in fh:
+            fld = line.rstrip('\t|\n').split('\t|\t', 3)
+            taxid = int(fld[0])
+            rank = fld[2]
+            if rank not in ranks:
+                ranks[rank] = len(self.ranks)
+                self.ranks.append(rank)
+            _grow(self.parent, taxid + 1)
+            _grow(self.rank, taxid + 1)
+            self.parent[taxid] = int(fld[1])
+            self.rank[taxid] = ranks[rank]
+        fh.close()
+        size = len(self.parent)
+        self.name_id = array.array('i', [0]) * size
+
+    def _load_names(self, names_dmp):
+        fh = open_text(names_dmp)
+        size = len(self.name_id)
+        for line in fh:
+            fld = line.split('\t|\t')
+            if len(fld) > 3 and fld[3].startswith('scientific name'):
+                taxid = int(fld[0])
+                if taxid < size:
+                    self.name_id[taxid] = len(self.names)
+                    self.names.append(intern(fld[1]))
+        fh.close()
+
+    def has_taxid(self, taxid):
+        return taxid is not None and 0 < taxid < len(self.parent) and self.name_id[taxid] != 0
+
+    def name(self, taxid):
+        if self.has_taxid(taxid):
+            return self.names[self.name_id[taxid]]
+        return ''
+
+    def lineage(self, taxid):
+        """
+        t.lineage(taxid) --> 'name (rank); name; ...; name (rank)', '' if unknown
+
+        From the top of the taxonomy (root excluded) to taxid itself.
+        """
+        if not self.has_taxid(taxid):
+            return ''
+        lineage = self.lineages.get(taxid)
+        if lineage is not None:
+            return lineage
+        nodes = []
+        current = taxid
+        while current > 1 and len(nodes) < 256:
+            rank = self.rank[current]
+            if rank:
+                nodes.append('%s (%s)' % (self.names[self.name_id[current]], self.ranks[rank]))
+            else:
+                nodes.append(self.names[self.name_id[current]])
+            current = self.parent[current]
+        nodes.reverse()
+        lineage = '; '.join(nodes)
+        self.lineages[taxid] = lineage
+        return lineage
+
+
+##############################################################################
+#
+#            Pipeline stages: background threads linked by bounded queues
+#
+##############################################################################
+
+
+class _StageError(object):
+    def __init__(self, exc_info):
+        self.exc_info = exc_info
+
+    def reraise(self):
+        raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+
+
+def threaded_iter(iterable, depth, chunk_size=1000):
+    """
+    Iterate over iterable from a background thread. Items go through a queue
+    of at most depth chunks of chunk_size items. An exception raised by the
+    producer (including SystemExit) is raised again in the consumer.
+    """
+    queue = Queue.Queue(depth)
+
+    def produce():
+        try:
+            chunk = []
+            for item in iterable:
+                chunk.append(item)
+                if len(chunk) >= chunk_size:
+                    queue.put(chunk)
+                    chunk = []
+            if chunk:
+                queue.put(chunk)
+            queue.put(None)
+        except BaseException:
+            queue.put(_StageError(sys.exc_info()))
+
+    producer = threading.Thread(target=produce, name='reader')
+    producer.daemon = True
+    producer.start()
+    while True:
+        chunk = queue.get()
+        if chunk is None:
+            break
+        if isinstance(chunk, _StageError):
+            chunk.reraise()
+        for item in chunk:
+            yield item
+    producer.join()
+
+
+class ThreadedWriter(object):
+
+    def __init__(self, depth, *fhs):
+        """
+        w = ThreadedWriter(depth, fh1, fh2, ...)
+
+        Write in a background thread. w.write(str1, str2, ...) queues one
+        string for each file (None files are ignored); at most depth writes
+        wait in the queue.
+        """
+        self.fhs = fhs
+        self.queue = Queue.Queue(depth)
+        self.error = None
+        self.thread = threading.Thread(target=self._run, name='writer')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            strings = self.queue.get()
+            if strings is None:
+                break
+            if self.error:
+                continue
+            try:
+                for fh, string in zip(self.fhs, strings):
+                    if fh and string:
+                        fh.write(string)
+            except BaseException:
+                self.error = _StageError(sys.exc_info())
+
+    def write(self, *strings):
+        if self.error:
+            self.error.reraise()
+        self.queue.put(strings)
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        if self.error:
+            self.error.reraise()
+
+
+##############################################################################
+#
+#            Input shards: newline aligned byte ranges of a file
+#
+##############################################################################
+
+
+def split_ranges(path, nb):
+    """
+    split_ranges(path, nb) --> [(start, end), ...]
+
+    Split the file in at most nb contiguous byte ranges, each one starting
+    at the beginning of a line.
+    """
+    size = os.path.getsize(path)
+    bounds = [0]
+    fh = open(path, 'rb')
+    try:
+        for i in range(1, nb):
+            pos = size * i / nb
+            if pos <= bounds[-1]:
+                continue
+            fh.seek(pos - 1)
+            # the range ends after the line including pos - 1
+            fh.readline()
+            pos = fh.tell()
+            if bounds[-1] < pos < size:
+                bounds.append(pos)
+    finally:
+        fh.close()
+    bounds.append(size)
+    return [(bounds[i], bounds[i + 1]) for i in range(len(bounds) - 1)]
+
+
+class RangeReader(object):
+
+    def __init__(self, path, start, end):
+        """
+        r = RangeReader(path, start, end)
+
+        Read-only file object on the lines of path starting in [start, end[.
+        """
+        self.fh = open(path, 'rb')
+        self.fh.seek(start)
+        self.pos = start
+        self.end = end
+        self.name = path
+
+    def readline(self):
+        if self.pos >= self.end:
+            return ''
+        line = self.fh.readline()
+        self.pos += len(line)
+        return line
+
+    def __iter__(self):
+        return iter(self.readline, '')
+
+    def close(self):
+        self.fh.close()
+
+
+def copy_file(path, outfh, bufsize=1024 * 1024):
+    """
+    Append the content of the path file to outfh.
+    """
+    fh = open(path, 'rb')
+    try:
+        shutil.copyfileobj(fh, outfh, bufsize)
+    finally:
+        fh.close()
@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Persistent accession cache (taxoptimizer --cache_dir)
+#
+#  $ python -m unittest discover -s test
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+try:
+    import taxoptimizerlib
+except ImportError:
+    # bsddb3 not installed
+    taxoptimizerlib = None
+
+RECORD = ('Homo sapiens', '9606', 'Eukaryota; Chordata; Homo.', 'Eukaryota; Metazoa; Chordata; Homo.', 'Hemoglobin subunit beta')
+
+
+@unittest.skipIf(taxoptimizerlib is None, "bsddb3 is needed")
+class PersistentCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def test_description_of_an_e_run(self):
+        cache = taxoptimizerlib.PersistentCache(self.cache_dir, 'sign')
+        cache.put('sp:HBB_HUMAN', RECORD, description=True)
+        cache.close()
+
+        cache = taxoptimizerlib.PersistentCache(self.cache_dir, 'sign')
+        self.assertEqual(cache.get('sp:HBB_HUMAN'), RECORD[:-1] + ('',))
+        self.assertEqual(cache.get('sp:HBB_HUMAN', description=True), RECORD)
+        cache.close()
+
+    def test_no_description_for_an_e_run(self):
+        cache = taxoptimizerlib.PersistentCache(self.cache_dir, 'sign')
+        cache.put('sp:HBB_HUMAN', RECORD[:-1] + ('',))
+        self.assertEqual(cache.get('sp:HBB_HUMAN', description=True), None)
+        cache.close()
+
+    def test_evict(self):
+        cache = taxoptimizerlib.PersistentCache(self.cache_dir, 'sign', max_entries=10)
+        for nb in range(20):
+            cache.put('sp:ACC%d' % nb, RECORD)
+        cache.close()
+
+        cache = taxoptimizerlib.PersistentCache(self.cache_dir, 'sign', max_entries=10)
+        self.assertEqual(len([nb for nb in range(20) if cache.get('sp:ACC%d' % nb) is not None]), 9)
+        cache.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
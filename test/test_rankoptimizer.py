@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# rankoptimizer trees: worker partial trees (-w) merged vs one process
+#
+#  $ python -m unittest discover -s test
+
+import os
+import sys
+import Queue
+import random
+import shutil
+import argparse
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+import rankoptimizer
+import rankoptimizerlib
+
+TAXONOMIES = ['Eukaryota;Euka Phylum0;Euka Class2;Euka Order9;Euka Family38;Euka Genus153;',
+              'Eukaryota;Euka Phylum0;Euka Class2;Euka Order9;Euka Family40;',
+              'Eukaryota;Euka Phylum1;Euka Class5;',
+              'Bacteria;Proteobacteria;Gammaproteobacteria;Enterobacterales;Enterobacteriaceae;Escherichia.',
+              'Bacteria;Firmicutes;Bacilli;',
+              'Eukaryota (superkingdom); Euka Phylum0 (phylum); Euka Class3 (class); Euka Order12 (order); Euka Family48 (family); '
+              'Euka Genus194 (genus); Synthetic organism 778 (species)',
+              'Bacteria (superkingdom); Firmicutes (phylum); Bacilli (class); Bacillales (order)',
+              'Bacteria (superkingdom); Proteobacteria (phylum); Gammaproteobacteria (class)',
+              'cellular organisms; Archaea; Euryarchaeota;']
+
+
+def blast_lines(nb_queries, grouped, seed=7):
+    """
+    Taxoptimizer lines of nb_queries queries (1 to 4 HSPs each), grouped
+    by query or interleaved.
+    """
+    rand = random.Random(seed)
+    hsps = []
+    for nb in range(nb_queries):
+        query = 'read_%d' % rand.randint(0, 10 * nb_queries)
+        for hsp in range(rand.randint(1, 4)):
+            score = rand.choice([178.1, 177.0, 167.5, 150.2])
+            hsps.append([query, 'tr|S%07d|SYNTH' % rand.randint(0, 9999), '76.80', '274', '10', '0', '1', '123', '2407', '206',
+                         '1e-40', str(score), 'Synthetic organism.', rand.choice(TAXONOMIES)])
+    if not grouped:
+        rand.shuffle(hsps)
+    else:
+        # blocks in the order of the first line of each query
+        first = {}
+        for hsp in hsps:
+            first.setdefault(hsp[0], len(first))
+        hsps.sort(key=lambda hsp: first[hsp[0]])
+    return ''.join('\t'.join(hsp) + '\n' for hsp in hsps)
+
+
+def dump(taxon):
+    return (taxon.name, taxon.rank, taxon.nb_querys, list(taxon.queriesS), [dump(child) for child in taxon.childs])
+
+
+class MergeTreesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def args(self, **options):
+        args = argparse.Namespace(taxcolumn=14, scorecolumn=12, delta=0, clean=False, rank=False, grouped=False,
+                                  compact_tree=False, identical=False, workers=1)
+        for name, value in options.items():
+            setattr(args, name, value)
+        return args
+
+    def tab_file(self, grouped):
+        path = os.path.join(self.tmpdir, 'grouped.taxo' if grouped else 'interleaved.taxo')
+        with open(path, 'w') as tabfh:
+            tabfh.write(blast_lines(300, grouped))
+        return path
+
+    def one_process(self, args, path):
+        with open(path) as tabfh:
+            return rankoptimizer.build_tree(args, tabfh, rankoptimizer.new_tree(args))
+
+    def partial_trees(self, args, path, nb_workers):
+        # the lines of each worker, as sent by main_workers
+        queues = [Queue.Queue() for worker in range(nb_workers)]
+        with open(path) as tabfh:
+            rankoptimizer._dispatch(tabfh, queues, {}, args.grouped)
+        trees = []
+        order = {}
+        for queue in queues:
+            with open(path) as tabfh:
+                trees.append(rankoptimizer.build_tree(args, tabfh, rankoptimizer.new_tree(args), rankoptimizer._worker_lines(queue), order))
+        return trees, order
+
+    def check_merge(self, grouped, **options):
+        args = self.args(grouped=grouped, **options)
+        path = self.tab_file(grouped)
+        expected = dump(self.one_process(args, path))
+        for nb_workers in (2, 3, 5):
+            trees, order = self.partial_trees(args, path, nb_workers)
+            merged = rankoptimizerlib.merge_trees(trees, rankoptimizer.new_tree(args), order.get)
+            self.assertEqual(dump(merged), expected, "%d workers %s" % (nb_workers, options))
+        return expected
+
+    def test_two_pass(self):
+        self.check_merge(False)
+
+    def test_two_pass_rank_delta(self):
+        self.check_merge(False, rank=True)
+        self.check_merge(False, delta=5)
+        self.check_merge(False, rank=True, delta=5)
+
+    def test_grouped(self):
+        # -g and the two pass mode build one tree
+        for options in ({}, {'rank': True}, {'delta': 5}, {'rank': True, 'delta': 5}):
+            self.assertEqual(self.check_merge(True, **options), dump(self.one_process(self.args(**options), self.tab_file(True))))
+
+    def test_main_workers(self):
+        args = self.args(workers=3, rank=True, delta=5)
+        path = self.tab_file(False)
+        with open(path) as tabfh:
+            taxo_tree = rankoptimizer.main_workers(args, tabfh)
+        self.assertEqual(dump(taxo_tree), dump(self.one_process(args, path)))
+
+
+if __name__ == '__main__':
+    unittest.main()